@@ -0,0 +1,86 @@
+"""
+Benchmark resample against resample_gather_nd.
+
+Both functions sample a random volume at randomly perturbed grid locations
+inside a tf.function, the forward and backward passes are timed.
+The peak memory is reported if a GPU is available.
+
+Example:
+
+    python benchmark/resample.py --batch_size 2 --size 128 --channel 1
+"""
+import argparse
+import time
+from typing import Callable, Dict
+
+import tensorflow as tf
+
+from deepreg.model.layer_util import get_reference_grid, resample, resample_gather_nd
+
+
+def benchmark(
+    fn: Callable, vol: tf.Tensor, loc: tf.Tensor, repeat: int
+) -> Dict[str, float]:
+    """
+    Time the forward and backward passes of a resample function.
+
+    :param fn: resample or resample_gather_nd.
+    :param vol: shape = (batch, dim1, dim2, dim3) or (batch, dim1, dim2, dim3, ch)
+    :param loc: shape = (batch, dim1, dim2, dim3, 3)
+    :param repeat: number of timed runs, after one warm-up run.
+    :return: dict of mean time in seconds and peak memory in MB.
+    """
+
+    @tf.function
+    def step(v: tf.Tensor, x: tf.Tensor) -> tf.Tensor:
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            sampled = fn(vol=v, loc=x)
+            loss = tf.reduce_sum(sampled)
+        return tape.gradient(loss, x)
+
+    step(vol, loc).numpy()  # warm-up and tracing
+
+    gpus = tf.config.list_logical_devices("GPU")
+    if gpus:
+        tf.config.experimental.reset_memory_stats(gpus[0].name)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        step(vol, loc).numpy()
+    duration = (time.perf_counter() - start) / repeat
+    peak = (
+        tf.config.experimental.get_memory_info(gpus[0].name)["peak"] / 2 ** 20
+        if gpus
+        else float("nan")
+    )
+    return dict(time=duration, peak=peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--size", type=int, default=128, help="volume size per axis")
+    parser.add_argument("--channel", type=int, default=0, help="0 for no channel")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    shape = (args.size,) * 3
+    vol_shape = (args.batch_size, *shape) + ((args.channel,) if args.channel else ())
+    vol = tf.random.uniform(shape=vol_shape)
+    grid = get_reference_grid(grid_size=shape)[None, ...]  # (1, *shape, 3)
+    loc = grid + tf.random.normal(shape=(args.batch_size, *shape, 3), stddev=2.0)
+
+    print(f"vol shape = {vol_shape}, loc shape = {tuple(loc.shape)}")
+    for name, fn in [
+        ("resample", resample),
+        ("resample_gather_nd", resample_gather_nd),
+    ]:
+        result = benchmark(fn=fn, vol=vol, loc=loc, repeat=args.repeat)
+        print(
+            f"{name:>20s}: {result['time'] * 1000:8.1f} ms, "
+            f"peak memory {result['peak']:8.1f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark UNet with and without gradient checkpointing.
+
+For each depth, a UNet is built with and without gradient checkpointing,
+the forward and backward passes on a random batch are timed inside a
+tf.function. The peak memory is reported if a GPU is available.
+
+Example:
+
+    python benchmark/unet.py --batch_size 2 --size 128 --depths 3 4 5
+"""
+import argparse
+import time
+from typing import Dict
+
+import tensorflow as tf
+
+from deepreg.model.backbone import UNet
+
+
+def benchmark(
+    depth: int,
+    gradient_checkpointing: bool,
+    inputs: tf.Tensor,
+    num_channel_initial: int,
+    repeat: int,
+) -> Dict[str, float]:
+    """
+    Time the forward and backward passes of a UNet.
+
+    :param depth: depth of the UNet.
+    :param gradient_checkpointing: whether to recompute activations of conv blocks.
+    :param inputs: shape = (batch, dim1, dim2, dim3, 2)
+    :param num_channel_initial: number of initial channels.
+    :param repeat: number of timed runs, after one warm-up run.
+    :return: dict of mean time in seconds and peak memory in MB.
+    """
+    gpus = tf.config.list_logical_devices("GPU")
+    if gpus:
+        tf.config.experimental.reset_memory_stats(gpus[0].name)
+
+    net = UNet(
+        image_size=tuple(inputs.shape[1:4]),
+        num_channel_initial=num_channel_initial,
+        depth=depth,
+        out_kernel_initializer="glorot_uniform",
+        out_activation=None,
+        out_channels=3,
+        extract_levels=(0,),
+        gradient_checkpointing=gradient_checkpointing,
+    )
+
+    @tf.function
+    def step(x: tf.Tensor) -> tf.Tensor:
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(net(x, training=True) ** 2)
+        grads = tape.gradient(loss, net.trainable_variables)
+        return tf.add_n([tf.reduce_sum(g) for g in grads])
+
+    step(inputs).numpy()  # warm-up and tracing
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        step(inputs).numpy()
+    duration = (time.perf_counter() - start) / repeat
+    peak = (
+        tf.config.experimental.get_memory_info(gpus[0].name)["peak"] / 2 ** 20
+        if gpus
+        else float("nan")
+    )
+    return dict(time=duration, peak=peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--size", type=int, default=64, help="volume size per axis")
+    parser.add_argument("--num_channel_initial", type=int, default=16)
+    parser.add_argument("--depths", type=int, nargs="+", default=[3, 4, 5])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    inputs = tf.random.uniform(shape=(args.batch_size, *(args.size,) * 3, 2))
+    print(
+        f"inputs shape = {tuple(inputs.shape)}, "
+        f"num_channel_initial = {args.num_channel_initial}"
+    )
+    for depth in args.depths:
+        for gradient_checkpointing in [False, True]:
+            result = benchmark(
+                depth=depth,
+                gradient_checkpointing=gradient_checkpointing,
+                inputs=inputs,
+                num_channel_initial=args.num_channel_initial,
+                repeat=args.repeat,
+            )
+            print(
+                f"depth {depth}, gradient_checkpointing {gradient_checkpointing!s:>5}: "
+                f"{result['time'] * 1000:8.1f} ms, "
+                f"peak memory {result['peak']:8.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import os
 from copy import deepcopy
+from functools import partial
 from typing import Optional
 
 from deepreg.constant import KNOWN_DATA_SPLITS
@@ -44,11 +45,21 @@ def get_data_loader(data_config: dict, split: str) -> Optional[DataLoader]:
     }
     data_loader_config["name"] = data_loader_config.pop("type")
 
+    # format is either the name of the file loader
+    # or a dict having the name and extra arguments of the file loader
+    file_loader_config = data_config[split]["format"]
+    if isinstance(file_loader_config, str):
+        file_loader_config = dict(name=file_loader_config)
+    file_loader_config = deepcopy(file_loader_config)
+    file_loader = REGISTRY.get(
+        category=FILE_LOADER_CLASS, key=file_loader_config.pop("name")
+    )
+    if len(file_loader_config) > 0:
+        file_loader = partial(file_loader, **file_loader_config)
+
     default_args = dict(
         data_dir_paths=data_dir_paths,
-        file_loader=REGISTRY.get(
-            category=FILE_LOADER_CLASS, key=data_config[split]["format"]
-        ),
+        file_loader=file_loader,
         labeled=data_config[split]["labeled"],
         sample_label="sample" if split == "train" else "all",
         seed=None if split == "train" else 0,
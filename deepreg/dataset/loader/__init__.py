@@ -2,5 +2,6 @@
 from deepreg.dataset.loader.grouped_loader import GroupedDataLoader
 from deepreg.dataset.loader.h5_loader import H5FileLoader
 from deepreg.dataset.loader.nifti_loader import NiftiFileLoader
+from deepreg.dataset.loader.npy_cache_loader import NpyCacheFileLoader
 from deepreg.dataset.loader.paired_loader import PairedDataLoader
 from deepreg.dataset.loader.unpaired_loader import UnpairedDataLoader
@@ -0,0 +1,96 @@
+"""
+In-process cache of decoded volumes shared by file loaders.
+"""
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import numpy as np
+
+
+class VolumeCache:
+    """
+    Least-recently-used cache of numpy arrays bounded by a byte budget.
+
+    Cached arrays are marked as read-only, so that consumers cannot modify
+    the shared copy by accident. The cache is thread-safe.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Init.
+
+        :param max_bytes: maximum number of bytes held by the cache,
+            arrays larger than this budget are never cached.
+        """
+        if max_bytes < 0:
+            raise ValueError(f"max_bytes must be non-negative, got {max_bytes}")
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self._arrays: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        """
+        Return the cached array and mark it as the most recently used.
+
+        :param key: key identifying the array.
+        :return: the cached array, or None if the key is not cached.
+        """
+        with self._lock:
+            if key not in self._arrays:
+                return None
+            self._arrays.move_to_end(key)
+            return self._arrays[key]
+
+    def put(self, key: Hashable, arr: np.ndarray):
+        """
+        Cache an array, evicting least recently used ones if over budget.
+
+        :param key: key identifying the array.
+        :param arr: array to be cached.
+        """
+        if arr.nbytes > self.max_bytes:
+            return
+        arr.flags.writeable = False
+        with self._lock:
+            if key in self._arrays:
+                self.nbytes -= self._arrays.pop(key).nbytes
+            while self._arrays and self.nbytes + arr.nbytes > self.max_bytes:
+                _, evicted = self._arrays.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+            self._arrays[key] = arr
+            self.nbytes += arr.nbytes
+
+    def clear(self):
+        """Remove all cached arrays."""
+        with self._lock:
+            self._arrays.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._arrays
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._arrays)
+
+    def __getstate__(self) -> dict:
+        """
+        Return the state to pickle, used when starting worker processes.
+
+        The cached arrays and the lock are not pickled,
+        so that each process owns an empty cache with the same budget.
+
+        :return: state without cached arrays.
+        """
+        return dict(max_bytes=self.max_bytes)
+
+    def __setstate__(self, state: dict):
+        """
+        Restore an empty cache from a pickled state.
+
+        :param state: state returned by __getstate__.
+        """
+        self.__init__(max_bytes=state["max_bytes"])  # type: ignore
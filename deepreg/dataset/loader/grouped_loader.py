@@ -37,6 +37,7 @@ class GroupedDataLoader(AbstractUnpairedDataLoader, GeneratorDataLoader):
         sample_image_in_group: bool,
         seed: Optional[int],
         image_shape: Union[Tuple[int, ...], List[int]],
+        **kwargs,
     ):
         """
         :param file_loader: a subclass of FileLoader
@@ -47,7 +48,7 @@ class GroupedDataLoader(AbstractUnpairedDataLoader, GeneratorDataLoader):
           - labels
 
         :param labeled: bool, true if the data is labeled, false if unlabeled
-        :param sample_label: "sample" or "all", read `get_label_indices`
+        :param sample_label: "sample", "all" or "stack", read `sample_image_label`
             in deepreg/dataset/util.py for more details.
         :param intra_group_prob: float between 0 and 1,
 
@@ -65,12 +66,14 @@ class GroupedDataLoader(AbstractUnpairedDataLoader, GeneratorDataLoader):
             if seed=None, then the randomness is not fixed
         :param image_shape: list or tuple of length 3,
             corresponding to (dim1, dim2, dim3) of the 3D image
+        :param kwargs: additional arguments.
         """
         super().__init__(
             image_shape=image_shape,
             labeled=labeled,
             sample_label=sample_label,
             seed=seed,
+            **kwargs,
         )
         assert isinstance(
             data_dir_paths, list
@@ -280,6 +283,7 @@ class GroupedDataLoader(AbstractUnpairedDataLoader, GeneratorDataLoader):
 
     def close(self):
         """Close file loaders"""
+        super().close()
         self.loader_moving_image.close()
         if self.labeled is True:
             self.loader_moving_label.close()
@@ -2,7 +2,7 @@
 Load h5 files and associated information.
 """
 import os
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import h5py
 import numpy as np
@@ -15,18 +15,38 @@ DATA_KEY_FORMAT = "group-{}-{}"
 
 @REGISTRY.register_file_loader(name="h5")
 class H5FileLoader(FileLoader):
-    """Generalized loader for h5 files."""
+    """
+    Generalized loader for h5 files.
 
-    def __init__(self, dir_paths: List[str], name: str, grouped: bool):
+    File handles are opened per process, so that the loader can be used
+    by decoding worker processes.
+    """
+
+    def __init__(
+        self,
+        dir_paths: List[str],
+        name: str,
+        grouped: bool,
+        chunk_cache_size_mb: Optional[float] = None,
+        swmr: bool = False,
+    ):
         """
         Init.
 
         :param dir_paths: path of h5 files.
         :param name: name is used to identify the file names.
         :param grouped: whether the data is grouped.
+        :param chunk_cache_size_mb: size in megabytes of the raw data chunk cache
+            per opened dataset, if None, the default of h5py is used.
+        :param swmr: open files in single-writer multiple-reader mode,
+            the files must have been written with libver="latest".
         """
         super().__init__(dir_paths=dir_paths, name=name, grouped=grouped)
+        self.chunk_cache_size_mb = chunk_cache_size_mb
+        self.swmr = swmr
         self.h5_files = None
+        # id of the process which opened the h5 files
+        self.pid = None
         self.data_path_splits = None
         self.set_data_structure()
         self.group_struct = None
@@ -54,7 +74,7 @@ class H5FileLoader(FileLoader):
             assert os.path.exists(
                 h5_file_path
             ), f"h5 file {h5_file_path} does not exist"
-            h5_file = h5py.File(h5_file_path, "r")
+            h5_file = self.open_h5_file(dir_path=dir_path)
             h5_files[dir_path] = h5_file
 
             if self.grouped:
@@ -74,8 +94,39 @@ class H5FileLoader(FileLoader):
                 f"please verify the path is correct."
             )
         self.h5_files = h5_files
+        self.pid = os.getpid()
         self.data_path_splits = data_path_splits
 
+    def open_h5_file(self, dir_path: str) -> h5py.File:
+        """
+        Open the h5 file of the data under dir_path in read mode.
+
+        :param dir_path: path of the directory having the h5 file.
+        :return: opened h5 file handle.
+        """
+        kwargs = dict(swmr=self.swmr)
+        if self.chunk_cache_size_mb is not None:
+            kwargs["rdcc_nbytes"] = int(self.chunk_cache_size_mb * 1024 ** 2)
+        return h5py.File(os.path.join(dir_path, self.name + ".h5"), "r", **kwargs)
+
+    def get_h5_file(self, dir_path: str) -> h5py.File:
+        """
+        Return the h5 file handle opened by the current process.
+
+        Handles inherited from a parent process can not be shared safely,
+        the files are therefore reopened in a new process.
+
+        :param dir_path: path of the directory having the h5 file.
+        :return: opened h5 file handle.
+        """
+        if self.pid != os.getpid():
+            self.h5_files = {
+                dir_path: self.open_h5_file(dir_path=dir_path)
+                for dir_path in self.dir_paths
+            }
+            self.pid = os.getpid()
+        return self.h5_files[dir_path]  # type: ignore
+
     def set_group_structure(self):
         """
         Similar to NiftiLoader
@@ -127,13 +178,29 @@ class H5FileLoader(FileLoader):
                 f"index for H5FileLoader.get_data must be int, "
                 f"or tuple of length two, got {index}"
             )
-        arr = np.asarray(self.h5_files[dir_path][data_key], dtype=np.float32)
+        dataset = self.get_h5_file(dir_path=dir_path)[data_key]
+        if dataset.dtype == np.float32:
+            # read chunks directly into the output without intermediate copies
+            arr = np.empty(dataset.shape, dtype=np.float32)
+            dataset.read_direct(arr)
+        else:
+            arr = np.asarray(dataset, dtype=np.float32)
         if len(arr.shape) == 4 and arr.shape[3] == 1:
             # for labels, if there's only one label, remove the last dimension
             # currently have not encountered
             arr = arr[:, :, :, 0]  # pragma: no cover
         return arr
 
+    def get_data_file_path(self, data_index: int) -> str:
+        """
+        Return the path of the h5 file storing one data array.
+
+        :param data_index: index of the data, not grouped.
+        :return: path of the file, shared by all data of the same directory.
+        """
+        dir_path = self.data_path_splits[data_index][0]  # type: ignore
+        return os.path.join(dir_path, self.name + ".h5")
+
     def get_data_ids(self) -> List:
         """
         Get the unique IDs of data in this data set to
@@ -151,7 +218,76 @@ class H5FileLoader(FileLoader):
         """
         return len(self.data_path_splits)  # type: ignore
 
+    def __getstate__(self) -> dict:
+        """
+        Return the state to pickle, used when starting worker processes.
+
+        File handles can not be pickled, they are reopened by get_h5_file.
+
+        :return: state without file handles.
+        """
+        state = self.__dict__.copy()
+        state["h5_files"] = dict()
+        state["pid"] = None
+        return state
+
     def close(self):
         """Close opened h5 file handles."""
         for f in self.h5_files.values():
             f.close()
+
+
+def convert_h5_file(
+    src_file_path: str,
+    dst_file_path: str,
+    compression: Optional[str] = "lzf",
+    compression_opts: Optional[int] = None,
+    chunks: Union[bool, Tuple[int, ...]] = True,
+):
+    """
+    Copy all datasets of a h5 file into a chunked and compressed h5 file.
+
+    The output file is written with libver="latest",
+    so that it can be read in single-writer multiple-reader mode.
+
+    :param src_file_path: path of the h5 file to convert.
+    :param dst_file_path: path of the output h5 file.
+    :param compression: "lzf", "gzip", "blosc" or None,
+        blosc requires the package hdf5plugin,
+        which also has to be imported when reading the converted files.
+    :param compression_opts: compression level for gzip.
+    :param chunks: True to let h5py guess the chunk shape,
+        or the chunk shape which is clipped to the shape of each dataset,
+        missing trailing dimensions are not chunked.
+    """
+    if compression not in ["lzf", "gzip", "blosc", None]:
+        raise ValueError(
+            f"compression must be lzf, gzip, blosc or None, got {compression}"
+        )
+    if compression == "blosc":
+        try:
+            import hdf5plugin
+        except ImportError as err:  # pragma: no cover
+            raise ImportError(
+                "Blosc compression requires hdf5plugin, "
+                "please install it with pip install hdf5plugin."
+            ) from err
+        compression_kwargs = dict(hdf5plugin.Blosc())
+    else:
+        compression_kwargs = dict(
+            compression=compression, compression_opts=compression_opts
+        )
+
+    with h5py.File(src_file_path, "r") as src_file, h5py.File(
+        dst_file_path, "w", libver="latest"
+    ) as dst_file:
+        for key in src_file.keys():
+            arr = src_file[key][()]
+            dataset_chunks = chunks
+            if isinstance(chunks, (tuple, list)):
+                dataset_chunks = tuple(
+                    min(c, s) for c, s in zip(chunks, arr.shape)
+                ) + tuple(arr.shape[len(chunks) :])
+            dst_file.create_dataset(
+                key, data=arr, chunks=dataset_chunks, **compression_kwargs
+            )
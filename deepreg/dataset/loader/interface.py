@@ -2,20 +2,51 @@
 Interface between the data loaders and file loaders.
 """
 
+import multiprocessing
 from abc import ABC
-from typing import Dict, List, Optional, Tuple, Union
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import tensorflow as tf
 
 from deepreg import log
-from deepreg.dataset.loader.util import normalize_array
-from deepreg.dataset.preprocess import resize_inputs
+from deepreg.dataset.loader.util import get_min_max, normalize_array
+from deepreg.dataset.preprocess import resize_inputs, sample_patch
 from deepreg.dataset.util import get_label_indices
 from deepreg.registry import REGISTRY
 
 logger = log.get(__name__)
 
+# data loader used by the decoding worker processes, see GeneratorDataLoader
+_worker_data_loader = None
+
+
+def _set_worker_data_loader(data_loader: "GeneratorDataLoader"):
+    """
+    Store the data loader in a decoding worker process.
+
+    :param data_loader: data loader whose file loaders decode the data.
+    """
+    global _worker_data_loader
+    _worker_data_loader = data_loader
+
+
+def _load_images_in_worker(
+    moving_index: Union[int, Tuple[int, ...]], fixed_index: Union[int, Tuple[int, ...]]
+) -> tuple:
+    """
+    Load images and labels in a decoding worker process.
+
+    :param moving_index: index of the moving image and label.
+    :param fixed_index: index of the fixed image and label.
+    :return: (moving_image, fixed_image, moving_label, fixed_label)
+    """
+    return _worker_data_loader.load_images(  # type: ignore
+        moving_index=moving_index, fixed_index=fixed_index
+    )
+
 
 class DataLoader:
     """
@@ -28,12 +59,23 @@ class DataLoader:
         num_indices: Optional[int],
         sample_label: Optional[str],
         seed: Optional[int] = None,
+        patch_size: Optional[Union[Tuple[int, ...], List[int]]] = None,
+        patch_sampling: str = "random",
     ):
         """
         :param labeled: bool corresponding to labels provided or omitted
         :param num_indices:
         :param sample_label:
         :param seed:
+        :param patch_size: (p_dim1, p_dim2, p_dim3), if not None,
+            a patch of this size is cropped from each sample after resizing,
+            at the same coordinates for moving and fixed images,
+            and the start coordinates of the patch are added to indices.
+        :param patch_sampling: "random" or "foreground",
+
+          - random: patches are sampled uniformly,
+          - foreground: patches are centered at a random voxel of the fixed label
+            foreground, random patches are sampled for unlabeled data.
         """
         assert labeled in [
             True,
@@ -43,8 +85,9 @@ class DataLoader:
         assert sample_label in [
             "sample",
             "all",
+            "stack",
             None,
-        ], f"sample_label must be sample, all or None, got {sample_label}"
+        ], f"sample_label must be sample, all, stack or None, got {sample_label}"
         assert (
             num_indices is None or num_indices >= 1
         ), f"num_indices must be int >=1 or None, got {num_indices}"
@@ -52,10 +95,22 @@ class DataLoader:
             seed, int
         ), f"seed must be None or int, got {seed}"
 
+        if patch_size is not None and (len(patch_size) != 3 or min(patch_size) < 1):
+            raise ValueError(
+                f"patch_size must be None or three positive integers, "
+                f"got {patch_size}"
+            )
+        if patch_sampling not in ["random", "foreground"]:
+            raise ValueError(
+                f"patch_sampling must be random or foreground, got {patch_sampling}"
+            )
+
         self.labeled = labeled
         self.num_indices = num_indices  # number of indices to identify a sample
         self.sample_label = sample_label
         self.seed = seed  # used for sampling
+        self.patch_size = None if patch_size is None else tuple(patch_size)
+        self.patch_sampling = patch_sampling
 
     @property
     def moving_image_shape(self) -> tuple:
@@ -79,9 +134,51 @@ class DataLoader:
         """
         raise NotImplementedError
 
-    def get_dataset(self) -> tf.data.Dataset:
+    @property
+    def moving_sample_shape(self) -> tuple:
+        """
+        Return the shape of moving images in the preprocessed dataset.
+        :return: patch size if patches are sampled, otherwise moving image shape
+        """
+        if self.patch_size is None:
+            return self.moving_image_shape
+        return self.patch_size
+
+    @property
+    def fixed_sample_shape(self) -> tuple:
+        """
+        Return the shape of fixed images in the preprocessed dataset.
+        :return: patch size if patches are sampled, otherwise fixed image shape
+        """
+        if self.patch_size is None:
+            return self.fixed_image_shape
+        return self.patch_size
+
+    @property
+    def num_sample_indices(self) -> int:
+        """
+        Return the number of indices identifying a sample in the preprocessed dataset.
+        :return: num_indices, plus three if patches are sampled
+            as the start coordinates of patches are added
+        """
+        if self.patch_size is None:
+            return self.num_indices  # type:ignore
+        return self.num_indices + 3  # type:ignore
+
+    @property
+    def shuffle_indices(self) -> bool:
+        """
+        Return if the dataset shuffles the sample indices before loading the files.
+        :return: false by default, the loaded samples are shuffled
+        """
+        return False
+
+    def get_dataset(self, shuffle_buffer_size: int = 0) -> tf.data.Dataset:
         """
         defined in GeneratorDataLoader.
+
+        :param shuffle_buffer_size: buffer size to shuffle the sample indices,
+            only used if shuffle_indices is true, 0 means no shuffle.
         """
         raise NotImplementedError
 
@@ -93,6 +190,8 @@ class DataLoader:
         shuffle_buffer_num_batch: int,
         data_augmentation: Optional[Union[List, Dict]] = None,
         num_parallel_calls: int = tf.data.experimental.AUTOTUNE,
+        augmentation_mode: str = "batch",
+        resize: bool = True,
     ) -> tf.data.Dataset:
         """
         Generate tf.data.dataset.
@@ -112,49 +211,173 @@ class DataLoader:
         :param num_parallel_calls: number elements to process asynchronously in parallel
             during preprocessing, -1 means unlimited, heuristically it should be set to
             the number of CPU cores available. AUTOTUNE=-1 means not limited.
+        :param augmentation_mode: "sample" or "batch",
+
+          - sample: each sample is augmented in the parallel map before batching,
+          - batch: each batch is augmented after batching,
+            the batch may be smaller than batch_size.
+
+        :param resize: if false, images and labels keep their original shapes,
+            which may differ between samples, batch_size should then be one.
         :returns dataset:
         """
+        if augmentation_mode not in ["sample", "batch"]:
+            raise ValueError(
+                f"augmentation_mode must be sample or batch, got {augmentation_mode}"
+            )
 
-        dataset = self.get_dataset()
-
-        # resize
-        dataset = dataset.map(
-            lambda x: resize_inputs(
-                inputs=x,
-                moving_image_size=self.moving_image_shape,
-                fixed_image_size=self.fixed_image_shape,
-            ),
-            num_parallel_calls=num_parallel_calls,
+        shuffle_buffer_size = (
+            batch_size * shuffle_buffer_num_batch
+            if training and shuffle_buffer_num_batch > 0
+            else 0
         )
+        dataset = self.get_dataset(shuffle_buffer_size=shuffle_buffer_size)
+
+        # resize, moving images are resized to the fixed image shape
+        # if patches are sampled, so that they are cropped at the same coordinates
+        if resize:
+            dataset = dataset.map(
+                lambda x: resize_inputs(
+                    inputs=x,
+                    moving_image_size=self.moving_image_shape
+                    if self.patch_size is None
+                    else self.fixed_image_shape,
+                    fixed_image_size=self.fixed_image_shape,
+                ),
+                num_parallel_calls=num_parallel_calls,
+            )
+
+        augment = None
+        if training and data_augmentation is not None:
+            augment = self.get_augmentation_fn(
+                data_augmentation=data_augmentation,
+                batch_size=1 if augmentation_mode == "sample" else batch_size,
+            )
 
         # shuffle / repeat / batch / preprocess
-        if training and shuffle_buffer_num_batch > 0:
+        if shuffle_buffer_size > 0 and not self.shuffle_indices:
             dataset = dataset.shuffle(
-                buffer_size=batch_size * shuffle_buffer_num_batch,
-                reshuffle_each_iteration=True,
+                buffer_size=shuffle_buffer_size, reshuffle_each_iteration=True
             )
         if repeat:
             dataset = dataset.repeat()
 
+        if self.patch_size is not None:
+            # patches are sampled after repeat so that they differ between epochs
+            dataset = self.sample_patches(
+                dataset=dataset, num_parallel_calls=num_parallel_calls
+            )
+
+        if augment is not None and augmentation_mode == "sample":
+            # samples are augmented as batches of one sample
+
+            def augment_sample(step: tf.Tensor, inputs: dict) -> dict:
+                inputs = {k: tf.expand_dims(v, axis=0) for k, v in inputs.items()}
+                outputs = augment(step, inputs)  # type: ignore
+                return {k: tf.squeeze(v, axis=0) for k, v in outputs.items()}
+
+            dataset = tf.data.Dataset.zip(
+                (tf.data.experimental.Counter(dtype=tf.int64), dataset)
+            )
+            dataset = dataset.map(augment_sample, num_parallel_calls=num_parallel_calls)
+
         dataset = dataset.batch(batch_size=batch_size, drop_remainder=training)
         dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
-        if training and data_augmentation is not None:
-            if isinstance(data_augmentation, dict):
-                data_augmentation = [data_augmentation]
-            for config in data_augmentation:
-                da_fn = REGISTRY.build_data_augmentation(
-                    config=config,
-                    default_args={
-                        "moving_image_size": self.moving_image_shape,
-                        "fixed_image_size": self.fixed_image_shape,
-                        "batch_size": batch_size,
-                    },
-                )
-                dataset = dataset.map(da_fn, num_parallel_calls=num_parallel_calls)
+        if augment is not None and augmentation_mode == "batch":
+            dataset = tf.data.Dataset.zip(
+                (tf.data.experimental.Counter(dtype=tf.int64), dataset)
+            )
+            dataset = dataset.map(augment, num_parallel_calls=num_parallel_calls)
 
         return dataset
 
+    def get_augmentation_fn(
+        self, data_augmentation: Union[List, Dict], batch_size: int
+    ) -> Callable[[tf.Tensor, dict], dict]:
+        """
+        Build the function applying all data augmentations.
+
+        Each step uses different stateless seeds derived from the step count,
+        so that the augmentation is reproducible given the data loader seed.
+
+        :param data_augmentation: augmentation config, can be a list of dict or dict.
+        :param batch_size: default number of samples in a batch.
+        :return: a function taking the step count and the inputs,
+            and returning the augmented inputs.
+        """
+        if isinstance(data_augmentation, dict):
+            data_augmentation = [data_augmentation]
+        da_fns = [
+            REGISTRY.build_data_augmentation(
+                config=config,
+                default_args={
+                    "moving_image_size": self.moving_sample_shape,
+                    "fixed_image_size": self.fixed_sample_shape,
+                    "batch_size": batch_size,
+                },
+            )
+            for config in data_augmentation
+        ]
+        base_seed = (
+            np.random.randint(np.iinfo(np.int32).max)
+            if self.seed is None
+            else self.seed
+        )
+
+        def augment(step: tf.Tensor, inputs: dict) -> dict:
+            for i, da_fn in enumerate(da_fns):
+                seed = tf.stack([step, base_seed * len(da_fns) + i])
+                inputs = da_fn(inputs, seed=seed)
+            return inputs
+
+        return augment
+
+    def sample_patches(
+        self, dataset: tf.data.Dataset, num_parallel_calls: int
+    ) -> tf.data.Dataset:
+        """
+        Crop one patch per sample, using stateless seeds derived from the sample count.
+
+        :param dataset: dataset of samples having moving and fixed images
+            of the same shape.
+        :param num_parallel_calls: number elements to process in parallel.
+        :return: dataset of patches.
+        """
+        if any(p > s for p, s in zip(self.patch_size, self.fixed_image_shape)):
+            raise ValueError(
+                f"patch_size must not be larger than the image shape, "
+                f"got patch_size = {self.patch_size} "
+                f"and fixed_image_shape = {self.fixed_image_shape}"
+            )
+        foreground = self.patch_sampling == "foreground"
+        if foreground and not self.labeled:
+            logger.warning(
+                "Patches are sampled randomly instead of on the foreground, "
+                "as the data is not labeled."
+            )
+            foreground = False
+        base_seed = (
+            np.random.randint(np.iinfo(np.int32).max)
+            if self.seed is None
+            else self.seed
+        )
+
+        def crop(step: tf.Tensor, inputs: dict) -> dict:
+            # negative seeds avoid the seeds used by data augmentation
+            seed = tf.stack([step, tf.constant(-1 - base_seed, dtype=tf.int64)])
+            return sample_patch(
+                inputs=inputs,
+                patch_size=self.patch_size,  # type:ignore
+                seed=seed,
+                foreground=foreground,
+            )
+
+        dataset = tf.data.Dataset.zip(
+            (tf.data.experimental.Counter(dtype=tf.int64), dataset)
+        )
+        return dataset.map(crop, num_parallel_calls=num_parallel_calls)
+
     def close(self):
         pass
 
@@ -254,23 +477,124 @@ class GeneratorDataLoader(DataLoader, ABC):
     Load samples by implementing get_dataset from DataLoader.
     """
 
-    def __init__(self, **kwargs):
+    def __init__(
+        self,
+        num_workers: int = 0,
+        executor: str = "thread",
+        pipeline: str = "generator",
+        num_shards: int = 1,
+        shard_index: int = 0,
+        validation: str = "full",
+        intensity_window: Optional[Union[str, List[float]]] = None,
+        **kwargs,
+    ):
         """
         Init.
 
+        :param num_workers: number of workers decoding the data in parallel,
+            0 means the data are decoded sequentially in the generator.
+            For the index pipeline, it is the number of parallel calls
+            when loading files, 0 means AUTOTUNE.
+        :param executor: "thread" or "process", type of the decoding workers.
+            Processes avoid the contention on the Python GIL
+            but require the data loader to be pickled.
+            Only used by the generator pipeline.
+        :param pipeline: "generator" or "index",
+
+          - generator: samples are loaded in a Python generator,
+          - index: only the sample indices are generated,
+            files are loaded in a parallel map of tf.data.
+
+        :param num_shards: number of shards of the dataset,
+            only supported by the index pipeline.
+        :param shard_index: index of the shard to load,
+            only supported by the index pipeline.
+        :param validation: "full", "once" or "off",
+
+          - full: the values and shapes of all samples are validated at every yield,
+          - once: the values of each file are validated only the first time
+            it is loaded, shapes are still validated at every yield,
+          - off: samples are not validated.
+
+        :param intensity_window: window used to normalize the images into [0, 1],
+
+          - None: the min/max of each image, read from the file loader
+            if it has precomputed statistics, otherwise computed from the image,
+          - [v_min, v_max]: a fixed window, e.g. a Hounsfield window for CT,
+            values outside the window are clipped,
+          - "dataset": the min/max over all moving or fixed images,
+            computed once when the first sample is loaded.
+
         :param kwargs: additional arguments.
         """
         super().__init__(**kwargs)
+        if num_workers < 0:
+            raise ValueError(f"num_workers must be non-negative, got {num_workers}")
+        if executor not in ["thread", "process"]:
+            raise ValueError(f"executor must be thread or process, got {executor}")
+        if pipeline not in ["generator", "index"]:
+            raise ValueError(f"pipeline must be generator or index, got {pipeline}")
+        if not 0 <= shard_index < num_shards:
+            raise ValueError(
+                f"shard_index must be in [0, num_shards), "
+                f"got shard_index = {shard_index} and num_shards = {num_shards}"
+            )
+        if num_shards > 1 and pipeline != "index":
+            raise ValueError("Sharding is only supported by the index pipeline.")
+        if not (
+            intensity_window is None
+            or intensity_window == "dataset"
+            or (
+                isinstance(intensity_window, (list, tuple))
+                and len(intensity_window) == 2
+                and intensity_window[0] < intensity_window[1]
+            )
+        ):
+            raise ValueError(
+                f"intensity_window must be None, dataset or [v_min, v_max] "
+                f"with v_min < v_max, got {intensity_window}"
+            )
+        if validation not in ["full", "once", "off"]:
+            raise ValueError(f"validation must be full, once or off, got {validation}")
+        self.num_workers = num_workers
+        self.executor = executor
+        self.pipeline = pipeline
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.validation = validation
+        # (name, file index) of the files having validated values
+        self.validated_files: set = set()
+        self.intensity_window = intensity_window
+        # dataset_ranges[name] = (v_min, v_max) over all images of the loader
+        self.dataset_ranges: Dict[str, Tuple[float, float]] = dict()
         self.loader_moving_image = None
         self.loader_fixed_image = None
         self.loader_moving_label = None
         self.loader_fixed_label = None
+        # pool of decoding workers, created once and reused across epochs
+        self._executor: Optional[Executor] = None
+
+    @property
+    def shuffle_indices(self) -> bool:
+        """
+        Return if the dataset shuffles the sample indices before loading the files.
+        :return: true for the index pipeline
+        """
+        return self.pipeline == "index"
 
-    def get_dataset(self):
+    def get_dataset(self, shuffle_buffer_size: int = 0) -> tf.data.Dataset:
         """
         Return a dataset from the generator.
+
+        :param shuffle_buffer_size: buffer size to shuffle the sample indices,
+            only used by the index pipeline, 0 means no shuffle.
+        :return: dataset of samples.
         """
+        if self.pipeline == "index":
+            return self.get_index_dataset(shuffle_buffer_size=shuffle_buffer_size)
         if self.labeled:
+            # stacked labels have an extra axis for label channels
+            label_shape = [None] * (4 if self.sample_label == "stack" else 3)
             return tf.data.Dataset.from_generator(
                 generator=self.data_generator,
                 output_types=dict(
@@ -283,8 +607,8 @@ class GeneratorDataLoader(DataLoader, ABC):
                 output_shapes=dict(
                     moving_image=tf.TensorShape([None, None, None]),
                     fixed_image=tf.TensorShape([None, None, None]),
-                    moving_label=tf.TensorShape([None, None, None]),
-                    fixed_label=tf.TensorShape([None, None, None]),
+                    moving_label=tf.TensorShape(label_shape),
+                    fixed_label=tf.TensorShape(label_shape),
                     indices=self.num_indices,
                 ),
             )
@@ -300,34 +624,302 @@ class GeneratorDataLoader(DataLoader, ABC):
             ),
         )
 
+    def get_index_dataset(self, shuffle_buffer_size: int = 0) -> tf.data.Dataset:
+        """
+        Return a dataset generating sample indices and loading files in parallel.
+
+        Shuffling and sharding are therefore applied on indices,
+        and files are decoded in a parallel map outside of the Python generator.
+        The indices of image pairs are shuffled, so that samples of different labels
+        sharing the same images stay consecutive.
+
+        :param shuffle_buffer_size: buffer size to shuffle the indices of image pairs,
+            0 means no shuffle.
+        :return: a dataset having the same elements as the generator pipeline,
+            in the same order if not shuffled.
+        """
+        dataset = tf.data.Dataset.from_generator(
+            generator=self.index_generator,
+            output_types=dict(
+                moving_index=tf.int64, fixed_index=tf.int64, image_indices=tf.int64
+            ),
+            output_shapes=dict(
+                moving_index=tf.TensorShape([None]),
+                fixed_index=tf.TensorShape([None]),
+                image_indices=tf.TensorShape([None]),
+            ),
+        )
+        if self.num_shards > 1:
+            dataset = dataset.shard(num_shards=self.num_shards, index=self.shard_index)
+        if shuffle_buffer_size > 0:
+            dataset = dataset.shuffle(
+                buffer_size=shuffle_buffer_size, reshuffle_each_iteration=True
+            )
+
+        dataset = dataset.map(
+            self.load_samples_tf,
+            num_parallel_calls=self.num_workers
+            if self.num_workers > 0
+            else tf.data.experimental.AUTOTUNE,
+        )
+
+        def split_samples(samples: dict) -> tf.data.Dataset:
+            """
+            Split the samples of different labels sharing the same images.
+
+            :param samples: dict of images and stacked labels and indices.
+            :return: a dataset of samples.
+            """
+            images = dict(
+                moving_image=samples.pop("moving_image"),
+                fixed_image=samples.pop("fixed_image"),
+            )
+            return tf.data.Dataset.from_tensor_slices(samples).map(
+                lambda sample: dict(**images, **sample)
+            )
+
+        return dataset.flat_map(split_samples)
+
+    def index_generator(self):
+        """
+        Yield the indices of samples as integer arrays, used by the index pipeline.
+
+        Indices of grouped data are tuples and therefore
+        converted into arrays of length two.
+        """
+        for moving_index, fixed_index, image_indices in self.sample_index_generator():
+            yield dict(
+                moving_index=np.asarray(moving_index, dtype=np.int64).reshape(-1),
+                fixed_index=np.asarray(fixed_index, dtype=np.int64).reshape(-1),
+                image_indices=np.asarray(image_indices, dtype=np.int64),
+            )
+
+    def load_samples(
+        self,
+        moving_index: np.ndarray,
+        fixed_index: np.ndarray,
+        image_indices: np.ndarray,
+    ) -> tuple:
+        """
+        Load the samples of one image pair, used by the index pipeline.
+
+        As one pair may correspond to multiple samples of different labels,
+        the labels and indices are stacked along the first axis.
+
+        :param moving_index: index of moving image, of shape (1,) or (2,) if grouped.
+        :param fixed_index: index of fixed image, of shape (1,) or (2,) if grouped.
+        :param image_indices: indices identifying the image pair.
+        :return: (moving_image, fixed_image, indices) if unlabeled, otherwise
+            (moving_image, fixed_image, indices, moving_label, fixed_label).
+        """
+
+        def to_file_index(index: np.ndarray) -> Union[int, Tuple[int, ...]]:
+            index = [int(x) for x in index]
+            return index[0] if len(index) == 1 else tuple(index)
+
+        images = self.load_images(
+            moving_index=to_file_index(moving_index),
+            fixed_index=to_file_index(fixed_index),
+        )
+        samples = list(
+            self.sample_image_label(
+                *images, image_indices=[int(x) for x in image_indices]
+            )
+        )
+        outputs = [
+            np.asarray(images[0], dtype=np.float32),
+            np.asarray(images[1], dtype=np.float32),
+            np.stack([x["indices"] for x in samples]),
+        ]
+        if self.labeled:
+            outputs += [
+                np.stack([x[key] for x in samples]).astype(np.float32)
+                for key in ["moving_label", "fixed_label"]
+            ]
+        return tuple(outputs)
+
+    def load_samples_tf(self, indices: dict) -> dict:
+        """
+        Wrap load_samples in a TensorFlow operation.
+
+        :param indices: dict of moving_index, fixed_index and image_indices.
+        :return: dict of images, and stacked labels and indices.
+        """
+        keys = ["moving_image", "fixed_image", "indices"]
+        if self.labeled:
+            keys += ["moving_label", "fixed_label"]
+        outputs = tf.numpy_function(
+            self.load_samples,
+            [indices["moving_index"], indices["fixed_index"], indices["image_indices"]],
+            [tf.float32] * len(keys),
+        )
+        # stacked labels have an extra axis for label channels
+        label_shape = [None] * (5 if self.sample_label == "stack" else 4)
+        shapes = dict(
+            moving_image=[None, None, None],
+            fixed_image=[None, None, None],
+            indices=[None, self.num_indices],
+            moving_label=label_shape,
+            fixed_label=label_shape,
+        )
+        samples = dict()
+        for key, output in zip(keys, outputs):
+            output.set_shape(shapes[key])
+            samples[key] = output
+        return samples
+
     def data_generator(self):
         """
         Yield samples of data to feed model.
+
+        If num_workers > 0, the data are decoded by a pool of workers
+        while the samples are still yielded in the order of
+        sample_index_generator, so that the outputs are deterministic.
         """
-        for (moving_index, fixed_index, image_indices) in self.sample_index_generator():
-            moving_image = self.loader_moving_image.get_data(index=moving_index)
-            moving_image = normalize_array(moving_image)
-            fixed_image = self.loader_fixed_image.get_data(index=fixed_index)
-            fixed_image = normalize_array(fixed_image)
-            moving_label = (
-                self.loader_moving_label.get_data(index=moving_index)
-                if self.labeled
-                else None
+        if self.num_workers == 0:
+            for sample_indices in self.sample_index_generator():
+                moving_index, fixed_index, image_indices = sample_indices
+                images = self.load_images(
+                    moving_index=moving_index, fixed_index=fixed_index
+                )
+                yield from self.sample_image_label(*images, image_indices=image_indices)
+            return
+
+        executor = self.get_executor()
+        load_fn = (
+            self.load_images if self.executor == "thread" else _load_images_in_worker
+        )
+        # keep a bounded number of pending samples to limit the memory usage
+        pending: deque = deque()
+        max_num_pending = 2 * self.num_workers
+        for sample_indices in self.sample_index_generator():
+            moving_index, fixed_index, image_indices = sample_indices
+            pending.append(
+                (executor.submit(load_fn, moving_index, fixed_index), image_indices)
             )
-            fixed_label = (
-                self.loader_fixed_label.get_data(index=fixed_index)
-                if self.labeled
-                else None
+            if len(pending) >= max_num_pending:
+                future, pending_indices = pending.popleft()
+                yield from self.sample_image_label(
+                    *future.result(), image_indices=pending_indices
+                )
+        while pending:
+            future, pending_indices = pending.popleft()
+            yield from self.sample_image_label(
+                *future.result(), image_indices=pending_indices
             )
 
-            for sample in self.sample_image_label(
-                moving_image=moving_image,
-                fixed_image=fixed_image,
-                moving_label=moving_label,
-                fixed_label=fixed_label,
-                image_indices=image_indices,
+    def get_executor(self) -> Executor:
+        """
+        Return the pool of workers decoding the data.
+
+        The pool is created at the first call and reused by the following epochs,
+        so that the caches of the workers are kept. Worker processes are spawned
+        instead of forked, as forking a process running TensorFlow threads
+        may deadlock, they receive a pickled copy of the data loader.
+
+        :return: a thread or process pool executor.
+        """
+        if self._executor is not None:
+            return self._executor
+        if self.executor == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=self.num_workers)
+            return self._executor
+        # compute the statistics before spawning to avoid computing them per worker
+        self.get_image_range(name="moving_image", index=None)
+        self.get_image_range(name="fixed_image", index=None)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_set_worker_data_loader,
+            initargs=(self,),
+        )
+        return self._executor
+
+    def __getstate__(self) -> dict:
+        """
+        Return the state to pickle, used when starting worker processes.
+
+        :return: state without the pool of workers.
+        """
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def close(self):
+        """
+        Shut down the pool of decoding workers if it has been created.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def load_images(
+        self,
+        moving_index: Union[int, Tuple[int, ...]],
+        fixed_index: Union[int, Tuple[int, ...]],
+    ) -> tuple:
+        """
+        Load the images and labels of one sample, images are normalized.
+
+        :param moving_index: index of the moving image and label.
+        :param fixed_index: index of the fixed image and label.
+        :return: (moving_image, fixed_image, moving_label, fixed_label),
+            labels are None if the data is not labeled.
+        """
+        moving_image = self.loader_moving_image.get_data(index=moving_index)
+        moving_image = normalize_array(
+            moving_image, *self.get_image_range(name="moving_image", index=moving_index)
+        )
+        fixed_image = self.loader_fixed_image.get_data(index=fixed_index)
+        fixed_image = normalize_array(
+            fixed_image, *self.get_image_range(name="fixed_image", index=fixed_index)
+        )
+        moving_label = (
+            self.loader_moving_label.get_data(index=moving_index)
+            if self.labeled
+            else None
+        )
+        fixed_label = (
+            self.loader_fixed_label.get_data(index=fixed_index)
+            if self.labeled
+            else None
+        )
+        if self.validation == "once":
+            for arr, name, index in zip(
+                [moving_image, fixed_image, moving_label, fixed_label],
+                ["moving_image", "fixed_image", "moving_label", "fixed_label"],
+                [moving_index, fixed_index, moving_index, fixed_index],
             ):
-                yield sample
+                if arr is None or (name, index) in self.validated_files:
+                    continue
+                self.validate_value_range(arr=arr, name=name, prefix=f"File {index}")
+                self.validated_files.add((name, index))
+        return moving_image, fixed_image, moving_label, fixed_label
+
+    def get_image_range(
+        self, name: str, index: Optional[Union[int, Tuple[int, ...]]]
+    ) -> Tuple[Optional[float], Optional[float]]:
+        """
+        Return the intensity window used to normalize an image.
+
+        :param name: moving_image or fixed_image.
+        :param index: index of the image, used if the window is per image.
+        :return: (v_min, v_max), values are None if they have to be
+            computed from the image.
+        """
+        if self.intensity_window is None:
+            if index is None:
+                return None, None
+            loader = getattr(self, f"loader_{name}")
+            data_range = loader.get_data_range(index=index)
+            return (None, None) if data_range is None else data_range
+        if self.intensity_window == "dataset":
+            if name not in self.dataset_ranges:
+                loader = getattr(self, f"loader_{name}")
+                self.dataset_ranges[name] = loader.get_dataset_range()
+            return self.dataset_ranges[name]
+        v_min, v_max = self.intensity_window
+        return v_min, v_max
 
     def sample_index_generator(self):
         """
@@ -336,6 +928,34 @@ class GeneratorDataLoader(DataLoader, ABC):
         """
         raise NotImplementedError
 
+    @staticmethod
+    def validate_value_range(arr: np.ndarray, name: str, prefix: str):
+        """
+        Check the values of an image or label are between [0, 1].
+
+        :param arr: image or label array.
+        :param name: name of the array, e.g. moving_image.
+        :param prefix: identifier of the sample or file, used in the error message.
+        """
+        v_min, v_max = get_min_max(arr)
+        if v_min < 0 or v_max > 1:
+            raise ValueError(
+                f"{prefix}'s {name}'s values are not between [0, 1]. "
+                f"Its minimum value is {v_min} "
+                f"and its maximum value is {v_max}.\n"
+                f"The images are automatically normalized on image level: "
+                f"x = (x - min(x) + EPS) / (max(x) - min(x) + EPS). \n"
+                f"Labels are assumed to have values between [0,1] "
+                f"and they are not normalised. "
+                f"This is to prevent accidental use of other encoding methods "
+                f"other than one-hot to represent multiple class labels.\n"
+                f"If the label values are intended to represent multiple labels, "
+                f"convert them to one hot / binary masks in multiple channels, "
+                f"with each channel representing one label only.\n"
+                f"Please read the dataset requirements section "
+                f"in docs/doc_data_loader.md for more detailed information."
+            )
+
     @staticmethod
     def validate_images_and_labels(
         moving_image: np.ndarray,
@@ -343,6 +963,7 @@ class GeneratorDataLoader(DataLoader, ABC):
         moving_label: Optional[np.ndarray],
         fixed_label: Optional[np.ndarray],
         image_indices: list,
+        check_range: bool = True,
     ):
         """
         Check file names match according to naming convention.
@@ -354,6 +975,7 @@ class GeneratorDataLoader(DataLoader, ABC):
         :param fixed_label: np.ndarray of shape (f_dim1, f_dim2, f_dim3)
             or (f_dim1, f_dim2, f_dim3, num_labels)
         :param image_indices: list
+        :param check_range: whether to check the values are between [0, 1].
         """
         # images should never be None, and labels should all be non-None or None
         if moving_image is None or fixed_image is None:
@@ -367,25 +989,11 @@ class GeneratorDataLoader(DataLoader, ABC):
             [moving_image, fixed_image, moving_label, fixed_label],
             ["moving_image", "fixed_image", "moving_label", "fixed_label"],
         ):
-            if arr is None:
+            if arr is None or not check_range:
                 continue
-            if np.min(arr) < 0 or np.max(arr) > 1:
-                raise ValueError(
-                    f"Sample {image_indices}'s {name}'s values are not between [0, 1]. "
-                    f"Its minimum value is {np.min(arr)} "
-                    f"and its maximum value is {np.max(arr)}.\n"
-                    f"The images are automatically normalized on image level: "
-                    f"x = (x - min(x) + EPS) / (max(x) - min(x) + EPS). \n"
-                    f"Labels are assumed to have values between [0,1] "
-                    f"and they are not normalised. "
-                    f"This is to prevent accidental use of other encoding methods "
-                    f"other than one-hot to represent multiple class labels.\n"
-                    f"If the label values are intended to represent multiple labels, "
-                    f"convert them to one hot / binary masks in multiple channels, "
-                    f"with each channel representing one label only.\n"
-                    f"Please read the dataset requirements section "
-                    f"in docs/doc_data_loader.md for more detailed information."
-                )
+            GeneratorDataLoader.validate_value_range(
+                arr=arr, name=name, prefix=f"Sample {image_indices}"
+            )
         # images should be 3D arrays
         for arr, name in zip(
             [moving_image, fixed_image], ["moving_image", "fixed_image"]
@@ -446,15 +1054,25 @@ class GeneratorDataLoader(DataLoader, ABC):
         """
         Sample the image labels, only used in data_generator.
 
+        If sample_label is "stack", one sample is yielded with all label channels,
+        of shape (dim1, dim2, dim3, num_labels), and its label index is 0.
+        Otherwise, one sample is yielded per sampled label.
+
         :param moving_image:
         :param fixed_image:
         :param moving_label:
         :param fixed_label:
         :param image_indices:
         """
-        self.validate_images_and_labels(
-            moving_image, fixed_image, moving_label, fixed_label, image_indices
-        )
+        if self.validation != "off":
+            self.validate_images_and_labels(
+                moving_image,
+                fixed_image,
+                moving_label,
+                fixed_label,
+                image_indices,
+                check_range=self.validation == "full",
+            )
         # unlabeled
         if moving_label is None or fixed_label is None:
             label_index = -1  # means no label
@@ -462,6 +1080,19 @@ class GeneratorDataLoader(DataLoader, ABC):
             yield dict(
                 moving_image=moving_image, fixed_image=fixed_image, indices=indices
             )
+        elif self.sample_label == "stack":
+            # all label channels are kept in one sample
+            if len(moving_label.shape) == 3:
+                moving_label = moving_label[..., None]
+                fixed_label = fixed_label[..., None]
+            indices = np.asarray(image_indices + [0], dtype=np.float32)
+            yield dict(
+                moving_image=moving_image,
+                fixed_image=fixed_image,
+                moving_label=moving_label,
+                fixed_label=fixed_label,
+                indices=indices,
+            )
         else:
             # labeled
             if len(moving_label.shape) == 4:  # multiple labels
@@ -543,6 +1174,54 @@ class FileLoader:
         """
         raise NotImplementedError
 
+    def get_data_range(
+        self, index: Union[int, Tuple[int, ...]]
+    ) -> Optional[Tuple[float, float]]:
+        """
+        Return the precomputed min/max of one data array.
+
+        :param index: the data index, same as get_data.
+        :return: (min, max), None if the statistics are not precomputed.
+        """
+        return None
+
+    def get_data_file_path(self, data_index: int) -> Optional[str]:
+        """
+        Return the path of the file storing one data array.
+
+        :param data_index: index of the data, not grouped.
+        :return: path of the file, None if not available.
+        """
+        return None
+
+    def get_dataset_range(self) -> Tuple[float, float]:
+        """
+        Return the min/max over all data arrays.
+
+        Precomputed statistics are used if available,
+        otherwise all data arrays are loaded once.
+
+        :return: (min, max) of the data set.
+        """
+        if self.grouped:
+            indices: list = [
+                (group_index, in_group_index)
+                for group_index, num_images in enumerate(
+                    self.get_num_images_per_group()
+                )
+                for in_group_index in range(num_images)
+            ]
+        else:
+            indices = list(range(self.get_num_images()))
+        v_min, v_max = np.inf, -np.inf
+        for index in indices:
+            data_range = self.get_data_range(index=index)
+            if data_range is None:
+                data_range = get_min_max(self.get_data(index=index))
+            v_min = min(v_min, float(data_range[0]))
+            v_max = max(v_max, float(data_range[1]))
+        return v_min, v_max
+
     def get_data_ids(self) -> List:
         """
         Return the unique IDs of the data in this data set.
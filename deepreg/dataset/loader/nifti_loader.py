@@ -4,6 +4,7 @@ from typing import List, Tuple, Union
 import nibabel as nib
 import numpy as np
 
+from deepreg.dataset.loader.cache import VolumeCache
 from deepreg.dataset.loader.interface import FileLoader
 from deepreg.dataset.util import get_sorted_file_paths_in_dir_with_suffix
 from deepreg.registry import REGISTRY
@@ -27,15 +28,29 @@ def load_nifti_file(file_path: str) -> np.ndarray:
 class NiftiFileLoader(FileLoader):
     """Generalized loader for nifti files."""
 
-    def __init__(self, dir_paths: List[str], name: str, grouped: bool):
+    def __init__(
+        self,
+        dir_paths: List[str],
+        name: str,
+        grouped: bool,
+        cache_size_mb: float = 0,
+    ):
         """
         Init.
 
         :param dir_paths: path of directories having nifti files.
         :param name: name is used to identify the subdirectories.
         :param grouped: whether the data is grouped.
+        :param cache_size_mb: memory budget in megabytes for caching decoded
+            volumes, least recently used volumes are evicted first,
+            0 means no cache.
         """
         super().__init__(dir_paths=dir_paths, name=name, grouped=grouped)
+        self.cache = (
+            VolumeCache(max_bytes=int(cache_size_mb * 1024 ** 2))
+            if cache_size_mb > 0
+            else None
+        )
         self.data_path_splits = None
         self.set_data_structure()
         self.group_struct = None
@@ -133,24 +148,45 @@ class NiftiFileLoader(FileLoader):
                 f"index for NiftiFileLoader.get_data must be int, "
                 f"or tuple of length two, got {index}"
             )
-        # if not grouped:
-        #   path  = dir_path/name/file_name.suffix
-        #   split = (dir_path, file_name, suffix)
-        # else:
-        #   path  = dir_path/name/group_path/file_name.suffix
-        #   split = (dir_path, group_path, file_name, suffix)
-        path_splits = self.data_path_splits[data_index]  # type: ignore
-        path_splits, suffix = path_splits[:-1], path_splits[-1]
-        path_splits = path_splits[:1] + (self.name,) + path_splits[1:]
-        file_path = os.path.join(*path_splits) + "." + suffix
+        data_path_split = self.data_path_splits[data_index]  # type: ignore
+        file_path = self.get_data_file_path(data_index=data_index)
+
+        # the modification time is part of the key
+        # so that an updated file is not served from the cache
+        cache_key = None
+        if self.cache is not None:
+            cache_key = (data_path_split, os.path.getmtime(file_path))
+            arr = self.cache.get(cache_key)
+            if arr is not None:
+                return arr
 
         arr = load_nifti_file(file_path=file_path)
         if len(arr.shape) == 4 and arr.shape[3] == 1:
             # for labels, if there's only one label, remove the last dimension
             # currently have not encountered
             arr = arr[:, :, :, 0]  # pragma: no cover
+        if self.cache is not None:
+            self.cache.put(cache_key, arr)
         return arr
 
+    def get_data_file_path(self, data_index: int) -> str:
+        """
+        Return the path of the nifti file storing one data array.
+
+        :param data_index: index of the data, not grouped.
+        :return: path of the file.
+        """
+        # if not grouped:
+        #   path  = dir_path/name/file_name.suffix
+        #   split = (dir_path, file_name, suffix)
+        # else:
+        #   path  = dir_path/name/group_path/file_name.suffix
+        #   split = (dir_path, group_path, file_name, suffix)
+        data_path_split = self.data_path_splits[data_index]  # type: ignore
+        path_splits, suffix = data_path_split[:-1], data_path_split[-1]
+        path_splits = path_splits[:1] + (self.name,) + path_splits[1:]
+        return os.path.join(*path_splits) + "." + suffix
+
     def get_data_ids(self) -> List:
         """
         Return the unique IDs of the data in this data set
@@ -168,5 +204,6 @@ class NiftiFileLoader(FileLoader):
         return len(self.data_path_splits)  # type: ignore
 
     def close(self):
-        """Close opened files."""
-        return
+        """Close opened files and release cached volumes."""
+        if self.cache is not None:
+            self.cache.clear()
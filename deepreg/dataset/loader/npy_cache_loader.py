@@ -0,0 +1,351 @@
+"""
+Load data from decoded numpy arrays cached on disk.
+
+The arrays are converted once from another file format and then
+read using memory mapping, which avoids decompressing files at every epoch.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from typing import IO, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from deepreg.dataset.loader.interface import FileLoader
+from deepreg.registry import FILE_LOADER_CLASS, REGISTRY
+
+MANIFEST_FILE_NAME = "manifest.json"
+DATA_FILE_FORMAT = "{:06d}.npy"
+
+
+def get_cache_dir_path(dir_path: str, name: str, cache_dir: Optional[str]) -> str:
+    """
+    Return the directory storing the cached arrays of dir_path/name.
+
+    :param dir_path: path of the directory having the source data.
+    :param name: name of the data, e.g. fixed_images.
+    :param cache_dir: root directory of caches,
+        if None, the cache is stored under dir_path/.npy_cache.
+    :return: path of the cache directory.
+    """
+    if cache_dir is None:
+        return os.path.join(dir_path, ".npy_cache", name)
+    # a hash is used to avoid collisions between data directories
+    abs_dir_path = os.path.abspath(dir_path)
+    dir_hash = hashlib.md5(abs_dir_path.encode()).hexdigest()[:8]
+    dir_name = os.path.basename(os.path.normpath(abs_dir_path))
+    return os.path.join(os.path.expanduser(cache_dir), f"{dir_name}-{dir_hash}", name)
+
+
+def get_source_stat(file_path: Optional[str]) -> dict:
+    """
+    Return the modification time and size of a source file.
+
+    :param file_path: path of the source file, None if not available.
+    :return: dict of mtime_ns and size, having None values if file_path is None.
+    """
+    if file_path is None:
+        return dict(mtime_ns=None, size=None)
+    stat = os.stat(file_path)
+    return dict(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+
+
+def write_file_atomically(file_path: str, write_fn: Callable[[IO], None], mode: str):
+    """
+    Write a file through a unique temporary file renamed at the end.
+
+    The temporary file is in the same directory, so that the renaming is atomic,
+    and its name is unique, so that concurrent writers of the same file
+    do not overwrite each other's partial outputs.
+
+    :param file_path: path of the file to write.
+    :param write_fn: function writing the content into an opened file.
+    :param mode: mode to open the file, "w" or "wb".
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path),
+        prefix=os.path.basename(file_path) + ".",
+        suffix=".tmp",
+    )
+    try:
+        # mkstemp creates files readable by the owner only
+        os.chmod(tmp_path, 0o644)
+        with os.fdopen(fd, mode) as file:
+            write_fn(file)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@REGISTRY.register_file_loader(name="npy_cache")
+class NpyCacheFileLoader(FileLoader):
+    """
+    Loader reading memory-mapped numpy arrays converted from another format.
+
+    At initialization, the data of the source file loader are converted
+    into uncompressed .npy files if the cache is missing or outdated.
+    A manifest records the data ids, shapes and intensity ranges,
+    as well as the modification times and sizes of the source files.
+    The data structure of the source file loader is kept unchanged.
+    """
+
+    def __init__(
+        self,
+        dir_paths: List[str],
+        name: str,
+        grouped: bool,
+        source: Union[str, dict] = "nifti",
+        cache_dir: Optional[str] = None,
+    ):
+        """
+        Init.
+
+        :param dir_paths: path of directories having the source data.
+        :param name: name is used to identify the data.
+        :param grouped: whether the data is grouped.
+        :param source: format of the source data, a file loader name
+            or a dict having the name and extra arguments of the file loader.
+        :param cache_dir: root directory of caches,
+            if None, the cache is stored in each data directory under .npy_cache.
+        """
+        super().__init__(dir_paths=dir_paths, name=name, grouped=grouped)
+        if isinstance(source, str):
+            source = dict(name=source)
+        source = source.copy()
+        source_name = source.pop("name")
+        if source_name == "npy_cache":
+            raise ValueError("The source of npy_cache can not be npy_cache.")
+        self.source_name = source_name
+        self.cache_dir = cache_dir
+        source_loader: FileLoader = REGISTRY.get(
+            category=FILE_LOADER_CLASS, key=source_name
+        )(dir_paths=dir_paths, name=name, grouped=grouped, **source)
+
+        self.data_path_splits = source_loader.data_path_splits  # type: ignore
+        self.group_struct = source_loader.group_struct  # type: ignore
+        self.data_ids = source_loader.get_data_ids()
+        # data_file_paths[data_index] = path of the .npy file
+        self.data_file_paths: List[str] = []
+        # manifest[data_index] = dict of data id, file name, shape, min, max
+        # and the modification time and size of the source file
+        self.manifest: List[dict] = []
+        self.set_data_structure(source_loader=source_loader)
+        source_loader.close()
+
+    def set_data_structure(self, source_loader: Optional[FileLoader] = None):
+        """
+        Convert the source data into .npy files if necessary
+        and read the manifests of all directories.
+
+        :param source_loader: file loader of the source data,
+            used to convert the data if the cache is missing or outdated.
+        """
+        # source_indices[data_index] = index for source_loader.get_data
+        source_indices: Dict[int, Union[int, Tuple[int, int]]] = {}
+        if self.grouped:
+            for group_index, data_indices in enumerate(self.group_struct):
+                for in_group_index, data_index in enumerate(data_indices):
+                    source_indices[data_index] = (group_index, in_group_index)
+        else:
+            source_indices = {i: i for i in range(len(self.data_path_splits))}
+
+        num_data = len(self.data_path_splits)
+        self.data_file_paths = [""] * num_data
+        self.manifest = [dict() for _ in range(num_data)]
+        for dir_path in self.dir_paths:
+            cache_dir_path = get_cache_dir_path(
+                dir_path=dir_path, name=self.name, cache_dir=self.cache_dir
+            )
+            data_indices = [
+                i
+                for i, split in enumerate(self.data_path_splits)
+                if split[0] == dir_path
+            ]
+            ids = [list(self.data_path_splits[i]) for i in data_indices]
+            # source files are only checked if the source loader is provided
+            source_stats = (
+                None
+                if source_loader is None
+                else [
+                    get_source_stat(source_loader.get_data_file_path(data_index=i))
+                    for i in data_indices
+                ]
+            )
+            manifest = self.read_manifest(cache_dir_path=cache_dir_path)
+            if (
+                manifest is None
+                or [x["id"] for x in manifest] != ids
+                or (
+                    source_stats is not None
+                    and [
+                        dict(mtime_ns=x.get("mtime_ns"), size=x.get("size"))
+                        for x in manifest
+                    ]
+                    != source_stats
+                )
+            ):
+                if source_loader is None:
+                    raise ValueError(
+                        f"Cache in {cache_dir_path} is missing or outdated "
+                        f"but the source data loader is not provided."
+                    )
+                manifest = self.write_cache(
+                    cache_dir_path=cache_dir_path,
+                    data_indices=data_indices,
+                    source_indices=[source_indices[i] for i in data_indices],
+                    source_stats=source_stats,  # type: ignore
+                    source_loader=source_loader,
+                )
+            # data_path_splits may be sorted across directories
+            for data_index, entry in zip(data_indices, manifest):
+                self.manifest[data_index] = entry
+                self.data_file_paths[data_index] = os.path.join(
+                    cache_dir_path, entry["file"]
+                )
+
+    @staticmethod
+    def read_manifest(cache_dir_path: str) -> Optional[List[dict]]:
+        """
+        Read the manifest of a cache directory.
+
+        :param cache_dir_path: path of the cache directory.
+        :return: list of entries, None if the manifest does not exist.
+        """
+        manifest_path = os.path.join(cache_dir_path, MANIFEST_FILE_NAME)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as file:
+            return json.load(file)["data"]
+
+    def write_cache(
+        self,
+        cache_dir_path: str,
+        data_indices: List[int],
+        source_indices: list,
+        source_stats: List[dict],
+        source_loader: FileLoader,
+    ) -> List[dict]:
+        """
+        Convert the source data into .npy files and write the manifest.
+
+        Files are first written to unique temporary paths and then renamed,
+        so that a partially written cache is never read.
+
+        :param cache_dir_path: path of the cache directory.
+        :param data_indices: indices of the data stored in this directory.
+        :param source_indices: corresponding indices for source_loader.get_data.
+        :param source_stats: modification times and sizes of the source files,
+            recorded before the conversion.
+        :param source_loader: file loader of the source data.
+        :return: list of manifest entries.
+        """
+        os.makedirs(cache_dir_path, exist_ok=True)
+        manifest = []
+        for data_index, source_index, source_stat in zip(
+            data_indices, source_indices, source_stats
+        ):
+            arr = np.asarray(
+                source_loader.get_data(index=source_index), dtype=np.float32
+            )
+            file_name = DATA_FILE_FORMAT.format(len(manifest))
+            file_path = os.path.join(cache_dir_path, file_name)
+            write_file_atomically(
+                file_path=file_path,
+                write_fn=lambda file: np.save(file, arr),
+                mode="wb",
+            )
+            manifest.append(
+                dict(
+                    id=list(self.data_path_splits[data_index]),
+                    file=file_name,
+                    shape=list(arr.shape),
+                    min=float(np.min(arr)),
+                    max=float(np.max(arr)),
+                    **source_stat,
+                )
+            )
+        manifest_path = os.path.join(cache_dir_path, MANIFEST_FILE_NAME)
+        write_file_atomically(
+            file_path=manifest_path,
+            write_fn=lambda file: json.dump(
+                dict(source=self.source_name, data=manifest), file, indent=2
+            ),
+            mode="w",
+        )
+        return manifest
+
+    def get_data_index(self, index: Union[int, Tuple[int, ...]]) -> int:
+        """
+        Convert the index into the data index.
+
+        :param index: the data index which is required
+
+          - for paired or unpaired, the index is one single int, data_index
+          - for grouped, the index is a tuple of two ints,
+            (group_index, in_group_data_index)
+        :return: data_index
+        """
+        if isinstance(index, int):  # paired or unpaired
+            assert not self.grouped
+            assert 0 <= index
+            return index
+        if isinstance(index, tuple):  # grouped
+            assert self.grouped
+            group_index, in_group_data_index = index
+            assert 0 <= group_index
+            assert 0 <= in_group_data_index
+            return self.group_struct[group_index][in_group_data_index]  # type: ignore
+        raise ValueError(
+            f"index for NpyCacheFileLoader.get_data must be int, "
+            f"or tuple of length two, got {index}"
+        )
+
+    def get_data(self, index: Union[int, Tuple[int, ...]]) -> np.ndarray:
+        """
+        Get one data array by specifying an index.
+
+        The returned array is a read-only memory map of the cached file.
+
+        :param index: the data index which is required
+
+          - for paired or unpaired, the index is one single int, data_index
+          - for grouped, the index is a tuple of two ints,
+            (group_index, in_group_data_index)
+        :returns arr: the data array at the specified index
+        """
+        data_index = self.get_data_index(index=index)
+        return np.load(self.data_file_paths[data_index], mmap_mode="r")
+
+    def get_data_range(
+        self, index: Union[int, Tuple[int, ...]]
+    ) -> Optional[Tuple[float, float]]:
+        """
+        Return the min/max of one data array recorded in the manifest.
+
+        :param index: the data index, same as get_data.
+        :return: (min, max) of the data array.
+        """
+        entry = self.manifest[self.get_data_index(index=index)]
+        return entry["min"], entry["max"]
+
+    def get_data_ids(self) -> List:
+        """
+        Return the unique IDs of the data in this data set,
+        which are the same as the source file loader.
+
+        :return: list of data ids
+        """
+        return self.data_ids
+
+    def get_num_images(self) -> int:
+        """
+        :return: int, number of images in this data set
+        """
+        return len(self.data_path_splits)  # type: ignore
+
+    def close(self):
+        """Close opened files."""
+        return
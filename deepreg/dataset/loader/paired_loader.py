@@ -31,6 +31,7 @@ class PairedDataLoader(AbstractPairedDataLoader, GeneratorDataLoader):
         seed,
         moving_image_shape: Union[Tuple[int, ...], List[int]],
         fixed_image_shape: Union[Tuple[int, ...], List[int]],
+        **kwargs,
     ):
         """
         :param file_loader:
@@ -43,6 +44,7 @@ class PairedDataLoader(AbstractPairedDataLoader, GeneratorDataLoader):
         :param seed:
         :param moving_image_shape: (width, height, depth)
         :param fixed_image_shape: (width, height, depth)
+        :param kwargs: additional arguments.
         """
         super().__init__(
             moving_image_shape=moving_image_shape,
@@ -50,6 +52,7 @@ class PairedDataLoader(AbstractPairedDataLoader, GeneratorDataLoader):
             labeled=labeled,
             sample_label=sample_label,
             seed=seed,
+            **kwargs,
         )
         assert isinstance(
             data_dir_paths, list
@@ -110,6 +113,7 @@ class PairedDataLoader(AbstractPairedDataLoader, GeneratorDataLoader):
             yield image_index, image_index, [image_index]
 
     def close(self):
+        super().close()
         self.loader_moving_image.close()
         self.loader_fixed_image.close()
         if self.labeled:
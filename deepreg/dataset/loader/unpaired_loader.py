@@ -31,6 +31,7 @@ class UnpairedDataLoader(AbstractUnpairedDataLoader, GeneratorDataLoader):
         sample_label: str,
         seed: int,
         image_shape: Union[Tuple[int, ...], List[int]],
+        **kwargs,
     ):
         """
         Load data which are unpaired, labeled or unlabeled.
@@ -42,12 +43,14 @@ class UnpairedDataLoader(AbstractUnpairedDataLoader, GeneratorDataLoader):
         :param sample_label:
         :param seed:
         :param image_shape: (width, height, depth)
+        :param kwargs: additional arguments.
         """
         super().__init__(
             image_shape=image_shape,
             labeled=labeled,
             sample_label=sample_label,
             seed=seed,
+            **kwargs,
         )
         assert isinstance(
             data_dir_paths, list
@@ -101,6 +104,7 @@ class UnpairedDataLoader(AbstractUnpairedDataLoader, GeneratorDataLoader):
         """
         Close the moving files opened by the file_loaders.
         """
+        super().close()
         self.loader_moving_image.close()
         if self.labeled:
             self.loader_moving_label.close()
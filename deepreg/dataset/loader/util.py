@@ -1,9 +1,35 @@
-from typing import List, Union
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 
+# number of elements per block in get_min_max, a block of float32 fits in L2 cache
+MIN_MAX_BLOCK_SIZE = 2 ** 16
 
-def normalize_array(arr: np.ndarray, v_min=None, v_max=None) -> np.ndarray:
+
+def get_min_max(arr: np.ndarray) -> Tuple[float, float]:
+    """
+    Compute the minimum and maximum of an array in a single pass over memory.
+
+    The array is reduced block by block, so that each block is
+    still cached when its maximum is computed after its minimum.
+
+    :param arr: non-empty array.
+    :return: (min, max) of the array.
+    """
+    flat = np.ravel(arr)
+    if flat.size <= MIN_MAX_BLOCK_SIZE:
+        return flat.min(), flat.max()
+    v_min, v_max = flat[0], flat[0]
+    for start in range(0, flat.size, MIN_MAX_BLOCK_SIZE):
+        block = flat[start : start + MIN_MAX_BLOCK_SIZE]
+        v_min = np.minimum(v_min, block.min())
+        v_max = np.maximum(v_max, block.max())
+    return v_min, v_max
+
+
+def normalize_array(
+    arr: np.ndarray, v_min=None, v_max=None, out: Optional[np.ndarray] = None
+) -> np.ndarray:
     """
     Normalize a numpy array.
 
@@ -12,19 +38,42 @@ def normalize_array(arr: np.ndarray, v_min=None, v_max=None) -> np.ndarray:
     If min/max are not provided, will use the min/max of the array.
     Values outside of [v_min, v_max] will be clipped.
 
+    The normalization is computed block by block into the output buffer,
+    so that the input is read once and no intermediate array is allocated.
+    The input array is never modified unless it is passed as out.
+
     :param arr: array to be normalized
     :param v_min: minimum of the value before normalization.
     :param v_max: maximum of the value before normalization.
+    :param out: C-contiguous buffer of the same shape as arr to store the output,
+        if None, a new floating point array is allocated.
     :return: normalized array.
     """
-    v_min = np.min(arr) if v_min is None else v_min
-    v_max = np.max(arr) if v_max is None else v_max
+    if v_min is None or v_max is None:
+        arr_min, arr_max = get_min_max(arr)
+        v_min = arr_min if v_min is None else v_min
+        v_max = arr_max if v_max is None else v_max
+    if out is None:
+        out = np.empty(arr.shape, dtype=np.result_type(arr.dtype, np.float32))
+    elif out.shape != arr.shape or not out.flags.c_contiguous:
+        raise ValueError(
+            f"out must be C-contiguous and of shape {arr.shape}, "
+            f"got an array of shape {out.shape}"
+        )
     if v_min == v_max:
-        return arr * 0
+        out[...] = 0
+        return out
     assert v_min < v_max
-    arr = np.clip(a=arr, a_min=v_min, a_max=v_max)
-    arr = (arr - v_min) / (v_max - v_min)
-    return arr
+    scale = 1.0 / (v_max - v_min)
+    flat_arr = np.ravel(arr)
+    flat_out = out.reshape(-1)
+    for start in range(0, flat_arr.size, MIN_MAX_BLOCK_SIZE):
+        end = start + MIN_MAX_BLOCK_SIZE
+        block = flat_out[start:end]
+        np.subtract(flat_arr[start:end], v_min, out=block)
+        np.multiply(block, scale, out=block)
+        np.clip(block, 0, 1, out=block)
+    return out
 
 
 def remove_prefix_suffix(
@@ -9,10 +9,17 @@ from typing import Dict, List, Optional, Tuple, Union
 import numpy as np
 import tensorflow as tf
 
-from deepreg.model.layer import Resize3d
-from deepreg.model.layer_util import get_reference_grid, resample, warp_grid
+from deepreg.model.layer_util import get_reference_grid, resample, resize3d, warp_grid
 from deepreg.registry import REGISTRY
 
+# four corners C G D A of a cube centered at (0, 0, 0) in homogeneous coordinates,
+# used to generate random affine transformations, see gen_rand_affine_transform
+AFFINE_CORNERS = np.array(
+    [[-1, -1, -1, 1], [-1, -1, 1, 1], [-1, 1, -1, 1], [1, -1, -1, 1]],
+    dtype=np.float64,
+)
+AFFINE_CORNERS_INV = np.linalg.inv(AFFINE_CORNERS)
+
 
 class RandomTransformation3D(tf.keras.layers.Layer):
     """
@@ -44,10 +51,18 @@ class RandomTransformation3D(tf.keras.layers.Layer):
         self.fixed_grid_ref = get_reference_grid(grid_size=fixed_image_size)
 
     @abstractmethod
-    def gen_transform_params(self) -> Tuple[tf.Tensor, tf.Tensor]:
+    def gen_transform_params(
+        self,
+        batch_size: Optional[Union[int, tf.Tensor]] = None,
+        seed: Optional[tf.Tensor] = None,
+    ) -> Tuple[tf.Tensor, tf.Tensor]:
         """
         Generates transformation parameters for moving and fixed image.
 
+        :param batch_size: number of samples in the batch, can be a scalar tensor,
+            if None, self.batch_size is used.
+        :param seed: shape = (2,), seed of the stateless random generators,
+            if None, a random seed is used.
         :return: two tensors
         """
 
@@ -65,7 +80,12 @@ class RandomTransformation3D(tf.keras.layers.Layer):
         :return: shape = (batch, dim1, dim2, dim3)
         """
 
-    def call(self, inputs: Dict[str, tf.Tensor], **kwargs) -> Dict[str, tf.Tensor]:
+    def call(
+        self,
+        inputs: Dict[str, tf.Tensor],
+        seed: Optional[tf.Tensor] = None,
+        **kwargs,
+    ) -> Dict[str, tf.Tensor]:
         """
         Creates random params for the input images and their labels,
         and params them based on the resampled reference grids.
@@ -80,6 +100,8 @@ class RandomTransformation3D(tf.keras.layers.Layer):
                 moving_image, shape = (batch, m_dim1, m_dim2, m_dim3)
                 fixed_image, shape = (batch, f_dim1, f_dim2, f_dim3)
                 indices, shape = (batch, num_indices)
+        :param seed: shape = (2,), seed of the stateless random generators,
+            the same seed gives the same transformation.
         :param kwargs: other arguments
         :return: dictionary with the same structure as inputs
         """
@@ -88,7 +110,11 @@ class RandomTransformation3D(tf.keras.layers.Layer):
         fixed_image = inputs["fixed_image"]
         indices = inputs["indices"]
 
-        moving_params, fixed_params = self.gen_transform_params()
+        # the batch may be smaller than self.batch_size, e.g. the last batch
+        batch_size = tf.shape(moving_image)[0]
+        moving_params, fixed_params = self.gen_transform_params(
+            batch_size=batch_size, seed=seed
+        )
 
         moving_image = self.transform(moving_image, self.moving_grid_ref, moving_params)
         fixed_image = self.transform(fixed_image, self.fixed_grid_ref, fixed_params)
@@ -158,17 +184,26 @@ class RandomAffineTransform3D(RandomTransformation3D):
         config["scale"] = self.scale
         return config
 
-    def gen_transform_params(self) -> Tuple[tf.Tensor, tf.Tensor]:
+    def gen_transform_params(
+        self,
+        batch_size: Optional[Union[int, tf.Tensor]] = None,
+        seed: Optional[tf.Tensor] = None,
+    ) -> Tuple[tf.Tensor, tf.Tensor]:
         """
         Function that generates the random 3D transformation parameters
         for a batch of data for moving and fixed image.
 
+        :param batch_size: number of samples in the batch,
+            if None, self.batch_size is used.
+        :param seed: shape = (2,), seed of the stateless random generator,
+            if None, a random seed is used.
         :return: a tuple of tensors, each has shape = (batch, 4, 3)
         """
-        theta = gen_rand_affine_transform(
-            batch_size=self.batch_size * 2, scale=self.scale
+        batch_size = self.batch_size if batch_size is None else batch_size
+        theta = gen_rand_affine_transform_tf(
+            batch_size=batch_size * 2, scale=self.scale, seed=split_seed(seed, 1)[0]
         )
-        return theta[: self.batch_size], theta[self.batch_size :]
+        return theta[:batch_size], theta[batch_size:]
 
     @staticmethod
     def transform(
@@ -238,24 +273,36 @@ class RandomDDFTransform3D(RandomTransformation3D):
         config["low_res_size"] = self.low_res_size
         return config
 
-    def gen_transform_params(self) -> Tuple[tf.Tensor, tf.Tensor]:
+    def gen_transform_params(
+        self,
+        batch_size: Optional[Union[int, tf.Tensor]] = None,
+        seed: Optional[tf.Tensor] = None,
+    ) -> Tuple[tf.Tensor, tf.Tensor]:
         """
         Generates two random ddf fields for moving and fixed images.
 
+        :param batch_size: number of samples in the batch,
+            if None, self.batch_size is used.
+        :param seed: shape = (2,), seed of the stateless random generators,
+            if None, a random seed is used.
         :return: tuple, one has shape = (batch, m_dim1, m_dim2, m_dim3, 3)
             another one has shape = (batch, f_dim1, f_dim2, f_dim3, 3)
         """
-        moving = gen_rand_ddf(
+        batch_size = self.batch_size if batch_size is None else batch_size
+        seeds = split_seed(seed, 2)
+        moving = gen_rand_ddf_tf(
             image_size=self.moving_image_size,
-            batch_size=self.batch_size,
+            batch_size=batch_size,
             field_strength=self.field_strength,
             low_res_size=self.low_res_size,
+            seed=seeds[0],
         )
-        fixed = gen_rand_ddf(
+        fixed = gen_rand_ddf_tf(
             image_size=self.fixed_image_size,
-            batch_size=self.batch_size,
+            batch_size=batch_size,
             field_strength=self.field_strength,
             low_res_size=self.low_res_size,
+            seed=seeds[1],
         )
         return moving, fixed
 
@@ -274,6 +321,122 @@ class RandomDDFTransform3D(RandomTransformation3D):
         return resample(vol=image, loc=grid_ref[None, ...] + params)
 
 
+@REGISTRY.register_data_augmentation(name="affine_ddf")
+class RandomAffineDDFTransform3D(RandomTransformation3D):
+    """
+    Apply random affine and DDF transformations to moving/fixed images separately.
+
+    It is equivalent to the affine augmentation followed by the DDF augmentation,
+    but the sampling grids are composed so that the images are resampled once,
+    which halves the cost and avoids interpolating the images twice.
+    """
+
+    def __init__(
+        self,
+        moving_image_size: Tuple[int, ...],
+        fixed_image_size: Tuple[int, ...],
+        batch_size: int,
+        scale: float = 0.1,
+        field_strength: int = 1,
+        low_res_size: tuple = (1, 1, 1),
+        name: str = "RandomAffineDDFTransform3D",
+        **kwargs,
+    ):
+        """
+        Init.
+
+        :param moving_image_size: (m_dim1, m_dim2, m_dim3)
+        :param fixed_image_size: (f_dim1, f_dim2, f_dim3)
+        :param batch_size: total number of samples consumed per step, over all devices.
+        :param scale: a positive float controlling the scale of affine transformation
+        :param field_strength: upper bound of the deformation field variance
+        :param low_res_size: size of the low resolution deformation field
+        :param name: name of the layer
+        :param kwargs: additional arguments
+        """
+        super().__init__(
+            moving_image_size=moving_image_size,
+            fixed_image_size=fixed_image_size,
+            batch_size=batch_size,
+            name=name,
+            **kwargs,
+        )
+
+        assert tuple(low_res_size) <= tuple(moving_image_size)
+        assert tuple(low_res_size) <= tuple(fixed_image_size)
+
+        self.scale = scale
+        self.field_strength = field_strength
+        self.low_res_size = low_res_size
+
+    def get_config(self) -> dict:
+        """Return the config dictionary for recreating this class."""
+        config = super().get_config()
+        config["scale"] = self.scale
+        config["field_strength"] = self.field_strength
+        config["low_res_size"] = self.low_res_size
+        return config
+
+    def gen_transform_params(
+        self,
+        batch_size: Optional[Union[int, tf.Tensor]] = None,
+        seed: Optional[tf.Tensor] = None,
+    ) -> Tuple[tf.Tensor, tf.Tensor]:
+        """
+        Generates random affine parameters and DDFs for moving and fixed images.
+
+        :param batch_size: number of samples in the batch,
+            if None, self.batch_size is used.
+        :param seed: shape = (2,), seed of the stateless random generators,
+            if None, a random seed is used.
+        :return: tuple, each element is a tuple of affine parameters,
+            shape = (batch, 4, 3), and a DDF, shape = (batch, dim1, dim2, dim3, 3)
+        """
+        batch_size = self.batch_size if batch_size is None else batch_size
+        seeds = split_seed(seed, 3)
+        theta = gen_rand_affine_transform_tf(
+            batch_size=batch_size * 2, scale=self.scale, seed=seeds[0]
+        )
+        moving_ddf = gen_rand_ddf_tf(
+            image_size=self.moving_image_size,
+            batch_size=batch_size,
+            field_strength=self.field_strength,
+            low_res_size=self.low_res_size,
+            seed=seeds[1],
+        )
+        fixed_ddf = gen_rand_ddf_tf(
+            image_size=self.fixed_image_size,
+            batch_size=batch_size,
+            field_strength=self.field_strength,
+            low_res_size=self.low_res_size,
+            seed=seeds[2],
+        )
+        return (theta[:batch_size], moving_ddf), (theta[batch_size:], fixed_ddf)
+
+    @staticmethod
+    def transform(
+        image: tf.Tensor, grid_ref: tf.Tensor, params: tf.Tensor
+    ) -> tf.Tensor:
+        """
+        Transforms the reference grid with the DDF then the affine transformation,
+        and resample the image once.
+
+        :param image: shape = (batch, dim1, dim2, dim3)
+        :param grid_ref: shape = (dim1, dim2, dim3, 3)
+        :param params: tuple of affine parameters, shape = (batch, 4, 3),
+            and DDF, shape = (batch, dim1, dim2, dim3, 3)
+        :return: shape = (batch, dim1, dim2, dim3)
+        """
+        theta, ddf = params
+        # grid deformed by DDF, shape = (batch, dim1, dim2, dim3, 3)
+        grid = grid_ref[None, ...] + ddf
+        # grid_padded[b,i,j,k,:] = [i j k 1], shape = (batch, dim1, dim2, dim3, 4)
+        grid_padded = tf.concat([grid, tf.ones_like(grid[..., :1])], axis=4)
+        # grid_warped[b,i,j,k,p] = sum_over_q (grid_padded[b,i,j,k,q] * theta[b,q,p])
+        loc = tf.einsum("bijkq,bqp->bijkp", grid_padded, theta)
+        return resample(vol=image, loc=loc)
+
+
 def resize_inputs(
     inputs: Dict[str, tf.Tensor],
     moving_image_size: Tuple[int, ...],
@@ -285,8 +448,8 @@ def resize_inputs(
         if labeled:
             moving_image, shape = (None, None, None)
             fixed_image, shape = (None, None, None)
-            moving_label, shape = (None, None, None)
-            fixed_label, shape = (None, None, None)
+            moving_label, shape = (None, None, None) or (None, None, None, None)
+            fixed_label, shape = (None, None, None) or (None, None, None, None)
             indices, shape = (num_indices, )
         else, unlabeled:
             moving_image, shape = (None, None, None)
@@ -299,7 +462,9 @@ def resize_inputs(
             moving_image, shape = (m_dim1, m_dim2, m_dim3)
             fixed_image, shape = (f_dim1, f_dim2, f_dim3)
             moving_label, shape = (m_dim1, m_dim2, m_dim3)
+                or (m_dim1, m_dim2, m_dim3, L) if labels are stacked
             fixed_label, shape = (f_dim1, f_dim2, f_dim3)
+                or (f_dim1, f_dim2, f_dim3, L) if labels are stacked
             indices, shape = (num_indices, )
         else, unlabeled:
             moving_image, shape = (m_dim1, m_dim2, m_dim3)
@@ -310,19 +475,26 @@ def resize_inputs(
     fixed_image = inputs["fixed_image"]
     indices = inputs["indices"]
 
-    moving_resize_layer = Resize3d(shape=moving_image_size)
-    fixed_resize_layer = Resize3d(shape=fixed_image_size)
-
-    moving_image = moving_resize_layer(moving_image)
-    fixed_image = fixed_resize_layer(fixed_image)
+    moving_image = resize3d(image=moving_image, shape=moving_image_size)
+    fixed_image = resize3d(image=fixed_image, shape=fixed_image_size)
 
     if "moving_label" not in inputs:  # unlabeled
         return dict(moving_image=moving_image, fixed_image=fixed_image, indices=indices)
     moving_label = inputs["moving_label"]
     fixed_label = inputs["fixed_label"]
 
-    moving_label = moving_resize_layer(moving_label)
-    fixed_label = fixed_resize_layer(fixed_label)
+    if len(moving_label.shape) == 4:
+        # stacked labels of shape (dim1, dim2, dim3, num_labels)
+        # are resized as a batch of one multi-channel volume
+        moving_label = resize3d(image=moving_label[None, ...], shape=moving_image_size)[
+            0, ...
+        ]
+        fixed_label = resize3d(image=fixed_label[None, ...], shape=fixed_image_size)[
+            0, ...
+        ]
+    else:
+        moving_label = resize3d(image=moving_label, shape=moving_image_size)
+        fixed_label = resize3d(image=fixed_label, shape=fixed_image_size)
 
     return dict(
         moving_image=moving_image,
@@ -333,6 +505,91 @@ def resize_inputs(
     )
 
 
+def sample_patch(
+    inputs: Dict[str, tf.Tensor],
+    patch_size: Tuple[int, ...],
+    seed: tf.Tensor,
+    foreground: bool = False,
+) -> Dict[str, tf.Tensor]:
+    """
+    Crop images and labels of one sample at the same random patch.
+
+    Moving and fixed images must have the same shape.
+    The start coordinates of the patch are inserted in indices
+    before the label index, so that the patch can be traced back.
+
+    :param inputs: a sample, having
+        moving_image, shape = (dim1, dim2, dim3)
+        fixed_image, shape = (dim1, dim2, dim3)
+        moving_label, shape = (dim1, dim2, dim3) or (dim1, dim2, dim3, L), optional
+        fixed_label, shape = (dim1, dim2, dim3) or (dim1, dim2, dim3, L), optional
+        indices, shape = (num_indices, )
+    :param patch_size: (p_dim1, p_dim2, p_dim3), not larger than the images.
+    :param seed: shape = (2,), seed of stateless random generators.
+    :param foreground: if true, the patch is centered at a random voxel of the
+        fixed label foreground, i.e. patches are sampled proportionally to
+        their foreground volume. A random patch is sampled if the label is empty.
+    :return: a sample of the same keys, images and labels are of
+        shape = (p_dim1, p_dim2, p_dim3) or (p_dim1, p_dim2, p_dim3, L)
+        and indices of shape = (num_indices + 3, )
+    """
+    patch_shape = tuple(patch_size)
+    patch_size = tf.constant(patch_shape, dtype=tf.int32)
+    image_size = tf.shape(inputs["fixed_image"])[:3]
+    max_start = image_size - patch_size
+    start_seed, fg_seed = tf.unstack(split_seed(seed=seed, num=2))
+
+    # uniform start coordinates in [0, max_start]
+    uniform = tf.random.stateless_uniform(shape=(3,), seed=start_seed)
+    start = tf.cast(
+        tf.math.floor(uniform * tf.cast(max_start + 1, tf.float32)), tf.int32
+    )
+    start = tf.minimum(start, max_start)
+
+    if foreground:
+        label = inputs["fixed_label"]
+        mask = label > 0.5
+        if len(label.shape) == 4:
+            # stacked labels
+            mask = tf.reduce_any(mask, axis=3)
+        # shape = (num_foreground, 3)
+        foreground_coords = tf.cast(tf.where(mask), tf.int32)
+        num_foreground = tf.shape(foreground_coords)[0]
+        index = tf.random.stateless_uniform(
+            shape=(),
+            seed=fg_seed,
+            minval=0,
+            maxval=tf.maximum(num_foreground, 1),
+            dtype=tf.int32,
+        )
+        start = tf.cond(
+            num_foreground > 0,
+            lambda: tf.clip_by_value(
+                foreground_coords[index] - patch_size // 2, 0, max_start
+            ),
+            lambda: start,
+        )
+
+    outputs = dict()
+    for key, value in inputs.items():
+        if key == "indices":
+            outputs[key] = tf.concat(
+                [value[:-1], tf.cast(start, value.dtype), value[-1:]], axis=0
+            )
+        elif len(value.shape) == 4:
+            # stacked labels have an extra axis for label channels
+            patch = tf.slice(
+                value,
+                begin=tf.concat([start, [0]], axis=0),
+                size=tf.concat([patch_size, [-1]], axis=0),
+            )
+            outputs[key] = tf.ensure_shape(patch, (*patch_shape, None))
+        else:
+            patch = tf.slice(value, begin=start, size=patch_size)
+            outputs[key] = tf.ensure_shape(patch, patch_shape)
+    return outputs
+
+
 def gen_rand_affine_transform(
     batch_size: int, scale: float, seed: Optional[int] = None
 ) -> tf.Tensor:
@@ -380,11 +637,7 @@ def gen_rand_affine_transform(
     - T is the transformation matrix, of shape (4, 3)
 
     Given original and transformed coordinates,
-    we can calculate the transformation matrix using
-
-        x = np.linalg.lstsq(a, b)
-
-    such that
+    we can calculate the transformation matrix by solving
 
         a x = b
 
@@ -394,6 +647,9 @@ def gen_rand_affine_transform(
     - b = new
     - x = T
 
+    As the four corners below are not coplanar, a is invertible and
+    the solution is given in closed form by x = inv(a) b.
+
     To generate random transformation,
     we choose to add random perturbation to corner coordinates as follows:
     for corner of coordinates (x, y, z), the noise is
@@ -445,21 +701,37 @@ def gen_rand_affine_transform(
     np.random.seed(seed)
     noise = np.random.uniform(1 - scale, 1, [batch_size, 4, 3])  # shape = (batch, 4, 3)
 
-    # old represents four corners of a cube
-    # corresponding to the corner C G D A as shown above
-    old = np.tile(
-        [[[-1, -1, -1, 1], [-1, -1, 1, 1], [-1, 1, -1, 1], [1, -1, -1, 1]]],
-        [batch_size, 1, 1],
-    )  # shape = (batch, 4, 4)
-    new = old[:, :, :3] * noise  # shape = (batch, 4, 3)
-
-    theta = np.array(
-        [np.linalg.lstsq(old[k], new[k], rcond=-1)[0] for k in range(batch_size)]
-    )  # shape = (batch, 4, 3)
+    new = AFFINE_CORNERS[None, :, :3] * noise  # shape = (batch, 4, 3)
+    theta = np.einsum("ij,bjk->bik", AFFINE_CORNERS_INV, new)  # shape = (batch, 4, 3)
 
     return tf.cast(theta, dtype=tf.float32)
 
 
+def gen_rand_affine_transform_tf(
+    batch_size: Union[int, tf.Tensor], scale: float, seed: tf.Tensor
+) -> tf.Tensor:
+    """
+    TensorFlow version of gen_rand_affine_transform using a stateless generator.
+
+    The noise is sampled with tf.random.stateless_uniform and the
+    transformation is solved in closed form with a batched matrix product,
+    so that it can run inside tf.function and tf.data on any device.
+
+    :param batch_size: total number of samples consumed per step, over all devices.
+    :param scale: a float number between 0 and 1
+    :param seed: shape = (2,), the same seed gives the same transformations.
+    :return: shape = (batch, 4, 3)
+    """
+    assert 0 <= scale <= 1
+    noise = tf.random.stateless_uniform(
+        shape=(batch_size, 4, 3), seed=seed, minval=1 - scale, maxval=1
+    )  # shape = (batch, 4, 3)
+    corners = tf.constant(AFFINE_CORNERS[:, :3], dtype=tf.float32)
+    new = corners[None, ...] * noise  # shape = (batch, 4, 3)
+    corners_inv = tf.constant(AFFINE_CORNERS_INV, dtype=tf.float32)
+    return tf.einsum("ij,bjk->bik", corners_inv, new)  # shape = (batch, 4, 3)
+
+
 def gen_rand_ddf(
     batch_size: int,
     image_size: Tuple[int, ...],
@@ -484,5 +756,50 @@ def gen_rand_ddf(
     low_res_field = low_res_strength * np.random.randn(
         batch_size, low_res_size[0], low_res_size[1], low_res_size[2], 3
     )
-    high_res_field = Resize3d(shape=image_size)(low_res_field)
+    high_res_field = resize3d(
+        image=tf.convert_to_tensor(low_res_field, dtype=tf.float32), shape=image_size
+    )
     return high_res_field
+
+
+def gen_rand_ddf_tf(
+    batch_size: Union[int, tf.Tensor],
+    image_size: Tuple[int, ...],
+    field_strength: Union[int, float],
+    low_res_size: Union[Tuple, List],
+    seed: tf.Tensor,
+) -> tf.Tensor:
+    """
+    TensorFlow version of gen_rand_ddf using stateless generators.
+
+    :param batch_size: number of samples, can be a scalar tensor.
+    :param image_size: (dim1, dim2, dim3)
+    :param field_strength: maximum field strength, computed as a U[0,field_strength]
+    :param low_res_size: low_resolution deformation field that will be upsampled to
+        the original size in order to get smooth and more realistic fields.
+    :param seed: shape = (2,), the same seed gives the same fields.
+    :return: shape = (batch, dim1, dim2, dim3, 3)
+    """
+    seeds = split_seed(seed, 2)
+    low_res_strength = tf.random.stateless_uniform(
+        shape=(batch_size, 1, 1, 1, 3), seed=seeds[0], minval=0, maxval=field_strength
+    )
+    low_res_field = low_res_strength * tf.random.stateless_normal(
+        shape=(batch_size, *low_res_size, 3), seed=seeds[1]
+    )
+    return resize3d(image=low_res_field, shape=image_size)
+
+
+def split_seed(seed: Optional[tf.Tensor], num: int) -> tf.Tensor:
+    """
+    Derive independent seeds for stateless random generators from one seed.
+
+    :param seed: shape = (2,), if None, random seeds are returned.
+    :param num: number of seeds.
+    :return: shape = (num, 2)
+    """
+    if seed is None:
+        return tf.random.uniform(shape=(num, 2), maxval=tf.int32.max, dtype=tf.int32)
+    return tf.random.stateless_uniform(
+        shape=(num, 2), seed=seed, minval=0, maxval=tf.int32.max, dtype=tf.int32
+    )
@@ -1,6 +1,7 @@
 """Provide regularization functions and classes for ddf."""
 from typing import Callable
 
+import numpy as np
 import tensorflow as tf
 
 from deepreg.registry import REGISTRY
@@ -13,8 +14,8 @@ def gradient_dx(fx: tf.Tensor) -> tf.Tensor:
     It moves the tensor along axis 1 to calculate the approximate gradient, the x axis,
     dx[i] = (x[i+1] - x[i-1]) / 2.
 
-    :param fx: shape = (batch, m_dim1, m_dim2, m_dim3)
-    :return: shape = (batch, m_dim1-2, m_dim2-2, m_dim3-2)
+    :param fx: shape = (batch, m_dim1, m_dim2, m_dim3, ...)
+    :return: shape = (batch, m_dim1-2, m_dim2-2, m_dim3-2, ...)
     """
     return (fx[:, 2:, 1:-1, 1:-1] - fx[:, :-2, 1:-1, 1:-1]) / 2
 
@@ -26,8 +27,8 @@ def gradient_dy(fy: tf.Tensor) -> tf.Tensor:
     It moves the tensor along axis 2 to calculate the approximate gradient, the y axis,
     dy[i] = (y[i+1] - y[i-1]) / 2.
 
-    :param fy: shape = (batch, m_dim1, m_dim2, m_dim3)
-    :return: shape = (batch, m_dim1-2, m_dim2-2, m_dim3-2)
+    :param fy: shape = (batch, m_dim1, m_dim2, m_dim3, ...)
+    :return: shape = (batch, m_dim1-2, m_dim2-2, m_dim3-2, ...)
     """
     return (fy[:, 1:-1, 2:, 1:-1] - fy[:, 1:-1, :-2, 1:-1]) / 2
 
@@ -39,8 +40,8 @@ def gradient_dz(fz: tf.Tensor) -> tf.Tensor:
     It moves the tensor along axis 3 to calculate the approximate gradient, the z axis,
     dz[i] = (z[i+1] - z[i-1]) / 2.
 
-    :param fz: shape = (batch, m_dim1, m_dim2, m_dim3)
-    :return: shape = (batch, m_dim1-2, m_dim2-2, m_dim3-2)
+    :param fz: shape = (batch, m_dim1, m_dim2, m_dim3, ...)
+    :return: shape = (batch, m_dim1-2, m_dim2-2, m_dim3-2, ...)
     """
     return (fz[:, 1:-1, 1:-1, 2:] - fz[:, 1:-1, 1:-1, :-2]) / 2
 
@@ -58,6 +59,30 @@ def gradient_dxyz(fxyz: tf.Tensor, fn: Callable) -> tf.Tensor:
     return tf.stack([fn(fxyz[..., i]) for i in [0, 1, 2]], axis=4)
 
 
+def get_second_order_gradient_filters() -> tf.Tensor:
+    """
+    Return filters computing second order gradients by central finite difference.
+
+    The filters are equivalent to calling gradient_dx, gradient_dy or gradient_dz
+    twice, e.g. dxy[i, j] = (f[i+1, j+1] - f[i+1, j-1] - f[i-1, j+1] + f[i-1, j-1]) / 4
+    and dxx[i] = (f[i+2] - 2 * f[i] + f[i-2]) / 4.
+
+    :return: shape = (5, 5, 5, 1, 6), output channels correspond to
+        dxx, dyy, dzz, dxy, dyz, dxz.
+    """
+    filters = np.zeros(shape=(5, 5, 5, 1, 6), dtype=np.float32)
+    unit = np.eye(3, dtype=int)
+    center = np.array([2, 2, 2])
+    for channel, (axis1, axis2) in enumerate(
+        [(0, 0), (1, 1), (2, 2), (0, 1), (1, 2), (0, 2)]
+    ):
+        for sign1 in [-1, 1]:
+            for sign2 in [-1, 1]:
+                index = center + sign1 * unit[axis1] + sign2 * unit[axis2]
+                filters[(*index, 0, channel)] += sign1 * sign2 / 4
+    return tf.constant(filters)
+
+
 @REGISTRY.register_loss(name="gradient")
 class GradientNorm(tf.keras.layers.Layer):
     """
@@ -74,7 +99,8 @@ class GradientNorm(tf.keras.layers.Layer):
         :param name: name of the loss
         :param kwargs: additional arguments.
         """
-        super().__init__(name=name)
+        # always computed in float32, even if a mixed precision policy is used
+        super().__init__(name=name, dtype="float32")
         self.l1 = l1
 
     def call(self, inputs: tf.Tensor, **kwargs) -> tf.Tensor:
@@ -87,11 +113,11 @@ class GradientNorm(tf.keras.layers.Layer):
         """
         assert len(inputs.shape) == 5
         ddf = inputs
-        # first order gradient
+        # first order gradient, all channels at once
         # (batch, m_dim1-2, m_dim2-2, m_dim3-2, 3)
-        dfdx = gradient_dxyz(ddf, gradient_dx)
-        dfdy = gradient_dxyz(ddf, gradient_dy)
-        dfdz = gradient_dxyz(ddf, gradient_dz)
+        dfdx = gradient_dx(ddf)
+        dfdy = gradient_dy(ddf)
+        dfdz = gradient_dz(ddf)
         if self.l1:
             norms = tf.abs(dfdx) + tf.abs(dfdy) + tf.abs(dfdz)
         else:
@@ -120,34 +146,49 @@ class BendingEnergy(tf.keras.layers.Layer):
         :param name: name of the loss.
         :param kwargs: additional arguments.
         """
-        super().__init__(name=name)
+        # always computed in float32, even if a mixed precision policy is used
+        super().__init__(name=name, dtype="float32")
+        self.filters = get_second_order_gradient_filters()
 
     def call(self, inputs: tf.Tensor, **kwargs) -> tf.Tensor:
         """
         Return a scalar loss.
 
+        The second order gradients are computed by a single convolution
+        with fixed filters, equivalent to applying central differences twice.
+
         :param inputs: shape = (batch, m_dim1, m_dim2, m_dim3, 3)
         :param kwargs: additional arguments.
         :return: shape = (batch, )
         """
         assert len(inputs.shape) == 5
         ddf = inputs
-        # first order gradient
-        # (batch, m_dim1-2, m_dim2-2, m_dim3-2, 3)
-        dfdx = gradient_dxyz(ddf, gradient_dx)
-        dfdy = gradient_dxyz(ddf, gradient_dy)
-        dfdz = gradient_dxyz(ddf, gradient_dz)
-
-        # second order gradient
-        # (batch, m_dim1-4, m_dim2-4, m_dim3-4, 3)
-        dfdxx = gradient_dxyz(dfdx, gradient_dx)
-        dfdyy = gradient_dxyz(dfdy, gradient_dy)
-        dfdzz = gradient_dxyz(dfdz, gradient_dz)
-        dfdxy = gradient_dxyz(dfdx, gradient_dy)
-        dfdyz = gradient_dxyz(dfdy, gradient_dz)
-        dfdxz = gradient_dxyz(dfdx, gradient_dz)
+        if any(d is not None and d < 5 for d in ddf.shape[1:4]):
+            # no voxel has the full five-voxel stencil
+            return tf.zeros_like(ddf[:, 0, 0, 0, 0])
+
+        # fold channels into the batch axis
+        # (3 * batch, m_dim1, m_dim2, m_dim3, 1)
+        shape = tf.shape(ddf)
+        ddf = tf.reshape(
+            tf.transpose(ddf, perm=[4, 0, 1, 2, 3]),
+            shape=[-1, shape[1], shape[2], shape[3], 1],
+        )
+
+        # second order gradient dxx, dyy, dzz, dxy, dyz, dxz in one pass
+        # (3 * batch, m_dim1-4, m_dim2-4, m_dim3-4, 6)
+        grads = tf.nn.conv3d(
+            ddf,
+            filters=tf.cast(self.filters, dtype=ddf.dtype),
+            strides=[1, 1, 1, 1, 1],
+            padding="VALID",
+        )
 
         # (dx + dy + dz) ** 2 = dxx + dyy + dzz + 2*(dxy + dyz + dzx)
-        energy = dfdxx ** 2 + dfdyy ** 2 + dfdzz ** 2
-        energy += 2 * dfdxy ** 2 + 2 * dfdxz ** 2 + 2 * dfdyz ** 2
-        return tf.reduce_mean(energy, axis=[1, 2, 3, 4])
+        # (3 * batch, m_dim1-4, m_dim2-4, m_dim3-4)
+        weights = tf.constant([1, 1, 1, 2, 2, 2], dtype=grads.dtype)
+        energy = tf.reduce_sum(grads ** 2 * weights, axis=4)
+        # average over voxels then channels
+        # (3, batch, (m_dim1-4) * (m_dim2-4) * (m_dim3-4))
+        energy = tf.reshape(energy, shape=[3, shape[0], -1])
+        return tf.reduce_mean(tf.reduce_mean(energy, axis=2), axis=0)
@@ -1,10 +1,13 @@
 """Provide different loss or metrics classes for images."""
+from typing import Optional, Tuple, Union
+
+import numpy as np
 import tensorflow as tf
 
 from deepreg.constant import EPS
 from deepreg.loss.kernel import gaussian_kernel1d_size as gaussian_kernel1d
 from deepreg.loss.kernel import rectangular_kernel1d, triangular_kernel1d
-from deepreg.loss.util import NegativeLossMixin, separable_filter
+from deepreg.loss.util import NegativeLossMixin, box_filter, separable_filter
 from deepreg.registry import REGISTRY
 
 
@@ -22,6 +25,8 @@ class GlobalMutualInformation(tf.keras.losses.Loss):
         self,
         num_bins: int = 23,
         sigma_ratio: float = 0.5,
+        chunk_size: Optional[int] = None,
+        sampling_rate: float = 1.0,
         name: str = "GlobalMutualInformation",
         **kwargs,
     ):
@@ -30,12 +35,104 @@ class GlobalMutualInformation(tf.keras.losses.Loss):
 
         :param num_bins: number of bins for intensity, the default value is empirical.
         :param sigma_ratio: a hyper param for gaussian function
+        :param chunk_size: if given, the joint histogram is accumulated over
+            chunks of chunk_size voxels, and the Parzen weights of each chunk
+            are recomputed during backpropagation, so that the memory does not
+            depend on the volume size.
+        :param sampling_rate: fraction of voxels randomly sampled per call
+            to estimate the histograms, 1.0 means all voxels are used.
         :param name: name of the loss
         :param kwargs: additional arguments.
         """
         super().__init__(name=name, **kwargs)
+        if chunk_size is not None and chunk_size <= 0:
+            raise ValueError(f"chunk_size must be positive, got {chunk_size}.")
+        if not 0 < sampling_rate <= 1:
+            raise ValueError(f"sampling_rate must be in (0, 1], got {sampling_rate}.")
         self.num_bins = num_bins
         self.sigma_ratio = sigma_ratio
+        self.chunk_size = chunk_size
+        self.sampling_rate = sampling_rate
+
+    def calc_histogram(
+        self, y_true: tf.Tensor, y_pred: tf.Tensor, mask: tf.Tensor
+    ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+        """
+        Return the unnormalized joint and marginal histograms.
+
+        Each voxel contributes continuously to a range of histogram bins,
+        weighted by a Gaussian function of the distance to the bin centers.
+
+        :param y_true: shape = (batch, nb_voxels, 1), values in [0, 1]
+        :param y_pred: shape = (batch, nb_voxels, 1), values in [0, 1]
+        :param mask: shape = (batch, nb_voxels, 1), one for voxels to count,
+            zero for padded voxels.
+        :return: tuple of
+            - joint histogram, shape = (batch, num_bins, num_bins)
+            - histogram of y_true, shape = (batch, num_bins)
+            - histogram of y_pred, shape = (batch, num_bins)
+        """
+        bin_centers = tf.linspace(0.0, 1.0, self.num_bins)  # (num_bins,)
+        bin_centers = tf.cast(bin_centers, dtype=y_true.dtype)
+        bin_centers = bin_centers[None, None, ...]  # (1, 1, num_bins)
+        sigma = (
+            tf.reduce_mean(bin_centers[:, :, 1:] - bin_centers[:, :, :-1])
+            * self.sigma_ratio
+        )  # scalar, sigma in the Gaussian function (weighting function W)
+        preterm = 1 / (2 * tf.math.square(sigma))  # scalar
+
+        ia = tf.math.exp(
+            -preterm * tf.math.square(y_true - bin_centers)
+        )  # (batch, nb_voxels, num_bins)
+        ia *= mask / tf.reduce_sum(ia, -1, keepdims=True)
+
+        ib = tf.math.exp(
+            -preterm * tf.math.square(y_pred - bin_centers)
+        )  # (batch, nb_voxels, num_bins)
+        ib /= tf.reduce_sum(ib, -1, keepdims=True)  # (batch, nb_voxels, num_bins)
+
+        pab = tf.matmul(ia, ib, transpose_a=True)  # (batch, num_bins, num_bins)
+        pa = tf.reduce_sum(ia, axis=1)  # (batch, num_bins)
+        pb = tf.reduce_sum(ib * mask, axis=1)  # (batch, num_bins)
+        return pab, pa, pb
+
+    def calc_chunked_histogram(
+        self, y_true: tf.Tensor, y_pred: tf.Tensor, mask: tf.Tensor
+    ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+        """
+        Return the unnormalized histograms accumulated over chunks of voxels.
+
+        The voxels are zero padded to a multiple of chunk_size, padded voxels
+        are masked out.
+
+        :param y_true: shape = (batch, nb_voxels, 1), values in [0, 1]
+        :param y_pred: shape = (batch, nb_voxels, 1), values in [0, 1]
+        :param mask: shape = (batch, nb_voxels, 1), same as calc_histogram.
+        :return: same as calc_histogram.
+        """
+        nb_voxels = y_true.shape[1]
+        num_chunks = -(-nb_voxels // self.chunk_size)
+        paddings = [[0, 0], [0, num_chunks * self.chunk_size - nb_voxels], [0, 0]]
+        # (batch, num_chunks, chunk_size, 1)
+        chunk_shape = [-1, num_chunks, self.chunk_size, 1]
+        mask = tf.reshape(tf.pad(mask, paddings=paddings), chunk_shape)
+        y_true = tf.reshape(tf.pad(y_true, paddings=paddings), chunk_shape)
+        y_pred = tf.reshape(tf.pad(y_pred, paddings=paddings), chunk_shape)
+        histogram_fn = tf.recompute_grad(self.calc_histogram)
+
+        def body(i, pab, pa, pb):
+            pab_i, pa_i, pb_i = histogram_fn(y_true[:, i], y_pred[:, i], mask[:, i])
+            return i + 1, pab + pab_i, pa + pa_i, pb + pb_i
+
+        batch = tf.shape(y_true)[0]
+        pab = tf.zeros(shape=(batch, self.num_bins, self.num_bins), dtype=y_true.dtype)
+        pa = tf.zeros(shape=(batch, self.num_bins), dtype=y_true.dtype)
+        _, pab, pa, pb = tf.while_loop(
+            cond=lambda i, *_: i < num_chunks,
+            body=body,
+            loop_vars=(tf.constant(0), pab, pa, pa),
+        )
+        return pab, pa, pb
 
     def call(self, y_true: tf.Tensor, y_pred: tf.Tensor) -> tf.Tensor:
         """
@@ -56,36 +153,46 @@ class GlobalMutualInformation(tf.keras.losses.Loss):
         # intensity is split into bins between 0, 1
         y_true = tf.clip_by_value(y_true, 0, 1)
         y_pred = tf.clip_by_value(y_pred, 0, 1)
-        bin_centers = tf.linspace(0.0, 1.0, self.num_bins)  # (num_bins,)
-        bin_centers = tf.cast(bin_centers, dtype=y_true.dtype)
-        bin_centers = bin_centers[None, None, ...]  # (1, 1, num_bins)
-        sigma = (
-            tf.reduce_mean(bin_centers[:, :, 1:] - bin_centers[:, :, :-1])
-            * self.sigma_ratio
-        )  # scalar, sigma in the Gaussian function (weighting function W)
-        preterm = 1 / (2 * tf.math.square(sigma))  # scalar
-        batch, w, h, z, c = y_true.shape
-        y_true = tf.reshape(y_true, [batch, w * h * z * c, 1])  # (batch, nb_voxels, 1)
-        y_pred = tf.reshape(y_pred, [batch, w * h * z * c, 1])  # (batch, nb_voxels, 1)
-        nb_voxels = y_true.shape[1] * 1.0  # w * h * z, number of voxels
-
-        # each voxel contributes continuously to a range of histogram bin
-        ia = tf.math.exp(
-            -preterm * tf.math.square(y_true - bin_centers)
-        )  # (batch, nb_voxels, num_bins)
-        ia /= tf.reduce_sum(ia, -1, keepdims=True)  # (batch, nb_voxels, num_bins)
-        ia = tf.transpose(ia, (0, 2, 1))  # (batch, num_bins, nb_voxels)
-        pa = tf.reduce_mean(ia, axis=-1, keepdims=True)  # (batch, num_bins, 1)
+        _, w, h, z, c = y_true.shape
+        nb_voxels = w * h * z * c
+        y_true = tf.reshape(y_true, [-1, nb_voxels, 1])  # (batch, nb_voxels, 1)
+        y_pred = tf.reshape(y_pred, [-1, nb_voxels, 1])  # (batch, nb_voxels, 1)
+
+        if self.sampling_rate < 1:
+            # the same voxels are sampled for y_true and y_pred
+            nb_voxels = max(int(nb_voxels * self.sampling_rate), 1)
+            indices = tf.random.uniform(
+                shape=(nb_voxels,), maxval=y_true.shape[1], dtype=tf.int32
+            )
+            y_true = tf.gather(y_true, indices, axis=1)
+            y_pred = tf.gather(y_pred, indices, axis=1)
+
+        mask = tf.ones_like(y_true)
+        if self.chunk_size is None or self.chunk_size >= nb_voxels:
+            pab, pa, pb = self.calc_histogram(y_true=y_true, y_pred=y_pred, mask=mask)
+        else:
+            pab, pa, pb = self.calc_chunked_histogram(
+                y_true=y_true, y_pred=y_pred, mask=mask
+            )
+        return self.calc_mutual_information(pab=pab, pa=pa, pb=pb, count=nb_voxels)
 
-        ib = tf.math.exp(
-            -preterm * tf.math.square(y_pred - bin_centers)
-        )  # (batch, nb_voxels, num_bins)
-        ib /= tf.reduce_sum(ib, -1, keepdims=True)  # (batch, nb_voxels, num_bins)
-        pb = tf.reduce_mean(ib, axis=1, keepdims=True)  # (batch, 1, num_bins)
+    @staticmethod
+    def calc_mutual_information(
+        pab: tf.Tensor, pa: tf.Tensor, pb: tf.Tensor, count: Union[tf.Tensor, int]
+    ) -> tf.Tensor:
+        """
+        Return mutual information from unnormalized histograms.
 
+        :param pab: joint histogram, shape = (batch, num_bins, num_bins)
+        :param pa: histogram of y_true, shape = (batch, num_bins)
+        :param pb: histogram of y_pred, shape = (batch, num_bins)
+        :param count: number of voxels, scalar or shape = (batch, 1, 1)
+        :return: shape = (batch,)
+        """
+        pa = pa[:, :, None] / count  # (batch, num_bins, 1)
+        pb = pb[:, None, :] / count  # (batch, 1, num_bins)
         papb = tf.matmul(pa, pb)  # (batch, num_bins, num_bins)
-        pab = tf.matmul(ia, ib)  # (batch, num_bins, num_bins)
-        pab /= nb_voxels
+        pab /= count
 
         # MI: sum(P_ab * log(P_ab/P_ap_b))
         div = (pab + EPS) / (papb + EPS)
@@ -96,6 +203,8 @@ class GlobalMutualInformation(tf.keras.losses.Loss):
         config = super().get_config()
         config["num_bins"] = self.num_bins
         config["sigma_ratio"] = self.sigma_ratio
+        config["chunk_size"] = self.chunk_size
+        config["sampling_rate"] = self.sampling_rate
         return config
 
 
@@ -104,6 +213,140 @@ class GlobalMutualInformationLoss(NegativeLossMixin, GlobalMutualInformation):
     """Revert the sign of GlobalMutualInformation."""
 
 
+class LocalMutualInformation(GlobalMutualInformation):
+    """
+    Local mutual information via Parzen windowing method.
+
+    The volume is split into non-overlapping cubic windows of kernel_size voxels,
+    the mutual information is computed per window with the same Parzen weights
+    as GlobalMutualInformation, then averaged over windows weighted by their
+    number of voxels. Windows are obtained by reshaping the volumes,
+    so that all local histograms are computed with one batched matrix
+    multiplication instead of a loop over windows. Volumes are zero padded
+    to a multiple of kernel_size, padded voxels are masked out.
+
+    y_true and y_pred have to be at least 4d tensor, including batch axis.
+    """
+
+    def __init__(
+        self,
+        kernel_size: int = 16,
+        num_bins: int = 12,
+        sigma_ratio: float = 0.5,
+        chunk_size: Optional[int] = None,
+        sampling_rate: float = 1.0,
+        name: str = "LocalMutualInformation",
+        **kwargs,
+    ):
+        """
+        Init.
+
+        :param kernel_size: size of the cubic windows along each axis.
+        :param num_bins: number of bins for intensity, fewer bins than the global
+            version are used as each window has fewer voxels.
+        :param sigma_ratio: a hyper param for gaussian function
+        :param chunk_size: if given, the histograms of each window are accumulated
+            over chunks of chunk_size voxels, see GlobalMutualInformation.
+        :param sampling_rate: must be 1.0, as voxels are not sampled per window.
+        :param name: name of the loss
+        :param kwargs: additional arguments.
+        """
+        super().__init__(
+            num_bins=num_bins,
+            sigma_ratio=sigma_ratio,
+            chunk_size=chunk_size,
+            name=name,
+            **kwargs,
+        )
+        if kernel_size <= 0:
+            raise ValueError(f"kernel_size must be positive, got {kernel_size}.")
+        if sampling_rate != 1:
+            raise ValueError(
+                f"LocalMutualInformation does not support voxel sampling, "
+                f"sampling_rate must be 1.0, got {sampling_rate}."
+            )
+        self.kernel_size = kernel_size
+
+    def split_windows(self, tensor: tf.Tensor) -> tf.Tensor:
+        """
+        Split a padded volume into non-overlapping windows.
+
+        :param tensor: shape = (batch, n1 * k, n2 * k, n3 * k, ch),
+            with k = kernel_size
+        :return: shape = (batch * n1 * n2 * n3, k * k * k * ch, 1)
+        """
+        k = self.kernel_size
+        _, dim1, dim2, dim3, ch = tensor.shape
+        # (batch, n1, k, n2, k, n3, k, ch)
+        tensor = tf.reshape(tensor, [-1, dim1 // k, k, dim2 // k, k, dim3 // k, k, ch])
+        # (batch, n1, n2, n3, k, k, k, ch)
+        tensor = tf.transpose(tensor, perm=[0, 1, 3, 5, 2, 4, 6, 7])
+        return tf.reshape(tensor, [-1, k * k * k * ch, 1])
+
+    def call(self, y_true: tf.Tensor, y_pred: tf.Tensor) -> tf.Tensor:
+        """
+        Return loss for a batch.
+
+        :param y_true: shape = (batch, dim1, dim2, dim3)
+            or (batch, dim1, dim2, dim3, ch)
+        :param y_pred: shape = (batch, dim1, dim2, dim3)
+            or (batch, dim1, dim2, dim3, ch)
+        :return: shape = (batch,)
+        """
+        # adjust
+        if len(y_true.shape) == 4:
+            y_true = tf.expand_dims(y_true, axis=4)
+            y_pred = tf.expand_dims(y_pred, axis=4)
+        assert len(y_true.shape) == len(y_pred.shape) == 5
+
+        # intensity is split into bins between 0, 1
+        y_true = tf.clip_by_value(y_true, 0, 1)
+        y_pred = tf.clip_by_value(y_pred, 0, 1)
+
+        # pad to a multiple of kernel_size
+        k = self.kernel_size
+        paddings = [[0, 0]] + [[0, -d % k] for d in y_true.shape[1:4]] + [[0, 0]]
+        mask = tf.pad(tf.ones_like(y_true), paddings=paddings)
+        y_true = tf.pad(y_true, paddings=paddings)
+        y_pred = tf.pad(y_pred, paddings=paddings)
+        num_windows = np.prod([d // k for d in y_true.shape[1:4]])
+
+        # (batch * num_windows, k * k * k * ch, 1)
+        mask = self.split_windows(mask)
+        y_true = self.split_windows(y_true)
+        y_pred = self.split_windows(y_pred)
+
+        if self.chunk_size is None or self.chunk_size >= y_true.shape[1]:
+            pab, pa, pb = self.calc_histogram(y_true=y_true, y_pred=y_pred, mask=mask)
+        else:
+            pab, pa, pb = self.calc_chunked_histogram(
+                y_true=y_true, y_pred=y_pred, mask=mask
+            )
+
+        # (batch * num_windows, 1, 1)
+        count = tf.reduce_sum(mask, axis=1, keepdims=True)
+        # (batch * num_windows,)
+        mi = self.calc_mutual_information(pab=pab, pa=pa, pb=pb, count=count)
+
+        # average over windows weighted by number of voxels
+        # (batch, num_windows)
+        mi = tf.reshape(mi, [-1, num_windows])
+        count = tf.reshape(count, [-1, num_windows])
+        return tf.reduce_sum(mi * count, axis=1) / tf.reduce_sum(count, axis=1)
+
+    def get_config(self) -> dict:
+        """Return the config dictionary for recreating this class."""
+        config = super().get_config()
+        config.pop("sampling_rate")
+        config["kernel_size"] = self.kernel_size
+        return config
+
+
+@REGISTRY.register_loss(name="lmi")
+class LocalMutualInformationLoss(NegativeLossMixin, LocalMutualInformation):
+    """Revert the sign of LocalMutualInformation."""
+
+
 class LocalNormalizedCrossCorrelation(tf.keras.losses.Loss):
     """
     Local squared zero-normalized cross-correlation.
@@ -150,6 +393,7 @@ class LocalNormalizedCrossCorrelation(tf.keras.losses.Loss):
         kernel_type: str = "rectangular",
         smooth_nr: float = EPS,
         smooth_dr: float = EPS,
+        summed_area: bool = False,
         name: str = "LocalNormalizedCrossCorrelation",
         **kwargs,
     ):
@@ -160,6 +404,8 @@ class LocalNormalizedCrossCorrelation(tf.keras.losses.Loss):
         :param kernel_type: str, rectangular, triangular or gaussian
         :param smooth_nr: small constant added to numerator in case of zero covariance.
         :param smooth_dr: small constant added to denominator in case of zero variance.
+        :param summed_area: sum over windows with summed-area tables, whose cost
+            does not depend on kernel_size, only for rectangular kernel.
         :param name: name of the loss.
         :param kwargs: additional arguments.
         """
@@ -169,11 +415,17 @@ class LocalNormalizedCrossCorrelation(tf.keras.losses.Loss):
                 f"Wrong kernel_type {kernel_type} for LNCC loss type. "
                 f"Feasible values are {self.kernel_fn_dict.keys()}"
             )
+        if summed_area and kernel_type != "rectangular":
+            raise ValueError(
+                f"summed_area is only supported for rectangular kernel, "
+                f"got kernel_type {kernel_type}."
+            )
         self.kernel_fn = self.kernel_fn_dict[kernel_type]
         self.kernel_type = kernel_type
         self.kernel_size = kernel_size
         self.smooth_nr = smooth_nr
         self.smooth_dr = smooth_dr
+        self.summed_area = summed_area
 
         # (kernel_size, )
         self.kernel = self.kernel_fn(kernel_size=self.kernel_size)
@@ -196,24 +448,31 @@ class LocalNormalizedCrossCorrelation(tf.keras.losses.Loss):
         machine error. Therefore a hard-coded clipping is added to
         prevent division by zero.
 
+        With summed_area, the sums are computed with summed-area tables,
+        whose cost does not depend on the kernel size.
+
         :param y_true: shape = (batch, dim1, dim2, dim3, 1)
         :param y_pred: shape = (batch, dim1, dim2, dim3, 1)
         :return: shape = (batch, dim1, dim2, dim3. 1)
         """
 
         # t = y_true, p = y_pred
-        # (batch, dim1, dim2, dim3, 1)
-        t2 = y_true * y_true
-        p2 = y_pred * y_pred
-        tp = y_true * y_pred
+        # (batch, dim1, dim2, dim3, 5)
+        stats = tf.concat(
+            [y_true, y_pred, y_true * y_true, y_pred * y_pred, y_true * y_pred],
+            axis=4,
+        )
+
+        # sum over kernel, all statistics are filtered in one pass
+        # (batch, dim1, dim2, dim3, 5)
+        if self.summed_area:
+            stats_sum = box_filter(stats, kernel_size=self.kernel_size)
+        else:
+            stats_sum = separable_filter(stats, kernel=self.kernel)
 
-        # sum over kernel
         # (batch, dim1, dim2, dim3, 1)
-        t_sum = separable_filter(y_true, kernel=self.kernel)  # E[t] * E[1]
-        p_sum = separable_filter(y_pred, kernel=self.kernel)  # E[p] * E[1]
-        t2_sum = separable_filter(t2, kernel=self.kernel)  # E[tt] * E[1]
-        p2_sum = separable_filter(p2, kernel=self.kernel)  # E[pp] * E[1]
-        tp_sum = separable_filter(tp, kernel=self.kernel)  # E[tp] * E[1]
+        # E[t] * E[1], E[p] * E[1], E[tt] * E[1], E[pp] * E[1], E[tp] * E[1]
+        t_sum, p_sum, t2_sum, p2_sum, tp_sum = tf.split(stats_sum, 5, axis=4)
 
         # average over kernel
         # (batch, dim1, dim2, dim3, 1)
@@ -271,6 +530,7 @@ class LocalNormalizedCrossCorrelation(tf.keras.losses.Loss):
             kernel_type=self.kernel_type,
             smooth_nr=self.smooth_nr,
             smooth_dr=self.smooth_dr,
+            summed_area=self.summed_area,
         )
         return config
 
@@ -28,7 +28,8 @@ class SumSquaredDifference(tf.keras.losses.Loss):
         :param kwargs: additional arguments.
         """
         super().__init__(name=name, **kwargs)
-        self.flatten = tf.keras.layers.Flatten()
+        # losses are computed in float32 even with mixed precision policies
+        self.flatten = tf.keras.layers.Flatten(dtype="float32")
 
     def call(self, y_true: tf.Tensor, y_pred: tf.Tensor) -> tf.Tensor:
         """
@@ -103,7 +104,8 @@ class DiceScore(tf.keras.losses.Loss):
         self.background_weight = background_weight
         self.smooth_nr = smooth_nr
         self.smooth_dr = smooth_dr
-        self.flatten = tf.keras.layers.Flatten()
+        # losses are computed in float32 even with mixed precision policies
+        self.flatten = tf.keras.layers.Flatten(dtype="float32")
 
     def call(self, y_true: tf.Tensor, y_pred: tf.Tensor) -> tf.Tensor:
         """
@@ -192,7 +194,8 @@ class CrossEntropy(tf.keras.losses.Loss):
         self.binary = binary
         self.background_weight = background_weight
         self.smooth = smooth
-        self.flatten = tf.keras.layers.Flatten()
+        # losses are computed in float32 even with mixed precision policies
+        self.flatten = tf.keras.layers.Flatten(dtype="float32")
 
     def call(self, y_true: tf.Tensor, y_pred: tf.Tensor) -> tf.Tensor:
         """
@@ -1,6 +1,6 @@
 """Provide helper functions or classes for defining loss or metrics."""
 
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
 import tensorflow as tf
 
@@ -22,6 +22,7 @@ class MultiScaleMixin(tf.keras.losses.Loss):
         self,
         scales: Optional[Union[List, float, int]] = None,
         kernel: str = "gaussian",
+        pyramid: bool = False,
         **kwargs,
     ):
         """
@@ -29,6 +30,10 @@ class MultiScaleMixin(tf.keras.losses.Loss):
 
         :param scales: list of scalars or None, if None, do not apply any scaling.
         :param kernel: gaussian or cauchy.
+        :param pyramid: if True, each scale is smoothed from the previous one in
+            increasing order, and tensors are downsampled by two
+            once the smoothing is at least two voxels, see call_pyramid.
+            Only supported for gaussian kernel.
         :param kwargs: additional arguments.
         """
         super().__init__(**kwargs)
@@ -37,10 +42,32 @@ class MultiScaleMixin(tf.keras.losses.Loss):
                 f"Kernel {kernel} is not supported."
                 f"Supported kernels are {list(self.kernel_fn_dict.keys())}"
             )
+        if pyramid and kernel != "gaussian":
+            raise ValueError(
+                f"Pyramid is only supported for gaussian kernel, got {kernel}."
+            )
         if scales is not None and not isinstance(scales, list):
             scales = [scales]
         self.scales = scales
         self.kernel = kernel
+        self.pyramid = pyramid
+
+    def smooth(
+        self, y_true: tf.Tensor, y_pred: tf.Tensor, scale: float
+    ) -> Tuple[tf.Tensor, tf.Tensor]:
+        """
+        Smooth both tensors in one filter pass.
+
+        :param y_true: shape = (batch, dim1, dim2, dim3).
+        :param y_pred: shape = (batch, dim1, dim2, dim3).
+        :param scale: scale of the kernel, in voxels.
+        :return: smoothed y_true and y_pred.
+        """
+        kernel_fn = self.kernel_fn_dict[self.kernel]
+        smoothed = separable_filter(
+            tf.stack([y_true, y_pred], axis=4), kernel_fn(scale)
+        )
+        return smoothed[..., 0], smoothed[..., 1]
 
     def call(self, y_true: tf.Tensor, y_pred: tf.Tensor) -> tf.Tensor:
         """
@@ -52,7 +79,8 @@ class MultiScaleMixin(tf.keras.losses.Loss):
         """
         if self.scales is None:
             return super().call(y_true=y_true, y_pred=y_pred)
-        kernel_fn = self.kernel_fn_dict[self.kernel]
+        if self.pyramid:
+            return self.call_pyramid(y_true=y_true, y_pred=y_pred)
         losses = []
         for s in self.scales:
             if s == 0:
@@ -64,16 +92,45 @@ class MultiScaleMixin(tf.keras.losses.Loss):
                     )
                 )
             else:
-                losses.append(
-                    super().call(
-                        y_true=separable_filter(
-                            tf.expand_dims(y_true, axis=4), kernel_fn(s)
-                        )[..., 0],
-                        y_pred=separable_filter(
-                            tf.expand_dims(y_pred, axis=4), kernel_fn(s)
-                        )[..., 0],
-                    )
+                y_true_s, y_pred_s = self.smooth(y_true=y_true, y_pred=y_pred, scale=s)
+                losses.append(super().call(y_true=y_true_s, y_pred=y_pred_s))
+        loss = tf.add_n(losses)
+        loss = loss / len(self.scales)
+        return loss
+
+    def call_pyramid(self, y_true: tf.Tensor, y_pred: tf.Tensor) -> tf.Tensor:
+        """
+        Calculate loss at different scales with a smoothing pyramid.
+
+        Scales are processed in increasing order, each scale is smoothed from
+        the previous one with a gaussian kernel of scale sqrt(s**2 - s_prev**2),
+        as the variances of gaussian kernels add up under convolution.
+        Once the smoothing is at least two voxels, tensors are downsampled
+        by two along each axis, so that larger scales are smoothed
+        with smaller kernels on fewer voxels.
+
+        The values differ slightly from call without pyramid
+        due to the truncation of kernels, the zero padding and the downsampling.
+
+        :param y_true: ground-truth tensor, shape = (batch, dim1, dim2, dim3).
+        :param y_pred: predicted tensor, shape = (batch, dim1, dim2, dim3).
+        :return: multi-scale loss, shape = (batch, ).
+        """
+        losses = []
+        factor = 1  # voxel size of the current level
+        prev_scale = 0
+        for s in sorted(self.scales):
+            if s > prev_scale:
+                increment = (s ** 2 - prev_scale ** 2) ** 0.5
+                y_true, y_pred = self.smooth(
+                    y_true=y_true, y_pred=y_pred, scale=increment / factor
                 )
+                prev_scale = s
+            losses.append(super().call(y_true=y_true, y_pred=y_pred))
+            while prev_scale / factor >= 2:
+                y_true = y_true[:, ::2, ::2, ::2]
+                y_pred = y_pred[:, ::2, ::2, ::2]
+                factor *= 2
         loss = tf.add_n(losses)
         loss = loss / len(self.scales)
         return loss
@@ -83,6 +140,7 @@ class MultiScaleMixin(tf.keras.losses.Loss):
         config = super().get_config()
         config["scales"] = self.scales
         config["kernel"] = self.kernel
+        config["pyramid"] = self.pyramid
         return config
 
 
@@ -119,13 +177,25 @@ def separable_filter(tensor: tf.Tensor, kernel: tf.Tensor) -> tf.Tensor:
     and the input to `tf.nn.conv3d` is of shape
     (batch, in_depth, in_height, in_width, in_channels).
 
-    :param tensor: shape = (batch, dim1, dim2, dim3, 1)
+    Channels are filtered independently, they are folded into the batch axis
+    so that all channels are filtered in one pass.
+
+    :param tensor: shape = (batch, dim1, dim2, dim3, channels)
     :param kernel: shape = (dim4,)
-    :return: shape = (batch, dim1, dim2, dim3, 1)
+    :return: shape = (batch, dim1, dim2, dim3, channels)
     """
     strides = [1, 1, 1, 1, 1]
     kernel = tf.cast(kernel, dtype=tensor.dtype)
 
+    num_channels = tensor.shape[4]
+    if num_channels != 1:
+        # (channels * batch, dim1, dim2, dim3, 1)
+        shape = tf.shape(tensor)
+        tensor = tf.reshape(
+            tf.transpose(tensor, perm=[4, 0, 1, 2, 3]),
+            shape=[-1, shape[1], shape[2], shape[3], 1],
+        )
+
     tensor = tf.nn.conv3d(
         tf.nn.conv3d(
             tf.nn.conv3d(
@@ -142,4 +212,42 @@ def separable_filter(tensor: tf.Tensor, kernel: tf.Tensor) -> tf.Tensor:
         strides=strides,
         padding="SAME",
     )
+
+    if num_channels != 1:
+        # (batch, dim1, dim2, dim3, channels)
+        tensor = tf.transpose(
+            tf.reshape(tensor, shape=[shape[4], -1, shape[1], shape[2], shape[3]]),
+            perm=[1, 2, 3, 4, 0],
+        )
+    return tensor
+
+
+def box_filter(tensor: tf.Tensor, kernel_size: int) -> tf.Tensor:
+    """
+    Sum over a cubic window using summed-area tables.
+
+    This is equivalent to separable_filter with a rectangular kernel of ones,
+    including the zero padding of "SAME", but the cost does not depend on
+    the kernel size: along each axis, the window sums are differences of
+    cumulative sums.
+
+    :param tensor: shape = (batch, dim1, dim2, dim3, channels)
+    :param kernel_size: size of the window along each axis.
+    :return: shape = (batch, dim1, dim2, dim3, channels)
+    """
+    # same padding as tf.nn.conv3d for padding="SAME"
+    pad_before = (kernel_size - 1) // 2
+    pad_after = kernel_size - 1 - pad_before
+    for axis in [1, 2, 3]:
+        paddings = [[0, 0]] * 5
+        # one extra zero so that the window sum is the difference of two sums
+        paddings[axis] = [pad_before + 1, pad_after]
+        cumsum = tf.cumsum(tf.pad(tensor, paddings=paddings), axis=axis)
+        # out[i] = cumsum[i + kernel_size] - cumsum[i]
+        #        = sum(tensor[i - pad_before : i + pad_after + 1])
+        head = (slice(None),) * axis
+        tensor = (
+            cumsum[head + (slice(kernel_size, None),)]
+            - cumsum[head + (slice(None, -kernel_size),)]
+        )
     return tensor
@@ -23,13 +23,17 @@ class AffineHead(tfkl.Layer):
         :param image_size: such as (dim1, dim2, dim3)
         :param name: name of the layer
         """
-        super().__init__(name=name)
+        # the affine transformation is sensitive to numerical precision,
+        # it is always computed in float32 even with mixed precision policies
+        super().__init__(name=name, dtype="float32")
         self.reference_grid = layer_util.get_reference_grid(image_size)
         self.transform_initial = tf.constant_initializer(
             value=list(np.eye(4, 3).reshape((-1)))
         )
         self._flatten = tfkl.Flatten()
-        self._dense = tfkl.Dense(units=12, bias_initializer=self.transform_initial)
+        self._dense = tfkl.Dense(
+            units=12, bias_initializer=self.transform_initial, dtype="float32"
+        )
 
     def call(
         self, inputs: Union[tf.Tensor, List], **kwargs
@@ -42,6 +42,7 @@ class UNet(Backbone):
         decode_num_channels: Optional[Tuple] = None,
         strides: int = 2,
         padding: str = "same",
+        gradient_checkpointing: bool = False,
         name: str = "Unet",
         **kwargs,
     ):
@@ -67,6 +68,11 @@ class UNet(Backbone):
             by default it is the same as encode_num_channels
         :param strides: strides for down-sampling
         :param padding: padding mode for all conv layers
+        :param gradient_checkpointing: if true, activations inside conv blocks
+            are not stored for the backward pass but recomputed during training,
+            trading compute for memory. As the forward pass of the blocks is run
+            twice, the moving statistics of batch normalization are updated twice
+            per step.
         :param name: name of the backbone.
         :param kwargs: additional arguments.
         """
@@ -94,6 +100,7 @@ class UNet(Backbone):
         self._decode_num_channels = decode_num_channels
         self._strides = strides
         self._padding = padding
+        self._gradient_checkpointing = gradient_checkpointing
 
         # init layers
         # all lists start with d = 0
@@ -526,6 +533,30 @@ class UNet(Backbone):
             out_activation=out_activation,
         )
 
+    def call_conv_block(
+        self, block: Union[tf.keras.Model, tfkl.Layer], inputs: tf.Tensor, training=None
+    ) -> tf.Tensor:
+        """
+        Call a conv block of the encoder, the bottom or the decoder.
+
+        With gradient checkpointing, the block is wrapped by tf.recompute_grad
+        during training, so that only its input is kept for the backward pass.
+        The wrapping happens at call time, such that the layers and checkpoints
+        are the same with or without gradient checkpointing.
+
+        :param block: conv block to call.
+        :param inputs: input tensor of the block.
+        :param training: None or bool.
+        :return: output tensor of the block.
+        """
+        if not (self._gradient_checkpointing and training):
+            return block(inputs=inputs, training=training)
+
+        def forward(x: tf.Tensor) -> tf.Tensor:
+            return block(inputs=x, training=training)
+
+        return tf.recompute_grad(forward)(inputs)
+
     def call(self, inputs: tf.Tensor, training=None, mask=None) -> tf.Tensor:
         """
         Build compute graph based on built layers.
@@ -540,19 +571,25 @@ class UNet(Backbone):
         skips = []
         encoded = inputs
         for d in range(self._depth):
-            skip = self._encode_convs[d](inputs=encoded, training=training)
+            skip = self.call_conv_block(
+                self._encode_convs[d], inputs=encoded, training=training
+            )
             encoded = self._encode_pools[d](inputs=skip, training=training)
             skips.append(skip)
 
         # bottom
-        decoded = self._bottom_block(inputs=encoded, training=training)  # type: ignore
+        decoded = self.call_conv_block(
+            self._bottom_block, inputs=encoded, training=training  # type: ignore
+        )
 
         # decoding / up-sampling
         outs = [decoded]
         for d in range(self._depth - 1, min(self._extract_levels) - 1, -1):
             decoded = self._decode_deconvs[d](inputs=decoded, training=training)
             decoded = self.build_skip_block()([decoded, skips[d]])
-            decoded = self._decode_convs[d](inputs=decoded, training=training)
+            decoded = self.call_conv_block(
+                self._decode_convs[d], inputs=decoded, training=training
+            )
             outs = [decoded] + outs
 
         # output
@@ -574,5 +611,6 @@ class UNet(Backbone):
             decode_num_channels=self._decode_num_channels,
             strides=self._strides,
             padding=self._padding,
+            gradient_checkpointing=self._gradient_checkpointing,
         )
         return config
@@ -1,5 +1,4 @@
 """This module defines custom layers."""
-import itertools
 from typing import List, Tuple, Union
 
 import numpy as np
@@ -118,6 +117,7 @@ class Resize3d(tfkl.Layer):
         shape: tuple,
         method: str = tf.image.ResizeMethod.BILINEAR,
         name: str = "resize3d",
+        **kwargs,
     ):
         """
         Init, save arguments.
@@ -125,8 +125,9 @@ class Resize3d(tfkl.Layer):
         :param shape: (dim1, dim2, dim3)
         :param method: tf.image.ResizeMethod
         :param name: name of the layer
+        :param kwargs: additional arguments.
         """
-        super().__init__(name=name)
+        super().__init__(name=name, **kwargs)
         assert len(shape) == 3
         self._shape = shape
         self._method = method
@@ -143,76 +144,7 @@ class Resize3d(tfkl.Layer):
                                 or (batch, dim1, dim2, dim3)
                                 or (dim1, dim2, dim3)
         """
-        # sanity check
-        image = inputs
-        image_dim = len(image.shape)
-
-        # init
-        if image_dim == 5:
-            has_channel = True
-            has_batch = True
-            input_image_shape = image.shape[1:4]
-        elif image_dim == 4:
-            has_channel = False
-            has_batch = True
-            input_image_shape = image.shape[1:4]
-        elif image_dim == 3:
-            has_channel = False
-            has_batch = False
-            input_image_shape = image.shape[0:3]
-        else:
-            raise ValueError(
-                "Resize3d takes input image of dimension 3 or 4 or 5, "
-                "corresponding to (dim1, dim2, dim3) "
-                "or (batch, dim1, dim2, dim3) "
-                "or (batch, dim1, dim2, dim3, channels), "
-                "got image shape{}".format(image.shape)
-            )
-
-        # no need of resize
-        if input_image_shape == tuple(self._shape):
-            return image
-
-        # expand to five dimensions
-        if not has_batch:
-            image = tf.expand_dims(image, axis=0)
-        if not has_channel:
-            image = tf.expand_dims(image, axis=-1)
-        assert len(image.shape) == 5  # (batch, dim1, dim2, dim3, channels)
-        image_shape = tf.shape(image)
-
-        # merge axis 0 and 1
-        output = tf.reshape(
-            image, (-1, image_shape[2], image_shape[3], image_shape[4])
-        )  # (batch * dim1, dim2, dim3, channels)
-
-        # resize dim2 and dim3
-        output = tf.image.resize(
-            images=output, size=self._shape[1:3], method=self._method
-        )  # (batch * dim1, out_dim2, out_dim3, channels)
-
-        # split axis 0 and merge axis 3 and 4
-        output = tf.reshape(
-            output,
-            shape=(-1, image_shape[1], self._shape[1], self._shape[2] * image_shape[4]),
-        )  # (batch, dim1, out_dim2, out_dim3 * channels)
-
-        # resize dim1 and dim2
-        output = tf.image.resize(
-            images=output, size=self._shape[:2], method=self._method
-        )  # (batch, out_dim1, out_dim2, out_dim3 * channels)
-
-        # reshape
-        output = tf.reshape(
-            output, shape=[-1, *self._shape, image_shape[4]]
-        )  # (batch, out_dim1, out_dim2, out_dim3, channels)
-
-        # squeeze to original dimension
-        if not has_batch:
-            output = tf.squeeze(output, axis=0)
-        if not has_channel:
-            output = tf.squeeze(output, axis=-1)
-        return output
+        return layer_util.resize3d(image=inputs, shape=self._shape, method=self._method)
 
     def get_config(self) -> dict:
         """Return the config dictionary for recreating this class."""
@@ -232,17 +164,33 @@ class Warping(tfkl.Layer):
     where vol = image, loc_shift = ddf
     """
 
-    def __init__(self, fixed_image_size: tuple, name: str = "warping", **kwargs):
+    def __init__(
+        self,
+        fixed_image_size: tuple,
+        interpolation: str = "linear",
+        name: str = "warping",
+        **kwargs,
+    ):
         """
         Init.
 
         :param fixed_image_size: shape = (f_dim1, f_dim2, f_dim3)
              or (f_dim1, f_dim2, f_dim3, ch) with the last channel for features
+        :param interpolation: nearest, linear, or cubic,
+            nearest is not differentiable with respect to the ddf.
         :param name: name of the layer
-        :param kwargs: additional arguments.
+        :param kwargs: additional arguments, the layer is computed in float32
+            by default, even if a mixed precision policy is used.
         """
+        kwargs.setdefault("dtype", "float32")
         super().__init__(name=name, **kwargs)
+        if interpolation not in layer_util.RESAMPLE_INTERPOLATIONS:
+            raise ValueError(
+                f"Warping interpolation must be one of "
+                f"{layer_util.RESAMPLE_INTERPOLATIONS}, got {interpolation}"
+            )
         self._fixed_image_size = fixed_image_size
+        self._interpolation = interpolation
         # shape = (1, f_dim1, f_dim2, f_dim3, 3)
         self.grid_ref = layer_util.get_reference_grid(grid_size=fixed_image_size)[
             None, ...
@@ -258,12 +206,15 @@ class Warping(tfkl.Layer):
         :return: shape = (batch, f_dim1, f_dim2, f_dim3)
         """
         ddf, image = inputs
-        return layer_util.resample(vol=image, loc=self.grid_ref + ddf)
+        return layer_util.resample(
+            vol=image, loc=self.grid_ref + ddf, interpolation=self._interpolation
+        )
 
     def get_config(self) -> dict:
         """Return the config dictionary for recreating this class."""
         config = super().get_config()
         config["fixed_image_size"] = self._fixed_image_size
+        config["interpolation"] = self._interpolation
         return config
 
 
@@ -367,6 +318,9 @@ class IntDVF(tfkl.Layer):
         self,
         fixed_image_size: tuple,
         num_steps: int = 7,
+        adaptive_steps: bool = False,
+        max_step_norm: float = 0.5,
+        gradient_checkpointing: bool = False,
         name: str = "int_dvf",
         **kwargs,
     ):
@@ -374,15 +328,26 @@ class IntDVF(tfkl.Layer):
         Init.
 
         :param fixed_image_size: tuple, (f_dim1, f_dim2, f_dim3)
-        :param num_steps: int, number of steps for integration
+        :param num_steps: int, number of steps for integration,
+            or maximum number of steps if adaptive_steps is true.
+        :param adaptive_steps: if true, use the smallest number of steps such that
+            the scaled DVF has a norm not larger than max_step_norm voxels.
+        :param max_step_norm: maximum norm of the scaled DVF in voxels,
+            used only if adaptive_steps is true.
+        :param gradient_checkpointing: if true, the resampling of each step is
+            recomputed during backpropagation instead of being stored.
         :param name: name of the layer
-        :param kwargs: additional arguments.
+        :param kwargs: additional arguments, the layer is computed in float32
+            by default, even if a mixed precision policy is used.
         """
+        kwargs.setdefault("dtype", "float32")
         super().__init__(name=name, **kwargs)
         assert len(fixed_image_size) == 3
         self._fixed_image_size = fixed_image_size
         self._num_steps = num_steps
-        self._warping = Warping(fixed_image_size=fixed_image_size)
+        self._adaptive_steps = adaptive_steps
+        self._max_step_norm = max_step_norm
+        self._gradient_checkpointing = gradient_checkpointing
 
     def call(self, inputs: tf.Tensor, **kwargs) -> tf.Tensor:
         """
@@ -390,16 +355,22 @@ class IntDVF(tfkl.Layer):
         :param kwargs: additional arguments.
         :return: ddf, shape = (batch, f_dim1, f_dim2, f_dim3, 3)
         """
-        ddf = inputs / (2 ** self._num_steps)
-        for _ in range(self._num_steps):
-            ddf += self._warping(inputs=[ddf, ddf])
-        return ddf
+        return layer_util.integrate_dvf(
+            dvf=inputs,
+            num_steps=self._num_steps,
+            adaptive_steps=self._adaptive_steps,
+            max_step_norm=self._max_step_norm,
+            gradient_checkpointing=self._gradient_checkpointing,
+        )
 
     def get_config(self) -> dict:
         """Return the config dictionary for recreating this class."""
         config = super().get_config()
         config["fixed_image_size"] = self._fixed_image_size
         config["num_steps"] = self._num_steps
+        config["adaptive_steps"] = self._adaptive_steps
+        config["max_step_norm"] = self._max_step_norm
+        config["gradient_checkpointing"] = self._gradient_checkpointing
         return config
 
 
@@ -414,8 +385,10 @@ class ResizeCPTransform(tfkl.Layer):
     ):
         """
         :param control_point_spacing: list or int
-        :param kwargs: additional arguments.
+        :param kwargs: additional arguments, the layer is computed in float32
+            by default, even if a mixed precision policy is used.
         """
+        kwargs.setdefault("dtype", "float32")
         super().__init__(**kwargs)
 
         if isinstance(control_point_spacing, int):
@@ -438,7 +411,7 @@ class ResizeCPTransform(tfkl.Layer):
             for v, c in zip(input_shape[1:-1], self.cp_spacing)
         )
         self._output_shape = output_shape
-        self._resize = Resize3d(output_shape)
+        self._resize = Resize3d(output_shape, dtype=self.dtype)
 
     def call(self, inputs, **kwargs) -> tf.Tensor:
         output = tf.nn.conv3d(
@@ -471,8 +444,10 @@ class BSplines3DTransform(tfkl.Layer):
             the same spacing to all dimensions is used
         :param output_shape: (batch_size, dim0, dim1, dim2, 3) of the high resolution
             deformation fields.
-        :param kwargs: additional arguments.
+        :param kwargs: additional arguments, the layer is computed in float32
+            by default, even if a mixed precision policy is used.
         """
+        kwargs.setdefault("dtype", "float32")
         super().__init__(**kwargs)
 
         self._output_shape = output_shape
@@ -495,64 +470,49 @@ class BSplines3DTransform(tfkl.Layer):
             3: lambda u: np.float64(u ** 3 / 6),
         }
 
-        filters = np.zeros(
-            (
-                4 * self.cp_spacing[0],
-                4 * self.cp_spacing[1],
-                4 * self.cp_spacing[2],
-                3,
-                3,
-            ),
-            dtype=np.float32,
-        )
-
-        u_arange = 1 - np.arange(
-            1 / (2 * self.cp_spacing[0]), 1, 1 / self.cp_spacing[0]
-        )
-        v_arange = 1 - np.arange(
-            1 / (2 * self.cp_spacing[1]), 1, 1 / self.cp_spacing[1]
-        )
-        w_arange = 1 - np.arange(
-            1 / (2 * self.cp_spacing[2]), 1, 1 / self.cp_spacing[2]
-        )
-
-        filter_idx = [[0, 1, 2, 3] for _ in range(3)]
-        filter_coord = list(itertools.product(*filter_idx))
-
-        for f_idx in filter_coord:
-            for it_dim in range(3):
-                filters[
-                    f_idx[0] * self.cp_spacing[0] : (f_idx[0] + 1) * self.cp_spacing[0],
-                    f_idx[1] * self.cp_spacing[1] : (f_idx[1] + 1) * self.cp_spacing[1],
-                    f_idx[2] * self.cp_spacing[2] : (f_idx[2] + 1) * self.cp_spacing[2],
-                    it_dim,
-                    it_dim,
-                ] = (
-                    b[f_idx[0]](u_arange)[:, None, None]
-                    * b[f_idx[1]](v_arange)[None, :, None]
-                    * b[f_idx[2]](w_arange)[None, None, :]
-                )
-
-        self.filter = tf.convert_to_tensor(filters)
+        # the tensor-product B-spline filter is separable and the same for each
+        # channel, so it is stored as one 1D filter of shape (4 * spacing,) per axis
+        self.filters = []
+        for spacing in self.cp_spacing:
+            u_arange = 1 - np.arange(1 / (2 * spacing), 1, 1 / spacing)
+            filter_1d = np.concatenate([b[k](u_arange) for k in range(4)])
+            self.filters.append(tf.convert_to_tensor(filter_1d, dtype=tf.float32))
 
     def interpolate(self, field) -> tf.Tensor:
         """
+        Interpolate the field with one 1D transposed convolution per axis.
+
+        The channels are folded into the batch axis,
+        so that the filters are applied to each channel independently.
+
         :param field: tf.Tensor with shape=number_of_control_points_per_dim
         :return: interpolated_field: tf.Tensor
         """
+        num_channels = field.shape[-1]
+
+        # (batch, c_dim1, c_dim2, c_dim3, ch) -> (batch * ch, c_dim1, c_dim2, c_dim3, 1)
+        output = tf.transpose(field, perm=[0, 4, 1, 2, 3])
+        output = tf.reshape(output, shape=(-1, *field.shape[1:4], 1))
+        for axis, spacing in enumerate(self.cp_spacing):
+            kernel_shape = [1, 1, 1, 1, 1]
+            kernel_shape[axis] = 4 * spacing
+            strides = [1, 1, 1]
+            strides[axis] = spacing
+            output_shape = [tf.shape(output)[0], *output.shape[1:]]
+            output_shape[axis + 1] = (
+                output.shape[axis + 1] - 1
+            ) * spacing + 4 * spacing
+            output = tf.nn.conv3d_transpose(
+                output,
+                tf.reshape(self.filters[axis], shape=kernel_shape),
+                output_shape=tf.stack(output_shape),
+                strides=strides,
+                padding="VALID",
+            )
 
-        image_shape = tuple(
-            [(a - 1) * b + 4 * b for a, b in zip(field.shape[1:-1], self.cp_spacing)]
-        )
-
-        output_shape = (field.shape[0],) + image_shape + (3,)
-        return tf.nn.conv3d_transpose(
-            field,
-            self.filter,
-            output_shape=output_shape,
-            strides=self.cp_spacing,
-            padding="VALID",
-        )
+        # (batch * ch, dim1, dim2, dim3, 1) -> (batch, dim1, dim2, dim3, ch)
+        output = tf.reshape(output, shape=(-1, num_channels, *output.shape[1:4]))
+        return tf.transpose(output, perm=[0, 2, 3, 4, 1])
 
     def call(self, inputs, **kwargs) -> tf.Tensor:
         """
@@ -1,17 +1,40 @@
 """
 Module containing utilities for layer inputs
 """
+import functools
 import itertools
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 import tensorflow as tf
 
+# maximum number of reference grids of different sizes kept in cache
+REFERENCE_GRID_CACHE_SIZE = 32
+
 
 def get_reference_grid(grid_size: Union[Tuple[int, ...], List[int]]) -> tf.Tensor:
     """
     Generate a 3D grid with given size.
 
+    Grids are cached by size, layers and data augmentations of the same
+    size therefore share a single constant tensor, even when they are traced
+    in different graphs.
+
+    :param grid_size: list or tuple of size 3, [dim1, dim2, dim3]
+    :return: shape = (dim1, dim2, dim3, 3),
+             grid[i, j, k, :] = [i j k]
+    """
+    return _get_reference_grid(tuple(int(x) for x in grid_size))
+
+
+@functools.lru_cache(maxsize=REFERENCE_GRID_CACHE_SIZE)
+def _get_reference_grid(grid_size: Tuple[int, ...]) -> tf.Tensor:
+    """
+    Generate a 3D grid with given size, the result is cached.
+
+    The grid is created eagerly so that the cached tensor can be captured
+    by any graph.
+
     Reference:
 
     - volshape_to_meshgrid of neuron
@@ -26,7 +49,7 @@ def get_reference_grid(grid_size: Union[Tuple[int, ...], List[int]]) -> tf.Tenso
     outputs are of shape (N, M, P) for ‘xy’ indexing and
     (M, N, P) for ‘ij’ indexing.
 
-    :param grid_size: list or tuple of size 3, [dim1, dim2, dim3]
+    :param grid_size: tuple of size 3, (dim1, dim2, dim3)
     :return: shape = (dim1, dim2, dim3, 3),
              grid[i, j, k, :] = [i j k]
     """
@@ -39,17 +62,116 @@ def get_reference_grid(grid_size: Union[Tuple[int, ...], List[int]]) -> tf.Tenso
     #             mesh_grid[0][i,j,k] = i
     #             mesh_grid[1][i,j,k] = j
     #             mesh_grid[2][i,j,k] = k
-    mesh_grid = tf.meshgrid(
-        tf.range(grid_size[0]),
-        tf.range(grid_size[1]),
-        tf.range(grid_size[2]),
-        indexing="ij",
-    )  # has three elements, each shape = (dim1, dim2, dim3)
-    grid = tf.stack(mesh_grid, axis=3)  # shape = (dim1, dim2, dim3, 3)
-    grid = tf.cast(grid, dtype=tf.float32)
+    with tf.init_scope():
+        mesh_grid = tf.meshgrid(
+            tf.range(grid_size[0]),
+            tf.range(grid_size[1]),
+            tf.range(grid_size[2]),
+            indexing="ij",
+        )  # has three elements, each shape = (dim1, dim2, dim3)
+        grid = tf.stack(mesh_grid, axis=3)  # shape = (dim1, dim2, dim3, 3)
+        grid = tf.cast(grid, dtype=tf.float32)
     return grid
 
 
+def resize3d(
+    image: tf.Tensor,
+    shape: Union[Tuple[int, ...], List[int]],
+    method: str = tf.image.ResizeMethod.BILINEAR,
+) -> tf.Tensor:
+    """
+    Resize image in two folds.
+
+    - resize dim2 and dim3
+    - resize dim1 and dim2
+
+    Unlike the Resize3d layer, no Keras layer is created,
+    so it can be used in data pipelines without building layers.
+
+    :param image: shape = (batch, dim1, dim2, dim3, channels)
+                          or (batch, dim1, dim2, dim3)
+                          or (dim1, dim2, dim3)
+    :param shape: (out_dim1, out_dim2, out_dim3)
+    :param method: tf.image.ResizeMethod
+    :return: shape = (batch, out_dim1, out_dim2, out_dim3, channels)
+                     or (batch, dim1, dim2, dim3)
+                     or (dim1, dim2, dim3)
+    """
+    # sanity check
+    image_dim = len(image.shape)
+
+    # init
+    if image_dim == 5:
+        has_channel = True
+        has_batch = True
+        input_image_shape = image.shape[1:4]
+    elif image_dim == 4:
+        has_channel = False
+        has_batch = True
+        input_image_shape = image.shape[1:4]
+    elif image_dim == 3:
+        has_channel = False
+        has_batch = False
+        input_image_shape = image.shape[0:3]
+    else:
+        raise ValueError(
+            "Resize3d takes input image of dimension 3 or 4 or 5, "
+            "corresponding to (dim1, dim2, dim3) "
+            "or (batch, dim1, dim2, dim3) "
+            "or (batch, dim1, dim2, dim3, channels), "
+            "got image shape{}".format(image.shape)
+        )
+
+    # no need of resize
+    if input_image_shape == tuple(shape):
+        return image
+
+    # expand to five dimensions
+    if not has_batch:
+        image = tf.expand_dims(image, axis=0)
+    if not has_channel:
+        image = tf.expand_dims(image, axis=-1)
+    assert len(image.shape) == 5  # (batch, dim1, dim2, dim3, channels)
+    image_shape = tf.shape(image)
+
+    # merge axis 0 and 1
+    output = tf.reshape(
+        image, (-1, image_shape[2], image_shape[3], image_shape[4])
+    )  # (batch * dim1, dim2, dim3, channels)
+
+    # resize dim2 and dim3
+    output = tf.image.resize(
+        images=output, size=shape[1:3], method=method
+    )  # (batch * dim1, out_dim2, out_dim3, channels)
+
+    # split axis 0 and merge axis 3 and 4
+    output = tf.reshape(
+        output,
+        shape=(-1, image_shape[1], shape[1], shape[2] * image_shape[4]),
+    )  # (batch, dim1, out_dim2, out_dim3 * channels)
+
+    # resize dim1 and dim2
+    output = tf.image.resize(
+        images=output, size=shape[:2], method=method
+    )  # (batch, out_dim1, out_dim2, out_dim3 * channels)
+
+    # reshape
+    output = tf.reshape(
+        output, shape=[-1, *shape, image_shape[4]]
+    )  # (batch, out_dim1, out_dim2, out_dim3, channels)
+
+    # tf.image.resize outputs float32, e.g. for float16 inputs
+    if image.dtype.is_floating:
+        output = tf.cast(output, dtype=image.dtype)
+
+    # squeeze to original dimension
+    if not has_batch:
+        output = tf.squeeze(output, axis=0)
+    if not has_channel:
+        output = tf.squeeze(output, axis=-1)
+    return output
+
+
 def get_n_bits_combinations(num_bits: int) -> List[List[int]]:
     """
     Function returning list containing all combinations of n bits.
@@ -214,57 +336,30 @@ def pyramid_combination(
     return values_floor + values_ceil
 
 
-def resample(
-    vol: tf.Tensor,
-    loc: tf.Tensor,
-    interpolation: str = "linear",
-    zero_boundary: bool = True,
-) -> tf.Tensor:
-    r"""
-    Sample the volume at given locations.
-
-    Input has
-
-    - volume, vol, of shape = (batch, v_dim 1, ..., v_dim n),
-      or (batch, v_dim 1, ..., v_dim n, ch),
-      where n is the dimension of volume,
-      ch is the extra dimension as features.
-
-      Denote vol_shape = (v_dim 1, ..., v_dim n)
-
-    - location, loc, of shape = (batch, l_dim 1, ..., l_dim m, n),
-      where m is the dimension of output.
+# interpolation methods supported by resample
+RESAMPLE_INTERPOLATIONS = ["nearest", "linear", "cubic"]
 
-      Denote loc_shape = (l_dim 1, ..., l_dim m)
-
-    Reference:
-
-    - neuron's interpn
-      https://github.com/adalca/neurite/blob/legacy/neuron/utils.py
-
-      Difference
+# half width of the FIR approximation of the cubic B-spline prefilter,
+# the truncation error is of order |z| ** 8 < 3e-5
+CUBIC_BSPLINE_PREFILTER_HALF_WIDTH = 8
 
-      1. they dont have batch size
-      2. they support more dimensions in vol
 
-      TODO try not using stack as neuron claims it's slower
+def get_resample_shapes(
+    vol: tf.Tensor, loc: tf.Tensor
+) -> Tuple[Union[int, tf.Tensor], tuple, bool]:
+    r"""
+    Check the shapes of the volume and locations for resample.
 
     :param vol: shape = (batch, \*vol_shape) or (batch, \*vol_shape, ch)
-      with the last channel for features
     :param loc: shape = (batch, \*loc_shape, n)
-      such that loc[b, l1, ..., lm, :] = [v1, ..., vn] is of shape (n,),
-      which represents a point in vol, with coordinates (v1, ..., vn)
-    :param interpolation: linear only, TODO support nearest
-    :param zero_boundary: if true, values on or outside boundary will be zeros
-    :return: shape = (batch, \*loc_shape) or (batch, \*loc_shape, ch)
-    """
-
-    if interpolation != "linear":
-        raise ValueError("resample supports only linear interpolation")
+    :return: a tuple of
 
-    # init
-    batch_size = vol.shape[0]
-    loc_shape = loc.shape[1:-1]
+        - batch_size, int or scalar tensor if the batch size is unknown,
+        - vol_shape, tuple of n ints,
+        - has_ch, whether vol has a feature channel.
+    """
+    # the batch size may be unknown, e.g. for the last partial batch of a dataset
+    batch_size = vol.shape[0] if vol.shape[0] is not None else tf.shape(vol)[0]
     dim_vol = loc.shape[-1]  # dimension of vol, n
     if dim_vol == len(vol.shape) - 1:
         # vol.shape = (batch, *vol_shape)
@@ -277,7 +372,36 @@ def resample(
             "vol shape inconsistent with loc "
             "vol.shape = {}, loc.shape = {}".format(vol.shape, loc.shape)
         )
-    vol_shape = vol.shape[1 : dim_vol + 1]
+    vol_shape = tuple(vol.shape[1 : dim_vol + 1])
+    return batch_size, vol_shape, has_ch
+
+
+def get_resample_corner_weights(
+    vol: tf.Tensor, loc: tf.Tensor, zero_boundary: bool
+) -> Tuple[Union[int, tf.Tensor], tuple, bool, list, list, list]:
+    r"""
+    Compute the hypercube corners surrounding each location and their weights.
+
+    It is shared by the implementations of linear resample.
+
+    :param vol: shape = (batch, \*vol_shape) or (batch, \*vol_shape, ch)
+    :param loc: shape = (batch, \*loc_shape, n)
+    :param zero_boundary: if true, values on or outside boundary will be zeros
+    :return: a tuple of
+
+        - batch_size, int or scalar tensor if the batch size is unknown,
+        - vol_shape, tuple of n ints,
+        - has_ch, whether vol has a feature channel,
+        - loc_floor_ceil, n lists of floor and ceil coordinates,
+          each tensor is of shape (batch, \*loc_shape), dtype int32,
+        - weight_floor, n tensors of weights for floor coordinates,
+        - weight_ceil, n tensors of weights for ceil coordinates,
+          each weight is of shape (batch, \*loc_shape)
+          or (batch, \*loc_shape, 1) if vol has feature channel.
+    """
+    batch_size, vol_shape, has_ch = get_resample_shapes(vol=vol, loc=loc)
+    loc_shape = loc.shape[1:-1]
+    dim_vol = len(vol_shape)
 
     # get floor/ceil for loc and stack, then clip together
     # loc, loc_floor, loc_ceil are have shape (batch, *loc_shape, n)
@@ -314,6 +438,348 @@ def resample(
         loc_floor_ceil.append([tf.cast(c_floor, tf.int32), tf.cast(c_ceil, tf.int32)])
         weight_floor.append(w_floor)
         weight_ceil.append(w_ceil)
+    return batch_size, vol_shape, has_ch, loc_floor_ceil, weight_floor, weight_ceil
+
+
+def get_linear_index_dtype(batch_size: Union[int, tf.Tensor], num_voxels: int):
+    """
+    Return the dtype of linear indices in a flattened batch of volumes.
+
+    int32 indices wrap around silently once the batch has 2**31 voxels or more,
+    e.g. two volumes of 1024^3, int64 is therefore used for large batches,
+    or if the batch size is unknown.
+
+    :param batch_size: int or scalar tensor if the batch size is unknown.
+    :param num_voxels: number of voxels per volume.
+    :return: tf.int32 or tf.int64.
+    """
+    if isinstance(batch_size, int) and batch_size * num_voxels < 2 ** 31:
+        return tf.int32
+    return tf.int64
+
+
+def gather_weighted_sum(
+    vol: tf.Tensor,
+    batch_size: Union[int, tf.Tensor],
+    vol_shape: tuple,
+    has_ch: bool,
+    indices: List[List[tf.Tensor]],
+    weights: List[List[Optional[tf.Tensor]]],
+) -> tf.Tensor:
+    r"""
+    Sum the volume values on separable neighbourhoods weighted by their weights.
+
+    For each dimension d, indices[d] and weights[d] define the taps on axis d.
+    The value on each combination of taps is gathered with one tf.gather
+    from the flattened volume using linear indices,
+    and is accumulated with the product of the tap weights,
+    which avoids storing all values at once.
+
+    :param vol: shape = (batch, \*vol_shape) or (batch, \*vol_shape, ch)
+    :param batch_size: int or scalar tensor.
+    :param vol_shape: tuple of n ints.
+    :param has_ch: whether vol has a feature channel.
+    :param indices: n lists of tap coordinates,
+        each tensor is of shape (batch, \*loc_shape), dtype int32,
+        coordinates must be inside the volume. The linear indices are
+        of dtype int64 if the batch may have 2**31 voxels or more.
+    :param weights: n lists of tap weights of the same lengths as indices,
+        each weight is of shape (batch, \*loc_shape)
+        or (batch, \*loc_shape, 1) if vol has feature channel,
+        None means the weight is one.
+    :return: shape = (batch, \*loc_shape) or (batch, \*loc_shape, ch)
+    """
+    # strides of each axis in the flattened volume, the first one is for batch
+    # strides[d] = prod(vol_shape[d:])
+    strides = [int(np.prod(vol_shape[d:])) for d in range(len(vol_shape) + 1)]
+
+    # flatten volume, shape = (batch * prod(vol_shape), ) or (..., ch)
+    # the number of channels may be unknown, e.g. for stacked labels
+    num_ch = vol.shape[-1] if vol.shape[-1] is not None else tf.shape(vol)[-1]
+    flat_shape = [-1, num_ch] if has_ch else [-1]
+    flat_vol = tf.reshape(vol, shape=flat_shape)
+
+    # batch_offset[b, l1, ..., lm] = b * prod(vol_shape)
+    index_dtype = get_linear_index_dtype(batch_size=batch_size, num_voxels=strides[0])
+    loc_ndim = len(indices[0][0].shape) - 1
+    batch_offset = tf.reshape(
+        tf.range(batch_size, dtype=index_dtype) * strides[0], [-1] + [1] * loc_ndim
+    )  # shape = (batch, 1, ..., 1)
+
+    # offsets of the taps for each dimension
+    # each tensor has shape (batch, *loc_shape)
+    offsets = [
+        [tf.cast(c, dtype=index_dtype) * strides[dim + 1] for c in taps]
+        for dim, taps in enumerate(indices)
+    ]
+
+    # combine the taps of all dimensions but the last one, such that
+    # the partial indices and weight products are shared by the last dimension
+    prefixes: List[Tuple[tf.Tensor, Optional[tf.Tensor]]] = [(batch_offset, None)]
+    for dim in range(len(indices) - 1):
+        prefixes = [
+            (index + offset, _multiply_weights(weight, w))
+            for index, weight in prefixes
+            for offset, w in zip(offsets[dim], weights[dim])
+        ]
+
+    # accumulate values on all tap combinations weighted by the product of weights
+    sampled = None
+    for index, weight in prefixes:
+        for offset, w in zip(offsets[-1], weights[-1]):
+            value = tf.gather(flat_vol, index + offset)
+            w = _multiply_weights(weight, w)
+            value = value if w is None else value * w
+            sampled = value if sampled is None else sampled + value
+    return sampled
+
+
+def _multiply_weights(
+    weight1: Optional[tf.Tensor], weight2: Optional[tf.Tensor]
+) -> Optional[tf.Tensor]:
+    """
+    Multiply two tap weights where None means one.
+
+    :param weight1: tensor or None.
+    :param weight2: tensor or None.
+    :return: the product, None if both are None.
+    """
+    if weight1 is None:
+        return weight2
+    if weight2 is None:
+        return weight1
+    return weight1 * weight2
+
+
+def cubic_bspline_prefilter(vol: tf.Tensor, num_dims: int) -> tf.Tensor:
+    r"""
+    Compute the cubic B-spline coefficients of a volume.
+
+    The coefficients c satisfy that the cubic B-spline interpolation
+    of c on the grid equals to the volume,
+    i.e. vol[i] = (c[i-1] + 4 * c[i] + c[i+1]) / 6 along each axis.
+    The recursive inverse filter is approximated by its symmetric impulse response
+    h[k] = -6z / (1 - z^2) * z^|k| with z = sqrt(3) - 2,
+    truncated to |k| <= CUBIC_BSPLINE_PREFILTER_HALF_WIDTH,
+    and applied separably with mirror boundary.
+
+    Reference:
+
+    - Unser, Splines: a perfect fit for signal and image processing, 1999.
+
+    :param vol: shape = (batch, \*vol_shape) or (batch, \*vol_shape, ch)
+    :param num_dims: number of spatial dimensions n.
+    :return: coefficients of the same shape as vol.
+    """
+    pole = np.sqrt(3) - 2
+    half_width = CUBIC_BSPLINE_PREFILTER_HALF_WIDTH
+    for axis in range(1, num_dims + 1):
+        dim = vol.shape[axis]
+        if dim == 1:
+            # a constant signal is its own coefficients
+            continue
+        # reflect by at most dim - 1 each time so that short axes are
+        # padded with the periodic mirror extension
+        padded, pad_width = vol, 0
+        while pad_width < half_width:
+            pad = min(dim - 1, half_width - pad_width)
+            paddings = [[0, 0]] * len(vol.shape)
+            paddings[axis] = [pad, pad]
+            padded = tf.pad(padded, paddings=paddings, mode="REFLECT")
+            pad_width += pad
+        filtered = None
+        for k in range(-half_width, half_width + 1):
+            h = -6 * pole / (1 - pole ** 2) * pole ** abs(k)
+            begin = [0] * len(vol.shape)
+            begin[axis] = half_width + k
+            size = [-1] * len(vol.shape)
+            size[axis] = dim
+            value = h * tf.slice(padded, begin=begin, size=size)
+            filtered = value if filtered is None else filtered + value
+        vol = filtered
+    return vol
+
+
+def resample(
+    vol: tf.Tensor,
+    loc: tf.Tensor,
+    interpolation: str = "linear",
+    zero_boundary: bool = True,
+) -> tf.Tensor:
+    r"""
+    Sample the volume at given locations.
+
+    Input has
+
+    - volume, vol, of shape = (batch, v_dim 1, ..., v_dim n),
+      or (batch, v_dim 1, ..., v_dim n, ch),
+      where n is the dimension of volume,
+      ch is the extra dimension as features.
+
+      Denote vol_shape = (v_dim 1, ..., v_dim n)
+
+    - location, loc, of shape = (batch, l_dim 1, ..., l_dim m, n),
+      where m is the dimension of output.
+
+      Denote loc_shape = (l_dim 1, ..., l_dim m)
+
+    The supported interpolations are
+
+    - nearest, the value of the nearest voxel, using one gather.
+      Values are preserved exactly, which is suitable for warping labels,
+      but it is not differentiable with respect to the locations.
+    - linear, the weighted sum over the 2**n hypercube corners.
+    - cubic, the cubic B-spline interpolation over 4**n neighbours,
+      after computing the B-spline coefficients with cubic_bspline_prefilter.
+      It is smoother and more accurate but slower than linear.
+
+    The volume is flattened so that the values on each neighbour
+    are gathered with one tf.gather using linear indices,
+    instead of tf.gather_nd with stacked coordinates.
+    See resample_gather_nd for the previous implementation.
+
+    Reference:
+
+    - neuron's interpn
+      https://github.com/adalca/neurite/blob/legacy/neuron/utils.py
+
+      Difference
+
+      1. they dont have batch size
+      2. they support more dimensions in vol
+
+    :param vol: shape = (batch, \*vol_shape) or (batch, \*vol_shape, ch)
+      with the last channel for features
+    :param loc: shape = (batch, \*loc_shape, n)
+      such that loc[b, l1, ..., lm, :] = [v1, ..., vn] is of shape (n,),
+      which represents a point in vol, with coordinates (v1, ..., vn)
+    :param interpolation: nearest, linear, or cubic.
+    :param zero_boundary: if true, values on or outside boundary will be zeros,
+      for nearest and cubic, values outside the volume will be zeros.
+    :return: shape = (batch, \*loc_shape) or (batch, \*loc_shape, ch)
+    """
+
+    if interpolation not in RESAMPLE_INTERPOLATIONS:
+        raise ValueError(
+            f"resample supports only {RESAMPLE_INTERPOLATIONS} interpolations, "
+            f"got {interpolation}"
+        )
+
+    if interpolation == "linear":
+        (
+            batch_size,
+            vol_shape,
+            has_ch,
+            loc_floor_ceil,
+            weight_floor,
+            weight_ceil,
+        ) = get_resample_corner_weights(vol=vol, loc=loc, zero_boundary=zero_boundary)
+        return gather_weighted_sum(
+            vol=vol,
+            batch_size=batch_size,
+            vol_shape=vol_shape,
+            has_ch=has_ch,
+            indices=loc_floor_ceil,
+            weights=[list(w) for w in zip(weight_floor, weight_ceil)],
+        )
+
+    batch_size, vol_shape, has_ch = get_resample_shapes(vol=vol, loc=loc)
+    # shape = (n, ), broadcast with loc
+    dim_max = tf.cast(vol_shape, dtype=loc.dtype) - 1
+
+    if interpolation == "nearest":
+        loc_round = tf.round(loc)
+        inside = (loc_round >= 0) & (loc_round <= dim_max)
+        # shape = (batch, *loc_shape, n)
+        loc_index = tf.cast(tf.clip_by_value(loc_round, 0, dim_max), tf.int32)
+        sampled = gather_weighted_sum(
+            vol=vol,
+            batch_size=batch_size,
+            vol_shape=vol_shape,
+            has_ch=has_ch,
+            indices=[[loc_index[..., d]] for d in range(len(vol_shape))],
+            weights=[[None] for _ in vol_shape],
+        )
+    else:
+        # cubic B-spline
+        inside = (loc >= 0) & (loc <= dim_max)
+        coeff = cubic_bspline_prefilter(vol=vol, num_dims=len(vol_shape))
+        loc_floor = tf.math.floor(loc)
+        t = loc - loc_floor  # shape = (batch, *loc_shape, n)
+        loc_floor = tf.cast(loc_floor, tf.int32)
+        t2 = t * t
+        t3 = t2 * t
+        # B-spline basis of the 4 neighbours floor-1, floor, floor+1, floor+2
+        basis = [
+            (1 - t) ** 3 / 6,
+            (3 * t3 - 6 * t2 + 4) / 6,
+            (-3 * t3 + 3 * t2 + 3 * t + 1) / 6,
+            t3 / 6,
+        ]
+        indices, weights = [], []
+        for d, dim in enumerate(vol_shape):
+            taps = []
+            for shift in range(-1, 3):
+                # mirror the coordinates as the prefilter, e.g. -1 -> 1
+                index = tf.abs(loc_floor[..., d] + shift)
+                index = (dim - 1) - tf.abs((dim - 1) - index)
+                taps.append(tf.clip_by_value(index, 0, dim - 1))
+            indices.append(taps)
+            weights.append(
+                [tf.expand_dims(b[..., d], -1) if has_ch else b[..., d] for b in basis]
+            )
+        sampled = gather_weighted_sum(
+            vol=coeff,
+            batch_size=batch_size,
+            vol_shape=vol_shape,
+            has_ch=has_ch,
+            indices=indices,
+            weights=weights,
+        )
+
+    if zero_boundary:
+        # shape = (batch, *loc_shape) or (batch, *loc_shape, 1)
+        inside = tf.reduce_all(inside, axis=-1, keepdims=has_ch)
+        sampled = sampled * tf.cast(inside, dtype=sampled.dtype)
+    return sampled
+
+
+def resample_gather_nd(
+    vol: tf.Tensor,
+    loc: tf.Tensor,
+    interpolation: str = "linear",
+    zero_boundary: bool = True,
+) -> tf.Tensor:
+    r"""
+    Sample the volume at given locations using tf.gather_nd.
+
+    This is the previous implementation of resample,
+    where the values on hypercube corners are gathered with stacked coordinates
+    and combined with pyramid_combination.
+    It is kept as a reference for tests and benchmarks.
+
+    :param vol: shape = (batch, \*vol_shape) or (batch, \*vol_shape, ch)
+      with the last channel for features
+    :param loc: shape = (batch, \*loc_shape, n)
+      such that loc[b, l1, ..., lm, :] = [v1, ..., vn] is of shape (n,),
+      which represents a point in vol, with coordinates (v1, ..., vn)
+    :param interpolation: linear only
+    :param zero_boundary: if true, values on or outside boundary will be zeros
+    :return: shape = (batch, \*loc_shape) or (batch, \*loc_shape, ch)
+    """
+
+    if interpolation != "linear":
+        raise ValueError("resample supports only linear interpolation")
+
+    (
+        batch_size,
+        vol_shape,
+        _,
+        loc_floor_ceil,
+        weight_floor,
+        weight_ceil,
+    ) = get_resample_corner_weights(vol=vol, loc=loc, zero_boundary=zero_boundary)
+    loc_shape = loc.shape[1:-1]
 
     # 2**n corners, each is a list of n binary values
     corner_indices = get_n_bits_combinations(num_bits=len(vol_shape))
@@ -348,6 +814,91 @@ def resample(
     return sampled
 
 
+def get_num_integration_steps(
+    dvf: tf.Tensor, max_num_steps: int, max_step_norm: float
+) -> tf.Tensor:
+    r"""
+    Get the smallest number of scaling and squaring steps for a DVF.
+
+    The number of steps n is the smallest one such that the norm of
+    dvf / 2**n is not larger than max_step_norm for all voxels of the batch,
+    it is clipped between 0 and max_num_steps.
+
+    :param dvf: shape = (batch, \*vol_shape, n)
+    :param max_num_steps: maximum number of steps.
+    :param max_step_norm: maximum displacement norm of the scaled DVF in voxels.
+    :return: scalar tensor, dtype int32.
+    """
+    max_norm = tf.reduce_max(tf.norm(tf.stop_gradient(dvf), axis=-1))
+    num_steps = tf.math.ceil(
+        tf.math.log(tf.maximum(max_norm, max_step_norm) / max_step_norm) / np.log(2.0)
+    )
+    return tf.cast(tf.clip_by_value(num_steps, 0, max_num_steps), tf.int32)
+
+
+def integrate_dvf(
+    dvf: tf.Tensor,
+    num_steps: int = 7,
+    adaptive_steps: bool = False,
+    max_step_norm: float = 0.5,
+    gradient_checkpointing: bool = False,
+) -> tf.Tensor:
+    r"""
+    Integrate a DVF into a DDF by scaling and squaring.
+
+    The DVF is scaled by 2**-num_steps, then the field is composed with itself
+    num_steps times, ddf = ddf + resample(ddf, grid + ddf),
+    with linear interpolation and zero boundary.
+    The reference grid is computed once for all steps.
+
+    With adaptive_steps, num_steps is the maximum number of steps, and the
+    number of steps is the smallest one such that the scaled DVF has a norm
+    not larger than max_step_norm voxels, see get_num_integration_steps.
+    The steps are then run in a tf.while_loop.
+
+    With gradient_checkpointing, the resampling of each step is recomputed
+    during backpropagation, so that only the field of each step is stored
+    instead of the gathered corner values and weights.
+
+    :param dvf: shape = (batch, \*vol_shape, n)
+    :param num_steps: number of steps, or maximum number of steps
+        if adaptive_steps is true.
+    :param adaptive_steps: whether to adapt the number of steps to the DVF norm.
+    :param max_step_norm: maximum displacement norm of the scaled DVF in voxels,
+        used only if adaptive_steps is true.
+    :param gradient_checkpointing: whether to recompute the resampling
+        of each step during backpropagation.
+    :return: ddf, shape = (batch, \*vol_shape, n)
+    """
+    vol_shape = tuple(dvf.shape[1:-1])
+    # shape = (1, *vol_shape, n)
+    grid_ref = get_reference_grid(grid_size=vol_shape)[None, ...]
+
+    def compose(ddf: tf.Tensor) -> tf.Tensor:
+        return ddf + resample(vol=ddf, loc=grid_ref + ddf)
+
+    if gradient_checkpointing:
+        compose = tf.recompute_grad(compose)
+
+    if not adaptive_steps:
+        ddf = dvf / (2 ** num_steps)
+        for _ in range(num_steps):
+            ddf = compose(ddf)
+        return ddf
+
+    steps = get_num_integration_steps(
+        dvf=dvf, max_num_steps=num_steps, max_step_norm=max_step_norm
+    )
+    ddf = dvf / tf.cast(2 ** steps, dtype=dvf.dtype)
+    _, ddf = tf.while_loop(
+        cond=lambda i, _: i < steps,
+        body=lambda i, x: (i + 1, compose(x)),
+        loop_vars=(tf.constant(0), ddf),
+        maximum_iterations=num_steps,
+    )
+    return ddf
+
+
 def warp_grid(grid: tf.Tensor, theta: tf.Tensor) -> tf.Tensor:
     """
     Perform transformation on the grid.
@@ -497,3 +1048,84 @@ def deconv_output_padding(
     if dim == 1:
         return output_padding[0]
     return output_padding
+
+
+def get_patch_starts(size: int, patch_size: int, stride: int) -> List[int]:
+    """
+    Get the start coordinates of overlapping patches covering an axis.
+
+    Patches are placed every stride voxels and the last patch is aligned
+    with the end of the axis, so that all voxels are covered.
+
+    :param size: size of the axis.
+    :param patch_size: size of the patch, <= size.
+    :param stride: distance between two patches, in [1, patch_size].
+    :return: list of start coordinates.
+    """
+    if patch_size > size:
+        raise ValueError(
+            f"patch_size must not be larger than the image, "
+            f"got patch_size = {patch_size} and size = {size}"
+        )
+    if not 0 < stride <= patch_size:
+        raise ValueError(
+            f"stride must be in [1, patch_size], "
+            f"got stride = {stride} and patch_size = {patch_size}"
+        )
+    starts = list(range(0, size - patch_size + 1, stride))
+    if starts[-1] != size - patch_size:
+        starts.append(size - patch_size)
+    return starts
+
+
+def get_patch_weight(patch_size: Union[Tuple[int, ...], List[int]]) -> np.ndarray:
+    """
+    Get the weight to blend predictions on overlapping patches.
+
+    The weight is the product of tent functions along each axis,
+    so that voxels near patch borders, where the receptive field is truncated,
+    contribute less, while the weight remains positive everywhere.
+
+    :param patch_size: shape of the patch, (dim1, dim2, dim3).
+    :return: shape = patch_size
+    """
+    weight = np.ones(patch_size, dtype=np.float32)
+    for axis, size in enumerate(patch_size):
+        index = np.arange(size)
+        tent = np.minimum(index + 1, size - index).astype(np.float32)
+        shape = [1] * len(patch_size)
+        shape[axis] = size
+        weight *= tent.reshape(shape)
+    return weight
+
+
+def warp_by_slabs(
+    vol: tf.Tensor, ddf: np.ndarray, interpolation: str, slab_size: int
+) -> np.ndarray:
+    """
+    Warp a volume with a DDF slab by slab along the first axis of the DDF.
+
+    The memory of each resample is bounded by the slab size
+    instead of the size of the DDF.
+
+    :param vol: shape = (batch, m_dim1, m_dim2, m_dim3)
+        or (batch, m_dim1, m_dim2, m_dim3, ch)
+    :param ddf: shape = (batch, f_dim1, f_dim2, f_dim3, 3)
+    :param interpolation: nearest, linear, or cubic.
+    :param slab_size: number of slices of DDF warped at once.
+    :return: shape = (batch, f_dim1, f_dim2, f_dim3)
+        or (batch, f_dim1, f_dim2, f_dim3, ch)
+    """
+    fixed_image_size = ddf.shape[1:4]
+    warped = np.zeros(
+        (ddf.shape[0], *fixed_image_size, *vol.shape[4:]), dtype=np.float32
+    )
+    for start in range(0, fixed_image_size[0], slab_size):
+        end = min(start + slab_size, fixed_image_size[0])
+        # shape = (1, end - start, f_dim2, f_dim3, 3)
+        grid = get_reference_grid(grid_size=(end - start, *fixed_image_size[1:]))
+        grid = grid[None, ...] + tf.constant([start, 0, 0], dtype=grid.dtype)
+        warped[:, start:end, ...] = resample(
+            vol=vol, loc=grid + ddf[:, start:end, ...], interpolation=interpolation
+        ).numpy()
+    return warped
@@ -1,8 +1,10 @@
+import itertools
 import os
 from abc import abstractmethod
 from copy import deepcopy
-from typing import Dict, Optional, Tuple
+from typing import Dict, Optional, Tuple, Union
 
+import numpy as np
 import tensorflow as tf
 
 from deepreg import log
@@ -39,6 +41,9 @@ class RegistrationModel(tf.keras.Model):
         batch_size: int,
         config: dict,
         name: str = "RegistrationModel",
+        stack_labels: bool = False,
+        image_interpolation: str = "linear",
+        label_interpolation: str = "linear",
     ):
         """
         Init.
@@ -52,6 +57,13 @@ class RegistrationModel(tf.keras.Model):
             Therefore, input shapes should be defined over batch_size.
         :param config: config for method, backbone, and loss.
         :param name: name of the model
+        :param stack_labels: if true, labels have an extra axis for label channels,
+            all labels of a sample are warped and evaluated in one pass.
+        :param image_interpolation: interpolation to warp moving images,
+            nearest, linear, or cubic.
+        :param label_interpolation: interpolation to warp moving labels,
+            nearest, linear, or cubic. Nearest preserves label values
+            but is not differentiable, it is therefore only for prediction.
         """
         super().__init__(name=name)
         self.moving_image_size = moving_image_size
@@ -60,6 +72,9 @@ class RegistrationModel(tf.keras.Model):
         self.labeled = labeled
         self.config = config
         self.batch_size = batch_size
+        self.stack_labels = stack_labels
+        self.image_interpolation = image_interpolation
+        self.label_interpolation = label_interpolation
 
         self._inputs = None  # save inputs of self._model as dict
         self._outputs = None  # save outputs of self._model as dict
@@ -67,6 +82,8 @@ class RegistrationModel(tf.keras.Model):
         self.grid_ref = layer_util.get_reference_grid(grid_size=fixed_image_size)[
             None, ...
         ]
+        # shared by all calls of concat_images to resize moving images and labels
+        self._resize = layer.Resize3d(shape=fixed_image_size, dtype="float32")
         self._model: tf.keras.Model = self.build_model()
         self.build_loss()
 
@@ -80,6 +97,9 @@ class RegistrationModel(tf.keras.Model):
             batch_size=self.batch_size,
             config=self.config,
             name=self.name,
+            stack_labels=self.stack_labels,
+            image_interpolation=self.image_interpolation,
+            label_interpolation=self.label_interpolation,
         )
 
     @abstractmethod
@@ -116,15 +136,17 @@ class RegistrationModel(tf.keras.Model):
                 moving_image=moving_image, fixed_image=fixed_image, indices=indices
             )
 
-        # (batch, m_dim1, m_dim2, m_dim3)
+        # stacked labels have an extra axis for label channels
+        label_channel = (None,) if self.stack_labels else ()
+        # (batch, m_dim1, m_dim2, m_dim3) or (batch, m_dim1, m_dim2, m_dim3, L)
         moving_label = tf.keras.Input(
-            shape=self.moving_image_size,
+            shape=(*self.moving_image_size, *label_channel),
             batch_size=self.batch_size,
             name="moving_label",
         )
-        # (batch, m_dim1, m_dim2, m_dim3)
+        # (batch, f_dim1, f_dim2, f_dim3) or (batch, f_dim1, f_dim2, f_dim3, L)
         fixed_label = tf.keras.Input(
-            shape=self.fixed_image_size,
+            shape=(*self.fixed_image_size, *label_channel),
             batch_size=self.batch_size,
             name="fixed_label",
         )
@@ -152,11 +174,9 @@ class RegistrationModel(tf.keras.Model):
         """
         images = []
 
-        resize_layer = layer.Resize3d(shape=self.fixed_image_size)
-
         # (batch, m_dim1, m_dim2, m_dim3, 1)
         moving_image = tf.expand_dims(moving_image, axis=4)
-        moving_image = resize_layer(moving_image)
+        moving_image = self._resize(moving_image)
         images.append(moving_image)
 
         # (batch, m_dim1, m_dim2, m_dim3, 1)
@@ -166,19 +186,52 @@ class RegistrationModel(tf.keras.Model):
         # (batch, m_dim1, m_dim2, m_dim3, 1)
         if moving_label is not None:
             moving_label = tf.expand_dims(moving_label, axis=4)
-            moving_label = resize_layer(moving_label)
+            moving_label = self._resize(moving_label)
             images.append(moving_label)
 
         # (batch, f_dim1, f_dim2, f_dim3, 2 or 3)
         images = tf.concat(images, axis=4)
         return images
 
-    def _build_loss(self, name: str, inputs_dict: dict):
+    def fold_label_channels(self, label: tf.Tensor) -> tf.Tensor:
+        """
+        Fold the channels of stacked labels into the batch axis.
+
+        :param label: shape = (batch, f_dim1, f_dim2, f_dim3, L)
+        :return: shape = (batch * L, f_dim1, f_dim2, f_dim3)
+        """
+        label = tf.transpose(label, perm=[0, 4, 1, 2, 3])
+        return tf.reshape(label, shape=(-1, *self.fixed_image_size))
+
+    @staticmethod
+    def unfold_label_channels(
+        value: tf.Tensor, num_labels: Union[tf.Tensor, int]
+    ) -> tf.Tensor:
+        """
+        Average per-label values computed on labels with folded channels.
+
+        The number of labels is used instead of the batch size,
+        as the last batch might be smaller.
+
+        :param value: shape = (batch * L,), batch-major as in fold_label_channels
+        :param num_labels: number of labels L, can be a scalar tensor.
+        :return: shape = (batch,)
+        """
+        return tf.reduce_mean(tf.reshape(value, shape=(-1, num_labels)), axis=1)
+
+    def _build_loss(
+        self,
+        name: str,
+        inputs_dict: dict,
+        num_labels: Optional[Union[tf.Tensor, int]] = None,
+    ):
         """
         Build and add one weighted loss together with the metrics.
 
         :param name: name of loss, image / label / regularization.
         :param inputs_dict: inputs for loss function
+        :param num_labels: if given, the label channels of inputs have been folded
+            into the batch axis, and the loss is averaged over the labels.
         """
 
         if name not in self.config["loss"]:
@@ -219,6 +272,10 @@ class RegistrationModel(tf.keras.Model):
                 default_args={"reduction": tf.keras.losses.Reduction.NONE},
             )
             loss_value = loss_layer(**inputs_dict)
+            if num_labels is not None:
+                loss_value = self.unfold_label_channels(
+                    value=loss_value, num_labels=num_labels
+                )
             weighted_loss = loss_value * weight
 
             # add loss
@@ -261,15 +318,23 @@ class RegistrationModel(tf.keras.Model):
 
             # label loss
             pred_fixed_label = self._outputs["pred_fixed_label"]
+            num_labels = None
+            if self.stack_labels:
+                num_labels = tf.shape(fixed_label)[4]
+                fixed_label = self.fold_label_channels(fixed_label)
+                pred_fixed_label = self.fold_label_channels(pred_fixed_label)
             self._build_loss(
                 name="label",
                 inputs_dict=dict(y_true=fixed_label, y_pred=pred_fixed_label),
+                num_labels=num_labels,
             )
 
             # additional label metrics
             tre = compute_centroid_distance(
                 y_true=fixed_label, y_pred=pred_fixed_label, grid=self.grid_ref
             )
+            if self.stack_labels:
+                tre = self.unfold_label_channels(value=tre, num_labels=num_labels)
             self._model.add_metric(tre, name="metric/TRE", aggregation="mean")
 
     def call(
@@ -398,14 +463,18 @@ class DDFModel(RegistrationModel):
             self._outputs = dict(ddf=ddf, theta=theta)
         else:
             # (f_dim1, f_dim2, f_dim3, 3)
-            ddf = backbone(inputs=backbone_inputs)
+            # outputs are cast to float32 in case of mixed precision
+            ddf = tf.cast(backbone(inputs=backbone_inputs), dtype=tf.float32)
             ddf = (
                 self._resize_interpolate(ddf, control_points) if control_points else ddf
             )
             self._outputs = dict(ddf=ddf)
 
         # build outputs
-        warping = layer.Warping(fixed_image_size=self.fixed_image_size)
+        warping = layer.Warping(
+            fixed_image_size=self.fixed_image_size,
+            interpolation=self.image_interpolation,
+        )
         # (f_dim1, f_dim2, f_dim3)
         pred_fixed_image = warping(inputs=[ddf, moving_image])
         self._outputs["pred_fixed_image"] = pred_fixed_image
@@ -415,7 +484,12 @@ class DDFModel(RegistrationModel):
 
         # (f_dim1, f_dim2, f_dim3)
         moving_label = self._inputs["moving_label"]
-        pred_fixed_label = warping(inputs=[ddf, moving_label])
+        label_warping = layer.Warping(
+            fixed_image_size=self.fixed_image_size,
+            interpolation=self.label_interpolation,
+            name="label_warping",
+        )
+        pred_fixed_label = label_warping(inputs=[ddf, moving_label])
 
         self._outputs["pred_fixed_label"] = pred_fixed_label
         return tf.keras.Model(inputs=self._inputs, outputs=self._outputs)
@@ -470,6 +544,115 @@ class DDFModel(RegistrationModel):
 
         return indices, processed
 
+    def predict_tiled(
+        self, inputs: Dict[str, tf.Tensor], patch_stride: Tuple[int, ...]
+    ) -> Dict[str, np.ndarray]:
+        """
+        Predict on images larger than the model using overlapping patches.
+
+        The model is built with the patch size as fixed_image_size.
+        The moving image is resized to the fixed image shape for the backbone only,
+        then the backbone is run on batches of patches with the given stride,
+        and the predicted fields of overlapping patches are blended
+        with weights decaying towards patch borders.
+        The given moving image and label, without resizing, are warped
+        by the blended DDF slab by slab, so that the memory is bounded
+        by the patch size except for the full resolution inputs and outputs.
+        The inputs are used as given, deepreg_predict loads them
+        at their original resolution when predicting on patches.
+
+        For DVF models, DDF is integrated per patch before blending,
+        which approximates the integration on the whole image.
+
+        :param inputs: dict of inputs, the fixed image is of
+            shape = (batch, f_dim1, f_dim2, f_dim3),
+            each f_dim must not be smaller than the patch size.
+        :param patch_stride: distance between two patches per axis.
+        :return: dict of outputs, same keys as the model outputs.
+        """
+        if "theta" in self._outputs:
+            raise ValueError(
+                "Tiled prediction does not support affine transformation "
+                "predicted by global backbones."
+            )
+        patch_size = self.fixed_image_size
+        fixed_image = inputs["fixed_image"]
+        batch_size = fixed_image.shape[0]
+        image_size = tuple(fixed_image.shape[1:4])
+        moving_image = layer_util.resize3d(
+            image=inputs["moving_image"], shape=image_size
+        )
+
+        # model predicting fields only, without labels and losses
+        field_names = [name for name in ["dvf", "ddf"] if name in self._outputs]
+        field_model = tf.keras.Model(
+            inputs=[self._inputs["moving_image"], self._inputs["fixed_image"]],
+            outputs=[self._outputs[name] for name in field_names],
+        )
+
+        # (sample index, patch slices) for all patches of all samples
+        patch_slices = [
+            tuple(slice(start, start + size) for start, size in zip(starts, patch_size))
+            for starts in itertools.product(
+                *[
+                    layer_util.get_patch_starts(
+                        size=size, patch_size=p_size, stride=stride
+                    )
+                    for size, p_size, stride in zip(
+                        image_size, patch_size, patch_stride
+                    )
+                ]
+            )
+        ]
+        patches = [(b, s) for b in range(batch_size) for s in patch_slices]
+
+        # (p_dim1, p_dim2, p_dim3, 1)
+        weight = layer_util.get_patch_weight(patch_size)[..., None]
+        weight_sum = np.zeros((*image_size, 1), dtype=np.float32)
+        for slices in patch_slices:
+            weight_sum[slices] += weight
+        fields = {
+            name: np.zeros((batch_size, *image_size, 3), dtype=np.float32)
+            for name in field_names
+        }
+
+        for i in range(0, len(patches), self.batch_size):
+            batch_patches = patches[i : i + self.batch_size]
+            # the model has a fixed batch size, the last batch is padded
+            padded = batch_patches + [batch_patches[-1]] * (
+                self.batch_size - len(batch_patches)
+            )
+            preds = field_model(
+                [
+                    tf.stack([moving_image[b][s] for b, s in padded], axis=0),
+                    tf.stack([fixed_image[b][s] for b, s in padded], axis=0),
+                ],
+                training=False,
+            )
+            preds = preds if isinstance(preds, list) else [preds]
+            for name, pred in zip(field_names, preds):
+                pred = pred.numpy()
+                for j, (b, slices) in enumerate(batch_patches):
+                    fields[name][(b, *slices)] += pred[j] * weight
+        for name in field_names:
+            fields[name] /= weight_sum
+
+        outputs = dict(fields)
+        outputs["pred_fixed_image"] = layer_util.warp_by_slabs(
+            vol=inputs["moving_image"],
+            ddf=fields["ddf"],
+            interpolation=self.image_interpolation,
+            slab_size=patch_size[0],
+        )
+        if self.labeled:
+            outputs["pred_fixed_label"] = layer_util.warp_by_slabs(
+                vol=inputs["moving_label"],
+                ddf=fields["ddf"],
+                interpolation=self.label_interpolation,
+                slab_size=patch_size[0],
+            )
+        return outputs
+
 
 @REGISTRY.register_model(name="dvf")
 class DVFModel(DDFModel):
@@ -500,12 +683,20 @@ class DVFModel(DDFModel):
                 out_activation=None,
             ),
         )
-        dvf = backbone(inputs=backbone_inputs)
+        # outputs are cast to float32 in case of mixed precision
+        dvf = tf.cast(backbone(inputs=backbone_inputs), dtype=tf.float32)
         dvf = self._resize_interpolate(dvf, control_points) if control_points else dvf
-        ddf = layer.IntDVF(fixed_image_size=self.fixed_image_size)(dvf)
+        # optional arguments of the integration, e.g. num_steps or adaptive_steps
+        ddf = layer.IntDVF(
+            fixed_image_size=self.fixed_image_size,
+            **self.config.get("integration", {}),
+        )(dvf)
 
         # build outputs
-        self._warping = layer.Warping(fixed_image_size=self.fixed_image_size)
+        self._warping = layer.Warping(
+            fixed_image_size=self.fixed_image_size,
+            interpolation=self.image_interpolation,
+        )
         # (f_dim1, f_dim2, f_dim3, 3)
         pred_fixed_image = self._warping(inputs=[ddf, moving_image])
 
@@ -516,7 +707,12 @@ class DVFModel(DDFModel):
 
         # (f_dim1, f_dim2, f_dim3, 3)
         moving_label = self._inputs["moving_label"]
-        pred_fixed_label = self._warping(inputs=[ddf, moving_label])
+        label_warping = layer.Warping(
+            fixed_image_size=self.fixed_image_size,
+            interpolation=self.label_interpolation,
+            name="label_warping",
+        )
+        pred_fixed_label = label_warping(inputs=[ddf, moving_label])
 
         self._outputs["pred_fixed_label"] = pred_fixed_label
         return tf.keras.Model(inputs=self._inputs, outputs=self._outputs)
@@ -560,6 +756,11 @@ class ConditionalModel(RegistrationModel):
     def build_model(self):
         """Build the model to be saved as self._model."""
         assert self.labeled
+        if self.stack_labels:
+            raise ValueError(
+                "ConditionalModel does not support stacked labels, "
+                "please use sample_label sample or all."
+            )
 
         # build inputs
         self._inputs = self.build_inputs()
@@ -579,7 +780,8 @@ class ConditionalModel(RegistrationModel):
             ),
         )
         # (batch, f_dim1, f_dim2, f_dim3)
-        pred_fixed_label = backbone(inputs=backbone_inputs)
+        # outputs are cast to float32 in case of mixed precision
+        pred_fixed_label = tf.cast(backbone(inputs=backbone_inputs), dtype=tf.float32)
         pred_fixed_label = tf.squeeze(pred_fixed_label, axis=4)
 
         self._outputs = dict(pred_fixed_label=pred_fixed_label)
@@ -8,7 +8,7 @@ command line interface.
 import argparse
 import os
 import shutil
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import tensorflow as tf
@@ -25,6 +25,7 @@ from deepreg.util import (
     calculate_metrics,
     save_array,
     save_metric_dict,
+    set_precision_policy,
 )
 
 logger = log.get(__name__)
@@ -55,6 +56,27 @@ def build_pair_output_path(indices: list, save_dir: str) -> Tuple[str, str]:
     return pair_dir, label_dir
 
 
+def resize_inputs_to_patch(
+    inputs: Dict[str, tf.Tensor], patch_size: Tuple[int, ...]
+) -> Dict[str, tf.Tensor]:
+    """
+    Resize images and labels in a batch of inputs to the patch size.
+
+    Moving and fixed images may be of different shapes, as they are not resized
+    when predicting on patches.
+
+    :param inputs: dict of inputs, images and labels are of
+        shape = (batch, dim1, dim2, dim3) or (batch, dim1, dim2, dim3, L)
+    :param patch_size: (p_dim1, p_dim2, p_dim3)
+    :return: dict of inputs where images and labels are of
+        shape = (batch, p_dim1, p_dim2, p_dim3) or (batch, p_dim1, p_dim2, p_dim3, L)
+    """
+    return {
+        k: v if k == "indices" else layer_util.resize3d(image=v, shape=patch_size)
+        for k, v in inputs.items()
+    }
+
+
 def predict_on_dataset(
     dataset: tf.data.Dataset,
     fixed_grid_ref: tf.Tensor,
@@ -62,6 +84,7 @@ def predict_on_dataset(
     save_dir: str,
     save_nifti: bool,
     save_png: bool,
+    patch_stride: Optional[Tuple[int, ...]] = None,
 ):
     """
     Function to predict results from a dataset from some model
@@ -72,6 +95,9 @@ def predict_on_dataset(
     :param save_dir: path to store dir
     :param save_nifti: if true, outputs will be saved in nifti format
     :param save_png: if true, outputs will be saved in png format
+    :param patch_stride: if not None, the model is built on patches
+        and predicts on overlapping patches with this stride.
+        The images are then not resized and fixed_grid_ref is built per batch.
     """
     # remove the save_dir in case it exists
     if os.path.exists(save_dir):
@@ -81,7 +107,16 @@ def predict_on_dataset(
     metric_lists = []
     for _, inputs in enumerate(dataset):
         batch_size = inputs[list(inputs.keys())[0]].shape[0]
-        outputs = model.predict(x=inputs, batch_size=batch_size)
+        if patch_stride is None:
+            outputs = model.predict(x=inputs, batch_size=batch_size)
+        else:
+            outputs = model.predict_tiled(inputs=inputs, patch_stride=patch_stride)
+            fixed_grid_ref = tf.expand_dims(
+                layer_util.get_reference_grid(
+                    grid_size=tuple(inputs["fixed_image"].shape[1:4])
+                ),
+                axis=0,
+            )
         indices, processed = model.postprocess(inputs=inputs, outputs=outputs)
 
         # convert to np arrays
@@ -91,57 +126,78 @@ def predict_on_dataset(
             for k, v in processed.items()
         }
 
+        # stacked labels have an extra axis for label channels,
+        # they are saved and evaluated per label
+        stack_labels = model.labeled and len(processed["fixed_label"][0].shape) == 5
+
         # save images of inputs and outputs
         for sample_index in range(batch_size):
             # save label independent tensors under pair_dir, otherwise under label_dir
-
-            # init output path
-            indices_i = indices[sample_index, :].astype(int).tolist()
-            pair_dir, label_dir = build_pair_output_path(
-                indices=indices_i, save_dir=save_dir
+            sample_indices = indices[sample_index, :].astype(int).tolist()
+            label_indices = (
+                list(range(processed["fixed_label"][0].shape[4]))
+                if stack_labels
+                else [sample_indices[-1]]
             )
+            for label_index in label_indices:
+                # init output path
+                indices_i = sample_indices[:-1] + [label_index]
+                pair_dir, label_dir = build_pair_output_path(
+                    indices=indices_i, save_dir=save_dir
+                )
 
-            for name, (arr, normalize, on_label) in processed.items():
-                if name == "theta":
-                    np.savetxt(
-                        fname=os.path.join(pair_dir, "affine.txt"),
-                        X=arr[sample_index, :, :],
-                        delimiter=",",
+                for name, (arr, normalize, on_label) in processed.items():
+                    if not on_label and label_index != label_indices[0]:
+                        # label independent tensors have been saved
+                        continue
+                    if name == "theta":
+                        np.savetxt(
+                            fname=os.path.join(pair_dir, "affine.txt"),
+                            X=arr[sample_index, :, :],
+                            delimiter=",",
+                        )
+                        continue
+
+                    arr = arr[sample_index, ...]
+                    if stack_labels and on_label:
+                        arr = arr[..., label_index]
+                    arr_save_dir = label_dir if on_label else pair_dir
+                    save_array(
+                        save_dir=arr_save_dir,
+                        arr=arr,
+                        name=name,
+                        normalize=normalize,  # label's value is already in [0, 1]
+                        save_nifti=save_nifti,
+                        save_png=save_png,
+                        overwrite=arr_save_dir == label_dir,
                     )
-                    continue
-
-                arr_save_dir = label_dir if on_label else pair_dir
-                save_array(
-                    save_dir=arr_save_dir,
-                    arr=arr[sample_index, :, :, :],
-                    name=name,
-                    normalize=normalize,  # label's value is already in [0, 1]
-                    save_nifti=save_nifti,
-                    save_png=save_png,
-                    overwrite=arr_save_dir == label_dir,
-                )
 
-            # calculate metric
-            sample_index_str = "_".join([str(x) for x in indices_i])
-            if sample_index_str in sample_index_strs:  # pragma: no cover
-                raise ValueError(
-                    "Sample is repeated, maybe the dataset has been repeated."
+                # calculate metric
+                sample_index_str = "_".join([str(x) for x in indices_i])
+                if sample_index_str in sample_index_strs:  # pragma: no cover
+                    raise ValueError(
+                        "Sample is repeated, maybe the dataset has been repeated."
+                    )
+                sample_index_strs.append(sample_index_str)
+
+                fixed_label, pred_fixed_label = None, None
+                if model.labeled:
+                    fixed_label = processed["fixed_label"][0]
+                    pred_fixed_label = processed["pred_fixed_label"][0]
+                    if stack_labels:
+                        fixed_label = fixed_label[..., label_index]
+                        pred_fixed_label = pred_fixed_label[..., label_index]
+                metric = calculate_metrics(
+                    fixed_image=processed["fixed_image"][0],
+                    fixed_label=fixed_label,
+                    pred_fixed_image=processed["pred_fixed_image"][0],
+                    pred_fixed_label=pred_fixed_label,
+                    fixed_grid_ref=fixed_grid_ref,
+                    sample_index=sample_index,
                 )
-            sample_index_strs.append(sample_index_str)
-
-            metric = calculate_metrics(
-                fixed_image=processed["fixed_image"][0],
-                fixed_label=processed["fixed_label"][0] if model.labeled else None,
-                pred_fixed_image=processed["pred_fixed_image"][0],
-                pred_fixed_label=processed["pred_fixed_label"][0]
-                if model.labeled
-                else None,
-                fixed_grid_ref=fixed_grid_ref,
-                sample_index=sample_index,
-            )
-            metric["pair_index"] = indices_i[:-1]
-            metric["label_index"] = indices_i[-1]
-            metric_lists.append(metric)
+                metric["pair_index"] = indices_i[:-1]
+                metric["label_index"] = indices_i[-1]
+                metric_lists.append(metric)
 
     # save metric
     save_metric_dict(save_dir=save_dir, metrics=metric_lists)
@@ -195,6 +251,10 @@ def predict(
     save_nifti: bool = True,
     save_png: bool = True,
     log_dir: str = "logs",
+    image_interpolation: str = "linear",
+    label_interpolation: str = "linear",
+    patch_size: Optional[List[int]] = None,
+    patch_stride: Optional[List[int]] = None,
 ):
     """
     Function to predict some metrics from the saved model and logging results.
@@ -210,6 +270,19 @@ def predict(
     :param save_nifti: if true, outputs will be saved in nifti format.
     :param save_png: if true, outputs will be saved in png format.
     :param log_dir: path of the log directory.
+    :param image_interpolation: interpolation to warp moving images,
+        nearest, linear, or cubic.
+    :param label_interpolation: interpolation to warp moving labels,
+        nearest, linear, or cubic.
+    :param patch_size: if not None, the model is built with this image size,
+        and predicts on overlapping patches of the images and labels
+        loaded at their original resolution, which are not resized
+        to the image shape of the data config nor to the patch size.
+        As the image shapes may differ, samples are loaded one by one
+        and batch_size is the number of patches per prediction step.
+        Only supported for ddf and dvf methods with local or u-net backbones.
+    :param patch_stride: distance between two patches,
+        by default half of the patch size.
     """
 
     # env vars
@@ -238,14 +311,32 @@ def predict(
         config_path=config_path, log_dir=log_dir, exp_name=exp_name, ckpt_path=ckpt_path
     )
     config["train"]["preprocess"]["batch_size"] = batch_size
+    # patches are only sampled for training, predictions are on whole images
+    config["dataset"].pop("patch_size", None)
+    config["dataset"].pop("patch_sampling", None)
+    if patch_size is not None:
+        if config["train"]["method"] not in ["ddf", "dvf"]:
+            raise ValueError(
+                f"Prediction on patches supports only ddf and dvf methods, "
+                f"got {config['train']['method']}"
+            )
+        patch_size = tuple(patch_size)
+        if patch_stride is None:
+            patch_stride = [max(x // 2, 1) for x in patch_size]
+        patch_stride = tuple(patch_stride)
 
     # data
+    # with patches, images of different shapes are loaded one by one
+    preprocess_config = dict(config["train"]["preprocess"])
+    if patch_size is not None:
+        preprocess_config["batch_size"] = 1
     data_loader, dataset, _ = build_dataset(
         dataset_config=config["dataset"],
-        preprocess_config=config["train"]["preprocess"],
+        preprocess_config=preprocess_config,
         split=split,
         training=False,
         repeat=False,
+        resize=patch_size is None,
     )
     assert data_loader is not None
 
@@ -263,16 +354,20 @@ def predict(
             )
     else:
         strategy = tf.distribute.get_strategy()
+    set_precision_policy(precision=config["train"].get("precision", "float32"))
     with strategy.scope():
         model: tf.keras.Model = REGISTRY.build_model(
             config=dict(
                 name=config["train"]["method"],
-                moving_image_size=data_loader.moving_image_shape,
-                fixed_image_size=data_loader.fixed_image_shape,
-                index_size=data_loader.num_indices,
+                moving_image_size=patch_size or data_loader.moving_sample_shape,
+                fixed_image_size=patch_size or data_loader.fixed_sample_shape,
+                index_size=data_loader.num_sample_indices,
                 labeled=config["dataset"][split]["labeled"],
                 batch_size=batch_size,
                 config=config["train"],
+                stack_labels=data_loader.sample_label == "stack",
+                image_interpolation=image_interpolation,
+                label_interpolation=label_interpolation,
             )
         )
         optimizer = opt.build_optimizer(optimizer_config=config["train"]["optimizer"])
@@ -287,9 +382,17 @@ def predict(
         model.load_weights(ckpt_path).expect_partial()  # pragma: no cover
     else:
         # for ckpts from ckpt manager callback
+        # the model is fitted for one step before restoring,
+        # which requires inputs of the model size when predicting on patches
+        fit_dataset = dataset
+        if patch_size is not None:
+            fit_dataset = dataset.map(
+                lambda x: resize_inputs_to_patch(inputs=x, patch_size=patch_size)
+            )
+            fit_dataset = fit_dataset.unbatch().batch(batch_size)
         _, _ = build_checkpoint_callback(
             model=model,
-            dataset=dataset,
+            dataset=fit_dataset,
             log_dir=log_dir,
             save_period=config["train"]["save_period"],
             ckpt_path=ckpt_path,
@@ -297,7 +400,7 @@ def predict(
 
     # predict
     fixed_grid_ref = tf.expand_dims(
-        layer_util.get_reference_grid(grid_size=data_loader.fixed_image_shape), axis=0
+        layer_util.get_reference_grid(grid_size=data_loader.fixed_sample_shape), axis=0
     )  # shape = (1, f_dim1, f_dim2, f_dim3, 3)
     predict_on_dataset(
         dataset=dataset,
@@ -306,6 +409,7 @@ def predict(
         save_dir=os.path.join(log_dir, "test"),
         save_nifti=save_nifti,
         save_png=save_png,
+        patch_stride=patch_stride if patch_size is not None else None,
     )
 
     # close the opened files in data loaders
@@ -392,6 +496,38 @@ def main(args=None):
         default="",
     )
 
+    parser.add_argument(
+        "--image_interpolation",
+        help="Interpolation to warp moving images.",
+        choices=layer_util.RESAMPLE_INTERPOLATIONS,
+        default="linear",
+    )
+
+    parser.add_argument(
+        "--label_interpolation",
+        help="Interpolation to warp moving labels, "
+        "nearest preserves the label values.",
+        choices=layer_util.RESAMPLE_INTERPOLATIONS,
+        default="linear",
+    )
+
+    parser.add_argument(
+        "--patch_size",
+        help="Patch size to predict on overlapping patches of full images, "
+        "the model is built with this image size.",
+        type=int,
+        nargs=3,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--patch_stride",
+        help="Distance between patches, by default half of the patch size.",
+        type=int,
+        nargs=3,
+        default=None,
+    )
+
     args = parser.parse_args(args)
 
     predict(
@@ -406,6 +542,10 @@ def main(args=None):
         config_path=args.config_path,
         save_nifti=args.nifti,
         save_png=args.png,
+        image_interpolation=args.image_interpolation,
+        label_interpolation=args.label_interpolation,
+        patch_size=args.patch_size,
+        patch_stride=args.patch_stride,
     )
 
 
@@ -15,7 +15,7 @@ import deepreg.model.optimizer as opt
 from deepreg import log
 from deepreg.callback import build_checkpoint_callback
 from deepreg.registry import REGISTRY
-from deepreg.util import build_dataset, build_log_dir
+from deepreg.util import build_dataset, build_log_dir, set_precision_policy
 
 logger = log.get(__name__)
 
@@ -145,16 +145,18 @@ def train(
             )
     else:
         strategy = tf.distribute.get_strategy()
+    set_precision_policy(precision=config["train"].get("precision", "float32"))
     with strategy.scope():
         model: tf.keras.Model = REGISTRY.build_model(
             config=dict(
                 name=config["train"]["method"],
-                moving_image_size=data_loader_train.moving_image_shape,
-                fixed_image_size=data_loader_train.fixed_image_shape,
-                index_size=data_loader_train.num_indices,
+                moving_image_size=data_loader_train.moving_sample_shape,
+                fixed_image_size=data_loader_train.fixed_sample_shape,
+                index_size=data_loader_train.num_sample_indices,
                 labeled=config["dataset"]["train"]["labeled"],
                 batch_size=batch_size,
                 config=config["train"],
+                stack_labels=data_loader_train.sample_label == "stack",
             )
         )
         optimizer = opt.build_optimizer(optimizer_config=config["train"]["optimizer"])
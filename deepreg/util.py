@@ -16,6 +16,8 @@ from deepreg.dataset.loader.util import normalize_array
 
 logger = log.get(__name__)
 
+PRECISIONS = ["float32", "mixed_float16", "mixed_bfloat16"]
+
 
 def build_dataset(
     dataset_config: dict,
@@ -23,6 +25,7 @@ def build_dataset(
     split: str,
     training: bool,
     repeat: bool,
+    resize: bool = True,
 ) -> Tuple[Optional[DataLoader], Optional[tf.data.Dataset], Optional[int]]:
     """
     Function to prepare dataset for training and validation.
@@ -32,6 +35,8 @@ def build_dataset(
     :param training: bool, if true, data augmentation and shuffling will be added
     :param repeat: bool, if true, dataset will be repeated,
         true for train/valid dataset during model.fit
+    :param resize: bool, if false, images and labels are not resized
+        to the image shape of the data config.
 
     :return:
     - (data_loader_train, dataset_train, steps_per_epoch_train)
@@ -46,7 +51,7 @@ def build_dataset(
         return None, None, None
 
     dataset = data_loader.get_dataset_and_preprocess(
-        training=training, repeat=repeat, **preprocess_config
+        training=training, repeat=repeat, resize=resize, **preprocess_config
     )
     dataset_size = data_loader.num_samples
     steps_per_epoch = max(dataset_size // preprocess_config["batch_size"], 1)
@@ -72,6 +77,26 @@ def build_log_dir(log_dir: str, exp_name: str) -> str:
     return log_dir
 
 
+def set_precision_policy(precision: str):
+    """
+    Set the global Keras dtype policy for layers built afterwards.
+
+    With mixed_float16 or mixed_bfloat16, backbones are computed in half
+    precision while variables stay in float32. Resampling layers, the affine
+    head, model outputs and losses are always computed in float32.
+    With mixed_float16, the optimizer is wrapped with loss scaling by Keras.
+
+    :param precision: float32, mixed_float16, or mixed_bfloat16.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, got {precision}")
+    if hasattr(tf.keras.mixed_precision, "set_global_policy"):
+        tf.keras.mixed_precision.set_global_policy(precision)
+    else:  # pragma: no cover
+        # TensorFlow < 2.4
+        tf.keras.mixed_precision.experimental.set_policy(precision)
+
+
 def save_array(
     save_dir: str,
     arr: Union[np.ndarray, tf.Tensor],
@@ -14,6 +14,7 @@ import tensorflow as tf
 from deepreg import log
 from deepreg.dataset.loader.nifti_loader import load_nifti_file
 from deepreg.model.layer import Warping
+from deepreg.model.layer_util import RESAMPLE_INTERPOLATIONS
 
 logger = log.get(__name__)
 
@@ -38,11 +39,13 @@ def shape_sanity_check(image: np.ndarray, ddf: np.ndarray):
         )
 
 
-def warp(image_path: str, ddf_path: str, out_path: str):
+def warp(image_path: str, ddf_path: str, out_path: str, interpolation: str = "linear"):
     """
     :param image_path: file path of the image file
     :param ddf_path: file path of the ddf file
     :param out_path: file path of the output
+    :param interpolation: nearest, linear, or cubic,
+        nearest is suitable for labels as it preserves the values.
     """
     if out_path == "":
         out_path = "warped.nii.gz"
@@ -70,7 +73,9 @@ def warp(image_path: str, ddf_path: str, out_path: str):
     ddf = tf.expand_dims(ddf, axis=0)
 
     # warp
-    warped_image = Warping(fixed_image_size=fixed_image_shape)([ddf, image])
+    warped_image = Warping(
+        fixed_image_size=fixed_image_shape, interpolation=interpolation
+    )([ddf, image])
     warped_image = warped_image.numpy()
     warped_image = warped_image[0, ...]  # removed added batch dimension
 
@@ -98,9 +103,21 @@ def main(args=None):
 
     parser.add_argument("--out", "-o", help="Output path for warped image", default="")
 
+    parser.add_argument(
+        "--interpolation",
+        help="Interpolation method, nearest is suitable for labels.",
+        choices=RESAMPLE_INTERPOLATIONS,
+        default="linear",
+    )
+
     # init arguments
     args = parser.parse_args(args)
-    warp(image_path=args.image, ddf_path=args.ddf, out_path=args.out)
+    warp(
+        image_path=args.image,
+        ddf_path=args.ddf,
+        out_path=args.out,
+        interpolation=args.interpolation,
+    )
 
 
 if __name__ == "__main__":
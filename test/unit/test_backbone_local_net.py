@@ -104,6 +104,7 @@ class TestLocalNet:
             decode_num_channels=(2, 4, 8),
             strides=2,
             padding="same",
+            gradient_checkpointing=False,
             name="Test",
         )
         network = LocalNet(**config)
@@ -5,6 +5,7 @@ Tests for deepreg/model/backbone/u_net.py
 """
 from typing import Tuple
 
+import numpy as np
 import pytest
 import tensorflow as tf
 
@@ -110,6 +111,44 @@ class TestUNet:
         output = network.call(inputs)
         assert inputs.shape == output.shape
 
+    @pytest.mark.parametrize("training", [True, False])
+    def test_gradient_checkpointing(self, training: bool):
+        """
+        Test outputs and gradients are the same with gradient checkpointing.
+
+        :param training: whether the network is called in training mode.
+        """
+        image_size = (6, 6, 6)
+        inputs = tf.random.uniform(shape=(2, *image_size, 2))
+        results = []
+        weights = None
+        for gradient_checkpointing in [False, True]:
+            network = UNet(
+                image_size=image_size,
+                out_channels=3,
+                num_channel_initial=2,
+                depth=2,
+                out_kernel_initializer="he_normal",
+                out_activation=None,
+                gradient_checkpointing=gradient_checkpointing,
+            )
+            network(inputs)
+            if weights is None:
+                weights = network.get_weights()
+            else:
+                network.set_weights(weights)
+            with tf.GradientTape() as tape:
+                output = network(inputs, training=training)
+                loss = tf.reduce_sum(output ** 2)
+            grads = tape.gradient(loss, network.trainable_variables)
+            results.append((output, grads))
+
+        (output, grads), (output_ckpt, grads_ckpt) = results
+        assert np.allclose(output, output_ckpt)
+        assert len(grads) == len(grads_ckpt)
+        for grad, grad_ckpt in zip(grads, grads_ckpt):
+            assert np.allclose(grad, grad_ckpt, atol=1e-5)
+
     def test_get_config(self):
         config = dict(
             image_size=(4, 5, 6),
@@ -127,6 +166,7 @@ class TestUNet:
             decode_num_channels=(2, 4, 8),
             strides=2,
             padding="same",
+            gradient_checkpointing=True,
             name="Test",
         )
         network = UNet(**config)
@@ -91,3 +91,10 @@ class TestGetDataLoader:
         with pytest.raises(ValueError) as err_info:
             load.get_data_loader(data_config=config["dataset"], split="example")
         assert "split must be one of ['train', 'valid', 'test']" in str(err_info.value)
+
+    def test_format_dict(self):
+        """Check file loader arguments are passed when format is a dict."""
+        config = load_yaml("config/test/paired_nifti.yaml")
+        config["dataset"]["train"]["format"] = dict(name="nifti", cache_size_mb=1)
+        got = load.get_data_loader(data_config=config["dataset"], split="train")
+        assert got.loader_moving_image.cache.max_bytes == 1024 ** 2
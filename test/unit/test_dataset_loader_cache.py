@@ -0,0 +1,69 @@
+"""
+Tests for deepreg/dataset/loader/cache.py
+"""
+import pickle
+
+import numpy as np
+import pytest
+
+from deepreg.dataset.loader.cache import VolumeCache
+
+
+class TestVolumeCache:
+    def test_get_put(self):
+        cache = VolumeCache(max_bytes=100)
+        arr = np.ones((5,), dtype=np.float32)
+        assert cache.get("a") is None
+        cache.put("a", arr)
+        assert cache.get("a") is arr
+        assert cache.nbytes == 20
+        assert len(cache) == 1
+        # cached arrays are read-only
+        assert not arr.flags.writeable
+
+    def test_eviction(self):
+        cache = VolumeCache(max_bytes=60)
+        for key in ["a", "b", "c"]:
+            cache.put(key, np.ones((5,), dtype=np.float32))
+        # a is used so that b is the least recently used
+        cache.get("a")
+        cache.put("d", np.ones((5,), dtype=np.float32))
+        assert "b" not in cache
+        assert all(key in cache for key in ["a", "c", "d"])
+        assert cache.nbytes == 60
+
+    def test_overwrite(self):
+        cache = VolumeCache(max_bytes=100)
+        cache.put("a", np.ones((5,), dtype=np.float32))
+        cache.put("a", np.ones((2,), dtype=np.float32))
+        assert cache.nbytes == 8
+        assert len(cache) == 1
+
+    def test_too_large(self):
+        cache = VolumeCache(max_bytes=10)
+        cache.put("a", np.ones((5,), dtype=np.float32))
+        assert len(cache) == 0
+
+    def test_clear(self):
+        cache = VolumeCache(max_bytes=100)
+        cache.put("a", np.ones((5,), dtype=np.float32))
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.nbytes == 0
+
+    def test_pickle(self):
+        cache = VolumeCache(max_bytes=100)
+        cache.put("a", np.ones((5,), dtype=np.float32))
+        # a copy in another process starts empty with the same budget
+        got = pickle.loads(pickle.dumps(cache))
+        assert got.max_bytes == 100
+        assert len(got) == 0
+        assert got.nbytes == 0
+        got.put("b", np.ones((5,), dtype=np.float32))
+        assert "b" in got
+        assert "b" not in cache
+
+    def test_err(self):
+        with pytest.raises(ValueError) as err_info:
+            VolumeCache(max_bytes=-1)
+        assert "max_bytes must be non-negative" in str(err_info.value)
@@ -47,6 +47,40 @@ class TestNormalizeArray:
         got = util.normalize_array(arr=arr, v_min=v_min)
         assert is_equal_np(got, expected)
 
+    def test_out(self):
+        arr = np.array([[-2, 0], [1, 2]])
+        out = np.empty((2, 2), dtype=np.float32)
+        got = util.normalize_array(arr=arr, v_min=-1, v_max=1, out=out)
+        assert got is out
+        assert is_equal_np(got, np.array([[0, 0.5], [1, 1]]))
+
+    def test_out_err(self):
+        with pytest.raises(ValueError) as err_info:
+            util.normalize_array(arr=np.ones((2, 2)), out=np.ones((2, 3)))
+        assert "out must be C-contiguous and of shape (2, 2)" in str(err_info.value)
+
+    def test_large(self):
+        # arrays larger than one block are normalized block by block
+        arr = np.random.uniform(low=-3, high=5, size=(64, 64, 33)).astype(np.float32)
+        got = util.normalize_array(arr=arr, v_min=-1, v_max=4)
+        expected = (np.clip(arr, -1, 4) + 1) / 5
+        assert got.dtype == np.float32
+        assert is_equal_np(got, expected)
+
+
+@pytest.mark.parametrize("shape", [(2, 3, 4), (64, 64, 33)])
+def test_get_min_max(shape: tuple):
+    """
+    Check min and max are the same as numpy for small and blocked arrays.
+
+    :param shape: shape of the array.
+    """
+    arr = np.random.uniform(low=-3, high=5, size=shape).astype(np.float32)
+    # non contiguous arrays are supported
+    for x in [arr, arr[:, ::2, :]]:
+        got = util.get_min_max(x)
+        assert got == (np.min(x), np.max(x))
+
 
 def test_remove_prefix_suffix():
     """
@@ -2,6 +2,7 @@
 Tests functionality of the H5FileLoader
 """
 import os
+import pickle
 from test.unit.util import is_equal_np
 from typing import List
 
@@ -9,7 +10,7 @@ import h5py
 import numpy as np
 import pytest
 
-from deepreg.dataset.loader.h5_loader import H5FileLoader
+from deepreg.dataset.loader.h5_loader import H5FileLoader, convert_h5_file
 
 
 def get_loader_h5_file_names(loader: H5FileLoader) -> List[str]:
@@ -244,6 +245,12 @@ class TestH5FileLoader:
         assert got == expected
         loader.close()
 
+    def test_get_data_file_path(self):
+        loader = get_loader("unpaired")
+        got = loader.get_data_file_path(data_index=1)
+        assert got == os.path.join("./data/test/h5/unpaired/test", "images.h5")
+        loader.close()
+
     @pytest.mark.parametrize(
         "name",
         [
@@ -257,3 +264,72 @@ class TestH5FileLoader:
         loader.close()
         for f in loader.h5_files.values():
             assert not f.__bool__()
+
+    def test_reopen_in_new_process(self):
+        loader = get_loader("unpaired")
+        expected = loader.get_data(index=0)
+        handles = list(loader.h5_files.values())
+        # mimic a forked process
+        loader.pid = -1
+        got = loader.get_data(index=0)
+        assert loader.pid == os.getpid()
+        assert all(
+            new is not old for new, old in zip(loader.h5_files.values(), handles)
+        )
+        assert is_equal_np(got, expected)
+        loader.close()
+        for f in handles:
+            f.close()
+
+    def test_pickle(self):
+        loader = get_loader("unpaired")
+        expected = loader.get_data(index=0)
+        # file handles are reopened after unpickling
+        got_loader = pickle.loads(pickle.dumps(loader))
+        assert got_loader.h5_files == dict()
+        assert is_equal_np(got_loader.get_data(index=0), expected)
+        assert got_loader.pid == os.getpid()
+        got_loader.close()
+        loader.close()
+
+
+@pytest.mark.parametrize(
+    "compression,chunks",
+    [("lzf", True), ("gzip", (16, 16, 16)), (None, (8, 8))],
+)
+def test_convert_h5_file(tmp_path, compression, chunks):
+    src_dir_path = "./data/test/h5/unpaired/test"
+    dst_dir_path = str(tmp_path)
+    convert_h5_file(
+        src_file_path=os.path.join(src_dir_path, "images.h5"),
+        dst_file_path=os.path.join(dst_dir_path, "images.h5"),
+        compression=compression,
+        chunks=chunks,
+    )
+    with h5py.File(os.path.join(dst_dir_path, "images.h5"), "r") as f:
+        for dataset in f.values():
+            assert dataset.chunks is not None
+            assert dataset.compression == compression
+
+    expected = H5FileLoader(dir_paths=[src_dir_path], name="images", grouped=False)
+    got = H5FileLoader(
+        dir_paths=[dst_dir_path],
+        name="images",
+        grouped=False,
+        chunk_cache_size_mb=1,
+        swmr=True,
+    )
+    for index in range(expected.get_num_images()):
+        assert is_equal_np(got.get_data(index=index), expected.get_data(index=index))
+    got.close()
+    expected.close()
+
+
+def test_convert_h5_file_err(tmp_path):
+    with pytest.raises(ValueError) as err_info:
+        convert_h5_file(
+            src_file_path="./data/test/h5/unpaired/test/images.h5",
+            dst_file_path=os.path.join(str(tmp_path), "images.h5"),
+            compression="zip",
+        )
+    assert "compression must be lzf, gzip, blosc or None" in str(err_info.value)
@@ -5,6 +5,7 @@ Tests for deepreg/dataset/loader/interface.py
 """
 from test.unit.util import is_equal_np
 from typing import Optional, Tuple
+from unittest.mock import patch
 
 import numpy as np
 import pytest
@@ -95,6 +96,23 @@ class TestDataLoader:
                     ],
                 },
             ),
+            (
+                True,
+                (9, 9, 9),
+                (15, 15, 15),
+                2,
+                {
+                    "data_augmentation": [
+                        {"name": "affine"},
+                        {
+                            "name": "ddf",
+                            "field_strength": 1,
+                            "low_res_size": (3, 3, 3),
+                        },
+                    ],
+                    "augmentation_mode": "sample",
+                },
+            ),
         ],
     )
     def test_get_dataset_and_preprocess(
@@ -156,6 +174,103 @@ class TestDataLoader:
             )
 
 
+def test_get_dataset_and_preprocess_err():
+    """Check errors are raised for unknown augmentation mode."""
+    data_loader = PairedDataLoader(
+        file_loader=NiftiFileLoader,
+        data_dir_paths=["data/test/nifti/paired/test"],
+        labeled=True,
+        sample_label="all",
+        seed=None,
+        moving_image_shape=(9, 9, 9),
+        fixed_image_shape=(9, 9, 9),
+    )
+    with pytest.raises(ValueError) as err_info:
+        data_loader.get_dataset_and_preprocess(
+            training=True,
+            batch_size=1,
+            repeat=False,
+            shuffle_buffer_num_batch=1,
+            augmentation_mode="epoch",
+        )
+    assert "augmentation_mode must be sample or batch" in str(err_info.value)
+
+
+@pytest.mark.parametrize("patch_sampling", ["random", "foreground"])
+@pytest.mark.parametrize("sample_label", ["all", "stack"])
+def test_get_dataset_and_preprocess_patch(patch_sampling: str, sample_label: str):
+    """Check patches are cropped and their coordinates are added to indices."""
+    patch_size = (4, 5, 6)
+    data_loader = PairedDataLoader(
+        file_loader=NiftiFileLoader,
+        data_dir_paths=["data/test/nifti/paired/test"],
+        labeled=True,
+        sample_label=sample_label,
+        seed=1,
+        moving_image_shape=(9, 9, 9),
+        fixed_image_shape=(10, 11, 12),
+        patch_size=patch_size,
+        patch_sampling=patch_sampling,
+    )
+    assert data_loader.moving_sample_shape == patch_size
+    assert data_loader.fixed_sample_shape == patch_size
+    assert data_loader.num_sample_indices == data_loader.num_indices + 3
+    dataset = data_loader.get_dataset_and_preprocess(
+        training=True, batch_size=2, repeat=True, shuffle_buffer_num_batch=1
+    )
+    for outputs in dataset.take(2):
+        assert outputs["moving_image"].shape == (2, *patch_size)
+        assert outputs["fixed_image"].shape == (2, *patch_size)
+        assert outputs["moving_label"].shape[:4] == (2, *patch_size)
+        assert outputs["fixed_label"].shape[:4] == (2, *patch_size)
+        indices = outputs["indices"].numpy()
+        assert indices.shape == (2, data_loader.num_sample_indices)
+        start = indices[:, -4:-1]
+        assert np.all(start >= 0)
+        assert np.all(start <= np.array([6, 6, 6]))
+
+
+@pytest.mark.parametrize(
+    ("patch_size", "patch_sampling", "err_msg"),
+    [
+        ((4, 4), "random", "patch_size must be None or three positive integers"),
+        ((4, 0, 4), "random", "patch_size must be None or three positive integers"),
+        ((4, 4, 4), "center", "patch_sampling must be random or foreground"),
+    ],
+)
+def test_patch_err(patch_size: tuple, patch_sampling: str, err_msg: str):
+    """Check errors are raised for invalid patch arguments."""
+    with pytest.raises(ValueError) as err_info:
+        AbstractPairedDataLoader(
+            moving_image_shape=(9, 9, 9),
+            fixed_image_shape=(9, 9, 9),
+            labeled=True,
+            sample_label="sample",
+            patch_size=patch_size,
+            patch_sampling=patch_sampling,
+        )
+    assert err_msg in str(err_info.value)
+
+
+def test_patch_larger_than_image_err():
+    """Check errors are raised if patches are larger than images."""
+    data_loader = PairedDataLoader(
+        file_loader=NiftiFileLoader,
+        data_dir_paths=["data/test/nifti/paired/test"],
+        labeled=True,
+        sample_label="all",
+        seed=None,
+        moving_image_shape=(9, 9, 9),
+        fixed_image_shape=(9, 9, 9),
+        patch_size=(4, 10, 4),
+    )
+    with pytest.raises(ValueError) as err_info:
+        data_loader.get_dataset_and_preprocess(
+            training=True, batch_size=1, repeat=False, shuffle_buffer_num_batch=1
+        )
+    assert "patch_size must not be larger than the image shape" in str(err_info.value)
+
+
 def test_abstract_paired_data_loader():
     """
     Test the functions in AbstractPairedDataLoader
@@ -288,6 +403,14 @@ class TestGeneratorDataLoader:
                 assert isinstance(index, int)
                 return get_arr(seed=self.seed)
 
+            def get_data_range(self, index: int) -> None:
+                """
+                Return None as statistics are not precomputed.
+
+                :param index: not used
+                """
+                return None
+
         def mock_sample_index_generator():
             """Toy sample index generator."""
             return [[1, 1, [1]]]
@@ -317,6 +440,33 @@ class TestGeneratorDataLoader:
             }
         assert all(is_equal_np(got[key], expected[key]) for key in expected.keys())
 
+    @pytest.mark.parametrize(
+        "args,err_msg",
+        [
+            (dict(num_workers=-1), "num_workers must be non-negative"),
+            (dict(executor="coroutine"), "executor must be thread or process"),
+            (dict(pipeline="graph"), "pipeline must be generator or index"),
+            (
+                dict(pipeline="index", num_shards=2, shard_index=2),
+                "shard_index must be in [0, num_shards)",
+            ),
+            (dict(num_shards=2), "Sharding is only supported by the index pipeline"),
+            (dict(validation="sometimes"), "validation must be full, once or off"),
+            (dict(intensity_window=[1, 0]), "intensity_window must be None"),
+            (dict(intensity_window="image"), "intensity_window must be None"),
+        ],
+    )
+    def test_init_err(self, args: dict, err_msg: str):
+        """
+        Check errors are raised for wrong data loading options.
+
+        :param args: data loading options.
+        :param err_msg: expected error message.
+        """
+        with pytest.raises(ValueError) as err_info:
+            GeneratorDataLoader(labeled=True, num_indices=1, sample_label="all", **args)
+        assert err_msg in str(err_info.value)
+
     def test_sample_index_generator(self):
         loader = GeneratorDataLoader(labeled=True, num_indices=1, sample_label="all")
         with pytest.raises(NotImplementedError):
@@ -468,6 +618,137 @@ class TestGeneratorDataLoader:
             )
         assert err_msg in str(err_info.value)
 
+    @pytest.mark.parametrize(
+        "validation,num_calls", [("full", 2), ("once", 0), ("off", 0)]
+    )
+    def test_validation(self, validation: str, num_calls: int):
+        """
+        Check value ranges are validated according to the validation option.
+
+        :param validation: validation option.
+        :param num_calls: expected number of range checks on samples.
+        """
+        loader = GeneratorDataLoader(
+            labeled=True, num_indices=1, sample_label="all", validation=validation
+        )
+        with patch.object(
+            GeneratorDataLoader,
+            "validate_value_range",
+            wraps=GeneratorDataLoader.validate_value_range,
+        ) as mocked:
+            for _ in range(2):
+                got = list(
+                    loader.sample_image_label(
+                        moving_image=get_arr(),
+                        fixed_image=get_arr(),
+                        moving_label=get_arr(),
+                        fixed_label=get_arr(),
+                        image_indices=[1],
+                    )
+                )
+                assert len(got) == 1
+            assert mocked.call_count == 4 * num_calls
+
+    def test_validation_once(self):
+        """Check the values of each file are only validated once."""
+
+        class MockDataLoader:
+            """Toy data loader counting the loaded files."""
+
+            def __init__(self, arr: np.ndarray):
+                """
+                Init.
+
+                :param arr: array returned for all indices.
+                """
+                self.arr = arr
+
+            def get_data(self, index: int) -> np.ndarray:
+                """
+                Return the array despite of the index.
+
+                :param index: not used
+                :return: the array.
+                """
+                return self.arr
+
+            def get_data_range(self, index: int) -> None:
+                """
+                Return None as statistics are not precomputed.
+
+                :param index: not used
+                """
+                return None
+
+        loader = GeneratorDataLoader(
+            labeled=True, num_indices=1, sample_label="all", validation="once"
+        )
+        loader.loader_moving_image = MockDataLoader(get_arr(seed=0))
+        loader.loader_fixed_image = MockDataLoader(get_arr(seed=1))
+        loader.loader_moving_label = MockDataLoader(get_arr(seed=2))
+        loader.loader_fixed_label = MockDataLoader(get_arr(seed=3) + 1)
+        with pytest.raises(ValueError) as err_info:
+            loader.load_images(moving_index=0, fixed_index=1)
+        assert "File 1's fixed_label's values are not between [0, 1]" in str(
+            err_info.value
+        )
+
+        loader.loader_fixed_label = MockDataLoader(get_arr(seed=3))
+        for _ in range(2):
+            loader.load_images(moving_index=0, fixed_index=1)
+        assert loader.validated_files == {
+            ("moving_image", 0),
+            ("fixed_image", 1),
+            ("moving_label", 0),
+            ("fixed_label", 1),
+        }
+
+    @pytest.mark.parametrize(
+        "intensity_window,expected",
+        [
+            (None, (None, None)),
+            ([-1000, 400], (-1000, 400)),
+            ("dataset", (-2.0, 3.0)),
+        ],
+    )
+    def test_get_image_range(self, intensity_window, expected: tuple):
+        """
+        Check the window used to normalize images.
+
+        :param intensity_window: intensity_window option.
+        :param expected: expected window.
+        """
+
+        class MockDataLoader(FileLoader):
+            """Toy file loader with two images."""
+
+            def get_data(self, index: int) -> np.ndarray:
+                """
+                Return an image depending on the index.
+
+                :param index: index of the image
+                :return: the image.
+                """
+                return np.asarray([-2.0, 1.0]) if index == 0 else np.asarray([3.0])
+
+            def get_num_images(self) -> int:
+                """
+                :return: number of images.
+                """
+                return 2
+
+        loader = GeneratorDataLoader(
+            labeled=False,
+            num_indices=1,
+            sample_label="all",
+            intensity_window=intensity_window,
+        )
+        loader.loader_moving_image = MockDataLoader(
+            dir_paths=[], name="images", grouped=False
+        )
+        got = loader.get_image_range(name="moving_image", index=1)
+        assert got == expected
+
     def test_sample_image_label_unlabeled(self):
         """Test sample_image_label in unlabeled case."""
         loader = GeneratorDataLoader(labeled=False, num_indices=1, sample_label="all")
@@ -537,6 +818,34 @@ class TestGeneratorDataLoader:
             )
             assert all(is_equal_np(got[key], expected[key]) for key in expected.keys())
 
+    @pytest.mark.parametrize("shape", [(2, 3, 4), (2, 3, 4, 1), (2, 3, 4, 5)])
+    def test_sample_image_label_stack(self, shape: Tuple):
+        """
+        Test sample_image_label in labeled case with stacked labels.
+
+        :param shape: shape of the label.
+        """
+        loader = GeneratorDataLoader(labeled=True, num_indices=1, sample_label="stack")
+        got = list(
+            loader.sample_image_label(
+                moving_image=get_arr(shape=shape[:3], seed=0),
+                fixed_image=get_arr(shape=shape[:3], seed=1),
+                moving_label=get_arr(shape=shape, seed=2),
+                fixed_label=get_arr(shape=shape, seed=3),
+                image_indices=[1],
+            )
+        )
+        assert len(got) == 1
+        label_shape = (*shape[:3], shape[3] if len(shape) == 4 else 1)
+        expected = dict(
+            moving_image=get_arr(shape=shape[:3], seed=0),
+            fixed_image=get_arr(shape=shape[:3], seed=1),
+            moving_label=get_arr(shape=shape, seed=2).reshape(label_shape),
+            fixed_label=get_arr(shape=shape, seed=3).reshape(label_shape),
+            indices=np.asarray([1, 0], dtype=np.float32),
+        )
+        assert all(is_equal_np(got[0][key], expected[key]) for key in expected.keys())
+
 
 def test_file_loader():
     """
@@ -4,6 +4,8 @@
 Tests for deepreg/model/layer
 """
 
+from test.unit.util import is_equal_tf
+
 import numpy as np
 import pytest
 import tensorflow as tf
@@ -57,18 +59,27 @@ class TestWarping:
             ((1, 2, 3), (1, 2, 3)),
         ],
     )
-    def test_forward(self, moving_image_size, fixed_image_size):
+    @pytest.mark.parametrize("interpolation", ["nearest", "linear", "cubic"])
+    def test_forward(self, moving_image_size, fixed_image_size, interpolation):
         batch_size = 2
         image = tf.ones(shape=(batch_size,) + moving_image_size)
         ddf = tf.ones(shape=(batch_size,) + fixed_image_size + (3,))
-        outputs = layer.Warping(fixed_image_size=fixed_image_size)([ddf, image])
+        outputs = layer.Warping(
+            fixed_image_size=fixed_image_size, interpolation=interpolation
+        )([ddf, image])
         assert outputs.shape == (batch_size, *fixed_image_size)
 
+    def test_err(self):
+        with pytest.raises(ValueError) as err_info:
+            layer.Warping(fixed_image_size=(2, 3, 4), interpolation="bilinear")
+        assert "Warping interpolation must be one of" in str(err_info.value)
+
     def test_get_config(self):
-        warping = layer.Warping(fixed_image_size=(2, 3, 4))
+        warping = layer.Warping(fixed_image_size=(2, 3, 4), interpolation="nearest")
         config = warping.get_config()
         assert config == dict(
             fixed_image_size=(2, 3, 4),
+            interpolation="nearest",
             name="warping",
             trainable=True,
             dtype="float32",
@@ -137,6 +148,9 @@ class TestIntDVF:
         assert config == dict(
             fixed_image_size=fixed_image_size,
             num_steps=7,
+            adaptive_steps=False,
+            max_step_norm=0.5,
+            gradient_checkpointing=False,
             name="int_dvf",
             trainable=True,
             dtype="float32",
@@ -260,13 +274,7 @@ class TestBSplines3DTransform:
         model = layer.BSplines3DTransform(cp, input_size[1:-1])
 
         model.build(input_size)
-        assert model.filter.shape == (
-            4 * cp[0],
-            4 * cp[1],
-            4 * cp[2],
-            3,
-            3,
-        )
+        assert [f.shape for f in model.filters] == [(4 * c,) for c in cp]
 
     @pytest.mark.parametrize(
         "input_size,cp",
@@ -279,7 +287,36 @@ class TestBSplines3DTransform:
         model = layer.BSplines3DTransform(cp, input_size[1:-1])
         model.build(input_size)
 
-        assert np.allclose(filters, model.filter.numpy(), atol=1e-8)
+        # the dense filter is the tensor product of 1D filters on the diagonal
+        f0, f1, f2 = [f.numpy() for f in model.filters]
+        product = f0[:, None, None] * f1[None, :, None] * f2[None, None, :]
+        got = product[..., None, None] * np.eye(3)
+
+        assert np.allclose(filters, got, atol=1e-8)
+
+    @pytest.mark.parametrize(
+        "field_size,cp",
+        [((2, 5, 4, 6, 3), (8, 8, 8)), ((1, 4, 4, 4, 3), (2, 3, 4))],
+    )
+    def test_interpolate(self, field_size, cp):
+        # separable interpolation equals the transposed convolution
+        # with the dense filter
+        filters = self.generate_filter_coefficients(cp_spacing=cp)
+
+        model = layer.BSplines3DTransform(cp, (8, 8, 8))
+        model.build(field_size)
+
+        field = tf.random.normal(shape=field_size, dtype=tf.float32)
+        image_shape = tuple((a - 1) * b + 4 * b for a, b in zip(field_size[1:-1], cp))
+        expected = tf.nn.conv3d_transpose(
+            field,
+            filters,
+            output_shape=(field_size[0], *image_shape, 3),
+            strides=cp,
+            padding="VALID",
+        )
+        got = model.interpolate(field)
+        assert is_equal_tf(got, expected, atol=1e-5)
 
     @pytest.mark.parametrize(
         "input_size,cp",
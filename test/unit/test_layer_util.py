@@ -2,13 +2,15 @@
 Tests for deepreg/model/layer_util.py in
 pytest style
 """
-from test.unit.util import is_equal_tf
+from test.unit.util import is_equal_np, is_equal_tf
 from typing import Tuple, Union
 
 import numpy as np
 import pytest
 import tensorflow as tf
+from scipy import ndimage
 
+import deepreg.model.layer as layer
 import deepreg.model.layer_util as layer_util
 
 
@@ -27,6 +29,46 @@ def test_get_reference_grid():
     assert is_equal_tf(want, get)
 
 
+def test_get_reference_grid_cache():
+    """
+    Test get_reference_grid returns the same tensor for the same size,
+    which can be used across different graphs.
+    """
+    grid = layer_util.get_reference_grid(grid_size=[2, 3, 4])
+    assert layer_util.get_reference_grid(grid_size=(2, 3, 4)) is grid
+    assert layer_util.get_reference_grid(grid_size=np.array([2, 3, 4])) is grid
+    assert layer_util.get_reference_grid(grid_size=(2, 3, 5)) is not grid
+
+    @tf.function
+    def get_grid(size: int) -> tf.Tensor:
+        return layer_util.get_reference_grid(grid_size=(2, 3, 4)) + size
+
+    assert is_equal_tf(get_grid(0), grid)
+    assert is_equal_tf(get_grid(1), grid + 1)
+
+
+@pytest.mark.parametrize(
+    ("input_shape", "output_shape"),
+    [
+        ((1, 2, 3), (3, 4, 5)),
+        ((2, 1, 2, 3), (2, 3, 4, 5)),
+        ((2, 1, 2, 3, 6), (2, 3, 4, 5, 6)),
+    ],
+)
+def test_resize3d(input_shape: tuple, output_shape: tuple):
+    """
+    Test resize3d gives the same outputs as the Resize3d layer.
+
+    :param input_shape: input shape
+    :param output_shape: expected output shape
+    """
+    inputs = tf.random.uniform(shape=input_shape)
+    got = layer_util.resize3d(image=inputs, shape=(3, 4, 5))
+    expected = layer.Resize3d(shape=(3, 4, 5))(inputs)
+    assert got.shape == output_shape
+    assert is_equal_tf(got, expected)
+
+
 def test_get_n_bits_combinations():
     """
     Test get_n_bits_combinations by confirming that it generates
@@ -181,12 +223,257 @@ class TestLinearResample:
         assert "vol shape inconsistent with loc" in str(err_info.value)
 
     def test_interpolation_error(self):
-        interpolation = "nearest"
+        interpolation = "bilinear"
         vol = tf.constant(np.array([[0]], dtype=np.float32))  # shape = [1,1]
         loc = tf.constant(np.array([[0, 0], [0, 0]], dtype=np.float32))  # shape = [2,2]
         with pytest.raises(ValueError) as err_info:
             layer_util.resample(vol=vol, loc=loc, interpolation=interpolation)
-        assert "resample supports only linear interpolation" in str(err_info.value)
+        assert "resample supports only" in str(err_info.value)
+
+
+@pytest.mark.parametrize("channel", [0, 1, 3])
+@pytest.mark.parametrize("zero_boundary", [True, False])
+def test_resample_gather_nd(channel: int, zero_boundary: bool):
+    """
+    Test resample gives the same result as resample_gather_nd,
+    with locations inside and outside the volume.
+    """
+    batch_size, vol_shape, loc_shape = 2, (4, 5, 6), (3, 4, 5)
+    vol_shape_ch = vol_shape + (channel,) if channel > 0 else vol_shape
+    vol = tf.random.uniform(shape=(batch_size,) + vol_shape_ch)
+    loc = tf.random.uniform(shape=(batch_size,) + loc_shape + (3,), minval=-1, maxval=7)
+    expected = layer_util.resample_gather_nd(
+        vol=vol, loc=loc, zero_boundary=zero_boundary
+    )
+    got = layer_util.resample(vol=vol, loc=loc, zero_boundary=zero_boundary)
+    assert is_equal_tf(expected, got, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    ("batch_size", "num_voxels", "expected"),
+    [
+        (1, 2 ** 31 - 1, tf.int32),
+        (1, 2 ** 31, tf.int64),
+        (17, 512 ** 3, tf.int64),
+        (16, 512 ** 3 - 1, tf.int32),
+        (2, 1024 ** 3, tf.int64),
+        (tf.constant(1), 8, tf.int64),
+    ],
+)
+def test_get_linear_index_dtype(batch_size, num_voxels: int, expected: tf.DType):
+    """
+    Test linear indices use int64 if the batch may have 2**31 voxels or more.
+    """
+    got = layer_util.get_linear_index_dtype(
+        batch_size=batch_size, num_voxels=num_voxels
+    )
+    assert got == expected
+
+
+def test_resample_unknown_batch():
+    """
+    Test resample when the batch size is unknown, e.g. in a tf.function.
+    """
+    vol = tf.random.uniform(shape=(3, 4, 5, 6))
+    loc = tf.random.uniform(shape=(3, 3, 4, 5, 3), maxval=4)
+
+    @tf.function(
+        input_signature=[
+            tf.TensorSpec(shape=(None, 4, 5, 6), dtype=tf.float32),
+            tf.TensorSpec(shape=(None, 3, 4, 5, 3), dtype=tf.float32),
+        ]
+    )
+    def fn(v, x):
+        return layer_util.resample(vol=v, loc=x)
+
+    expected = layer_util.resample_gather_nd(vol=vol, loc=loc)
+    assert is_equal_tf(expected, fn(vol, loc), atol=1e-5)
+
+
+@pytest.mark.parametrize("channel", [0, 2])
+@pytest.mark.parametrize("zero_boundary", [True, False])
+def test_resample_nearest(channel: int, zero_boundary: bool):
+    """
+    Test nearest resample against scipy.ndimage.map_coordinates.
+    """
+    vol_shape, loc_shape = (10, 11, 12), (3, 4, 5)
+    vol = np.random.rand(2, *vol_shape).astype(np.float32)
+    loc = np.random.uniform(-2, 13, size=(2, *loc_shape, 3)).astype(np.float32)
+    expected = np.stack(
+        [
+            ndimage.map_coordinates(
+                vol[b], np.moveaxis(loc[b], -1, 0), order=0, mode="nearest"
+            )
+            for b in range(2)
+        ]
+    )
+    if zero_boundary:
+        loc_round = np.round(loc)
+        inside = (loc_round >= 0) & (loc_round <= np.array(vol_shape) - 1)
+        expected = expected * np.all(inside, axis=-1)
+    if channel > 0:
+        vol = np.repeat(vol[..., None], channel, axis=-1)
+        expected = np.repeat(expected[..., None], channel, axis=-1)
+    got = layer_util.resample(
+        vol=tf.constant(vol),
+        loc=tf.constant(loc),
+        interpolation="nearest",
+        zero_boundary=zero_boundary,
+    )
+    assert is_equal_tf(expected, got)
+
+
+@pytest.mark.parametrize("channel", [0, 2])
+def test_resample_cubic(channel: int):
+    """
+    Test cubic resample against scipy.ndimage.map_coordinates,
+    and that it interpolates the volume on the grid.
+    """
+    vol_shape, loc_shape = (10, 11, 12), (3, 4, 5)
+    vol = np.random.rand(2, *vol_shape).astype(np.float32)
+    loc = np.random.uniform(0, 9, size=(2, *loc_shape, 3)).astype(np.float32)
+    expected = np.stack(
+        [
+            ndimage.map_coordinates(
+                vol[b], np.moveaxis(loc[b], -1, 0), order=3, mode="mirror"
+            )
+            for b in range(2)
+        ]
+    )
+    grid = np.tile(layer_util.get_reference_grid(vol_shape)[None, ...], [2, 1, 1, 1, 1])
+    if channel > 0:
+        vol = np.repeat(vol[..., None], channel, axis=-1)
+        expected = np.repeat(expected[..., None], channel, axis=-1)
+    got = layer_util.resample(
+        vol=tf.constant(vol), loc=tf.constant(loc), interpolation="cubic"
+    )
+    assert is_equal_tf(expected, got, atol=1e-4)
+    got = layer_util.resample(vol=tf.constant(vol), loc=grid, interpolation="cubic")
+    assert is_equal_tf(vol, got, atol=1e-4)
+
+
+def test_resample_cubic_outside():
+    """
+    Test cubic resample is zero outside the volume if zero_boundary.
+    """
+    vol = tf.ones(shape=(1, 4, 5, 6))
+    loc = tf.constant([[[-1.0, 1.0, 1.0], [1.0, 1.0, 6.0], [1.0, 1.0, 1.0]]])
+    got = layer_util.resample(vol=vol, loc=loc, interpolation="cubic")
+    assert is_equal_tf(got, [[0.0, 0.0, 1.0]], atol=1e-4)
+
+
+class TestGetPatchStarts:
+    @pytest.mark.parametrize(
+        ("size", "patch_size", "stride", "expected"),
+        [
+            (8, 4, 2, [0, 2, 4]),
+            (9, 4, 2, [0, 2, 4, 5]),
+            (4, 4, 1, [0]),
+            (5, 2, 2, [0, 2, 3]),
+        ],
+    )
+    def test_starts(self, size, patch_size, stride, expected):
+        got = layer_util.get_patch_starts(
+            size=size, patch_size=patch_size, stride=stride
+        )
+        assert got == expected
+
+    @pytest.mark.parametrize(
+        ("size", "patch_size", "stride", "err_msg"),
+        [
+            (3, 4, 2, "patch_size must not be larger than the image"),
+            (8, 4, 0, "stride must be in [1, patch_size]"),
+            (8, 4, 5, "stride must be in [1, patch_size]"),
+        ],
+    )
+    def test_err(self, size, patch_size, stride, err_msg):
+        with pytest.raises(ValueError) as err_info:
+            layer_util.get_patch_starts(size=size, patch_size=patch_size, stride=stride)
+        assert err_msg in str(err_info.value)
+
+
+def test_get_patch_weight():
+    got = layer_util.get_patch_weight((3, 4))
+    expected = np.array([[1, 2, 2, 1], [2, 4, 4, 2], [1, 2, 2, 1]])
+    assert is_equal_np(got, expected)
+
+
+@pytest.mark.parametrize("channel", [0, 2])
+@pytest.mark.parametrize("slab_size", [1, 2, 5])
+def test_warp_by_slabs(channel: int, slab_size: int):
+    """
+    Test warp_by_slabs gives the same result as warping at once.
+    """
+    vol_shape = (2, 4, 5, 6) + ((channel,) if channel > 0 else ())
+    vol = tf.random.uniform(vol_shape)
+    ddf = np.random.uniform(-1, 1, size=(2, 5, 3, 4, 3)).astype(np.float32)
+    grid = layer_util.get_reference_grid(grid_size=(5, 3, 4))[None, ...]
+    expected = layer_util.resample(vol=vol, loc=grid + ddf)
+    got = layer_util.warp_by_slabs(
+        vol=vol, ddf=ddf, interpolation="linear", slab_size=slab_size
+    )
+    assert is_equal_tf(expected, got, atol=1e-5)
+
+
+class TestIntegrateDVF:
+    shape = (2, 6, 7, 8, 3)
+
+    @staticmethod
+    def integrate_by_warping(dvf: tf.Tensor, num_steps: int) -> tf.Tensor:
+        """Reference scaling and squaring with repeated resample."""
+        grid = layer_util.get_reference_grid(grid_size=dvf.shape[1:4])[None, ...]
+        ddf = dvf / (2 ** num_steps)
+        for _ in range(num_steps):
+            ddf = ddf + layer_util.resample(vol=ddf, loc=grid + ddf)
+        return ddf
+
+    @pytest.mark.parametrize("num_steps", [0, 1, 7])
+    def test_fixed_steps(self, num_steps: int):
+        dvf = tf.random.normal(self.shape, stddev=2.0)
+        got = layer_util.integrate_dvf(dvf=dvf, num_steps=num_steps)
+        expected = self.integrate_by_warping(dvf=dvf, num_steps=num_steps)
+        assert is_equal_tf(got, expected, atol=1e-5)
+
+    @pytest.mark.parametrize(
+        "max_norm,max_num_steps,expected",
+        [(0.0, 7, 0), (0.4, 7, 0), (0.5, 7, 0), (0.6, 7, 1), (4.0, 7, 3), (100, 4, 4)],
+    )
+    def test_get_num_integration_steps(
+        self, max_norm: float, max_num_steps: int, expected: int
+    ):
+        dvf = np.zeros(self.shape, dtype=np.float32)
+        dvf[1, 2, 3, 4] = [0, max_norm * 0.6, max_norm * 0.8]
+        got = layer_util.get_num_integration_steps(
+            dvf=tf.constant(dvf), max_num_steps=max_num_steps, max_step_norm=0.5
+        )
+        assert got == expected
+
+    @pytest.mark.parametrize("stddev", [0.1, 2.0])
+    def test_adaptive_steps(self, stddev: float):
+        dvf = tf.random.normal(self.shape, stddev=stddev)
+        num_steps = layer_util.get_num_integration_steps(
+            dvf=dvf, max_num_steps=7, max_step_norm=0.5
+        )
+        got = tf.function(layer_util.integrate_dvf)(dvf=dvf, adaptive_steps=True)
+        expected = self.integrate_by_warping(dvf=dvf, num_steps=int(num_steps))
+        assert is_equal_tf(got, expected, atol=1e-5)
+
+    @pytest.mark.parametrize("adaptive_steps", [True, False])
+    def test_gradient_checkpointing(self, adaptive_steps: bool):
+        dvf = tf.random.normal(self.shape, stddev=2.0)
+        results = []
+        for gradient_checkpointing in [False, True]:
+            with tf.GradientTape() as tape:
+                tape.watch(dvf)
+                ddf = layer_util.integrate_dvf(
+                    dvf=dvf,
+                    adaptive_steps=adaptive_steps,
+                    gradient_checkpointing=gradient_checkpointing,
+                )
+                loss = tf.reduce_sum(ddf ** 2)
+            results.append((ddf, tape.gradient(loss, dvf)))
+        assert is_equal_tf(results[0][0], results[1][0])
+        assert is_equal_tf(results[0][1], results[1][1], atol=1e-5)
 
 
 class TestWarpGrid:
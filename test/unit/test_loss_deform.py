@@ -68,6 +68,25 @@ class TestGradientNorm:
         )
         assert is_equal_tf(got, expected)
 
+    @pytest.mark.parametrize("l1", [True, False])
+    def test_values(self, l1: bool):
+        """
+        Test values against gradients calculated per channel.
+
+        :param l1: whether to calculate L1 norm.
+        """
+        tensor = tf.random.normal([2, 6, 7, 8, 3])
+        got = deform.GradientNorm(l1=l1)(tensor)
+        dfdx = deform.gradient_dxyz(tensor, deform.gradient_dx)
+        dfdy = deform.gradient_dxyz(tensor, deform.gradient_dy)
+        dfdz = deform.gradient_dxyz(tensor, deform.gradient_dz)
+        if l1:
+            norms = tf.abs(dfdx) + tf.abs(dfdy) + tf.abs(dfdz)
+        else:
+            norms = dfdx ** 2 + dfdy ** 2 + dfdz ** 2
+        expected = tf.reduce_mean(norms, axis=[1, 2, 3, 4])
+        assert is_equal_tf(got, expected)
+
     def test_get_config(self):
         got = deform.GradientNorm().get_config()
         expected = {
@@ -89,3 +108,52 @@ def test_bending_energy():
         ]
     )
     assert is_equal_tf(got, expected)
+
+
+def test_second_order_gradient_filters():
+    """Test filters are equivalent to applying central differences twice."""
+    tensor = tf.random.normal([2, 7, 8, 9])
+    filters = deform.get_second_order_gradient_filters()
+    got = tf.nn.conv3d(
+        tensor[..., None], filters=filters, strides=[1, 1, 1, 1, 1], padding="VALID"
+    )
+    dx, dy, dz = deform.gradient_dx, deform.gradient_dy, deform.gradient_dz
+    expected = tf.stack(
+        [
+            dx(dx(tensor)),
+            dy(dy(tensor)),
+            dz(dz(tensor)),
+            dy(dx(tensor)),
+            dz(dy(tensor)),
+            dz(dx(tensor)),
+        ],
+        axis=4,
+    )
+    assert is_equal_tf(got, expected)
+
+
+def test_bending_energy_values():
+    """Test values against second order gradients calculated per channel."""
+    tensor = tf.random.normal([2, 6, 7, 8, 3])
+    got = deform.BendingEnergy()(tensor)
+
+    dfdx = deform.gradient_dxyz(tensor, deform.gradient_dx)
+    dfdy = deform.gradient_dxyz(tensor, deform.gradient_dy)
+    dfdz = deform.gradient_dxyz(tensor, deform.gradient_dz)
+    dfdxx = deform.gradient_dxyz(dfdx, deform.gradient_dx)
+    dfdyy = deform.gradient_dxyz(dfdy, deform.gradient_dy)
+    dfdzz = deform.gradient_dxyz(dfdz, deform.gradient_dz)
+    dfdxy = deform.gradient_dxyz(dfdx, deform.gradient_dy)
+    dfdyz = deform.gradient_dxyz(dfdy, deform.gradient_dz)
+    dfdxz = deform.gradient_dxyz(dfdx, deform.gradient_dz)
+    energy = dfdxx ** 2 + dfdyy ** 2 + dfdzz ** 2
+    energy += 2 * dfdxy ** 2 + 2 * dfdxz ** 2 + 2 * dfdyz ** 2
+    expected = tf.reduce_mean(energy, axis=[1, 2, 3, 4])
+    assert is_equal_tf(got, expected)
+
+
+def test_bending_energy_small_volume():
+    """Test bending energy is zero if volume is smaller than the stencil."""
+    tensor = tf.random.normal([2, 4, 6, 6, 3])
+    got = deform.BendingEnergy()(tensor)
+    assert is_equal_tf(got, tf.zeros([2]))
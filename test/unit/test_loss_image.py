@@ -6,7 +6,7 @@ in image.py should be better converted into tf tensor type beforehand.
 """
 
 from test.unit.util import is_equal_tf
-from typing import Tuple
+from typing import Optional, Tuple
 
 import numpy as np
 import pytest
@@ -35,17 +35,161 @@ class TestGlobalMutualInformation:
         )
         assert is_equal_tf(got, expected)
 
+    @pytest.mark.parametrize("chunk_size", [1, 100, 999, 2000])
+    def test_chunk_size(self, chunk_size: int):
+        """
+        Test chunked histograms give the same values and gradients.
+
+        :param chunk_size: number of voxels per chunk.
+        """
+        y_true = tf.random.uniform(shape=(2, 9, 10, 11))
+        y_pred = tf.random.uniform(shape=(2, 9, 10, 11))
+
+        def value_and_grad(loss: image.GlobalMutualInformation):
+            with tf.GradientTape() as tape:
+                tape.watch(y_pred)
+                value = loss.call(y_true, y_pred)
+            return value, tape.gradient(value, y_pred)
+
+        got, got_grad = value_and_grad(
+            image.GlobalMutualInformation(chunk_size=chunk_size)
+        )
+        expected, expected_grad = value_and_grad(image.GlobalMutualInformation())
+        assert is_equal_tf(got, expected)
+        assert is_equal_tf(got_grad, expected_grad)
+
+    @pytest.mark.parametrize("chunk_size", [None, 100])
+    def test_sampling_rate(self, chunk_size: int):
+        """
+        Test sampling voxels keeps zero information for constant images.
+
+        :param chunk_size: number of voxels per chunk.
+        """
+        y_true = 0.6 * tf.ones(shape=(2, 9, 10, 11))
+        y_pred = tf.random.uniform(shape=(2, 9, 10, 11))
+        got = image.GlobalMutualInformation(
+            chunk_size=chunk_size, sampling_rate=0.5
+        ).call(y_true, y_pred)
+        assert is_equal_tf(got, tf.zeros(shape=(2,)), atol=1e-4)
+
+    @pytest.mark.parametrize(
+        ("kwargs", "msg"),
+        [
+            (dict(chunk_size=0), "chunk_size must be positive"),
+            (dict(sampling_rate=0), "sampling_rate must be in (0, 1]"),
+            (dict(sampling_rate=1.5), "sampling_rate must be in (0, 1]"),
+        ],
+    )
+    def test_err(self, kwargs: dict, msg: str):
+        """
+        Test error messages of invalid arguments.
+
+        :param kwargs: arguments of the loss.
+        :param msg: expected error message.
+        """
+        with pytest.raises(ValueError) as err_info:
+            image.GlobalMutualInformation(**kwargs)
+        assert msg in str(err_info.value)
+
     def test_get_config(self):
         got = image.GlobalMutualInformation().get_config()
         expected = dict(
             num_bins=23,
             sigma_ratio=0.5,
+            chunk_size=None,
+            sampling_rate=1.0,
             reduction=tf.keras.losses.Reduction.AUTO,
             name="GlobalMutualInformation",
         )
         assert got == expected
 
 
+class TestLocalMutualInformation:
+    @pytest.mark.parametrize("shape", [(2, 4, 4, 4), (2, 5, 6, 7), (2, 5, 6, 7, 2)])
+    def test_zero_info(self, shape: Tuple):
+        """
+        Test zero information for constant images.
+
+        :param shape: shape of input.
+        """
+        y_true = 0.6 * tf.ones(shape=shape)
+        y_pred = tf.random.uniform(shape=shape)
+        got = image.LocalMutualInformation(kernel_size=4).call(y_true, y_pred)
+        assert is_equal_tf(got, tf.zeros(shape=shape[:1]), atol=1e-4)
+
+    @pytest.mark.parametrize("chunk_size", [None, 17])
+    def test_windows(self, chunk_size: Optional[int]):
+        """
+        Test the value equals the average of GMI over windows.
+
+        The volume size is not a multiple of the kernel size.
+
+        :param chunk_size: number of voxels per chunk.
+        """
+        kernel_size = 4
+        shape = (2, 5, 6, 7)
+        y_true = tf.random.uniform(shape=shape)
+        y_pred = tf.random.uniform(shape=shape)
+        got = image.LocalMutualInformation(
+            kernel_size=kernel_size, num_bins=8, chunk_size=chunk_size
+        ).call(y_true, y_pred)
+
+        values, counts = [], []
+        for i in range(0, shape[1], kernel_size):
+            for j in range(0, shape[2], kernel_size):
+                for k in range(0, shape[3], kernel_size):
+                    window = (
+                        slice(None),
+                        slice(i, i + kernel_size),
+                        slice(j, j + kernel_size),
+                        slice(k, k + kernel_size),
+                    )
+                    values.append(
+                        image.GlobalMutualInformation(num_bins=8).call(
+                            y_true[window], y_pred[window]
+                        )
+                    )
+                    counts.append(np.prod(y_true[window].shape[1:]))
+        expected = tf.reduce_sum(tf.stack(values, axis=1) * counts, axis=1) / np.sum(
+            counts
+        )
+        assert is_equal_tf(got, expected)
+
+    def test_global(self):
+        """Test the value equals GMI if a single window covers the volume."""
+        y_true = tf.random.uniform(shape=(2, 4, 4, 4))
+        y_pred = tf.random.uniform(shape=(2, 4, 4, 4))
+        got = image.LocalMutualInformation(kernel_size=4, num_bins=23).call(
+            y_true, y_pred
+        )
+        expected = image.GlobalMutualInformation().call(y_true, y_pred)
+        assert is_equal_tf(got, expected)
+
+    @pytest.mark.parametrize(
+        ("kwargs", "err_msg"),
+        [
+            (dict(kernel_size=0), "kernel_size must be positive"),
+            (dict(sampling_rate=0.1), "does not support voxel sampling"),
+        ],
+    )
+    def test_err(self, kwargs: dict, err_msg: str):
+        with pytest.raises(ValueError) as err_info:
+            image.LocalMutualInformation(**kwargs)
+        assert err_msg in str(err_info.value)
+
+    def test_get_config(self):
+        got = image.LocalMutualInformation().get_config()
+        expected = dict(
+            kernel_size=16,
+            num_bins=12,
+            sigma_ratio=0.5,
+            chunk_size=None,
+            reduction=tf.keras.losses.Reduction.AUTO,
+            name="LocalMutualInformation",
+        )
+        assert got == expected
+
+
 @pytest.mark.parametrize("kernel_size", [3, 5, 7])
 @pytest.mark.parametrize("name", ["gaussian", "triangular", "rectangular"])
 def test_kernel_fn(kernel_size, name):
@@ -200,6 +344,33 @@ class TestLocalNormalizedCrossCorrelation:
             image.LocalNormalizedCrossCorrelation(kernel_type="constant")
         assert "Wrong kernel_type constant for LNCC loss type." in str(err_info.value)
 
+    @pytest.mark.parametrize("kernel_size", [3, 4, 9])
+    def test_summed_area(self, kernel_size: int):
+        """
+        Test summed-area tables give the same values as the separable filter.
+
+        :param kernel_size: size of the kernel.
+        """
+        y_true = tf.random.uniform(shape=(2, 6, 7, 8, 1))
+        y_pred = tf.random.uniform(shape=(2, 6, 7, 8, 1))
+        got = image.LocalNormalizedCrossCorrelation(
+            kernel_size=kernel_size, summed_area=True
+        ).calc_ncc(y_true=y_true, y_pred=y_pred)
+        expected = image.LocalNormalizedCrossCorrelation(
+            kernel_size=kernel_size
+        ).calc_ncc(y_true=y_true, y_pred=y_pred)
+        assert is_equal_tf(got, expected, atol=1e-4)
+
+    def test_summed_area_error(self):
+        """Test the error message when using summed area with a gaussian kernel."""
+        with pytest.raises(ValueError) as err_info:
+            image.LocalNormalizedCrossCorrelation(
+                kernel_type="gaussian", summed_area=True
+            )
+        assert "summed_area is only supported for rectangular kernel" in str(
+            err_info.value
+        )
+
     def test_get_config(self):
         """Test the config is saved correctly."""
         got = image.LocalNormalizedCrossCorrelation().get_config()
@@ -210,6 +381,7 @@ class TestLocalNormalizedCrossCorrelation:
             name="LocalNormalizedCrossCorrelation",
             smooth_nr=1e-5,
             smooth_dr=1e-5,
+            summed_area=False,
         )
         assert got == expected
 
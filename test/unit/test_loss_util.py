@@ -12,7 +12,7 @@ import pytest
 import tensorflow as tf
 
 from deepreg.loss.label import DiceLoss, DiceScore
-from deepreg.loss.util import MultiScaleMixin, separable_filter
+from deepreg.loss.util import MultiScaleMixin, box_filter, separable_filter
 
 
 class TestMultiScaleMixin:
@@ -21,12 +21,18 @@ class TestMultiScaleMixin:
             MultiScaleMixin(kernel="unknown")
         assert "Kernel unknown is not supported." in str(err_info.value)
 
+    def test_pyramid_err(self):
+        with pytest.raises(ValueError) as err_info:
+            MultiScaleMixin(kernel="cauchy", pyramid=True)
+        assert "Pyramid is only supported for gaussian kernel" in str(err_info.value)
+
     def test_get_config(self):
         loss = MultiScaleMixin()
         got = loss.get_config()
         expected = dict(
             scales=None,
             kernel="gaussian",
+            pyramid=False,
             reduction=tf.keras.losses.Reduction.AUTO,
             name=None,
         )
@@ -61,6 +67,28 @@ def test_negative_loss_mixin():
     assert is_equal_tf(dice_score, -dice_loss)
 
 
+@pytest.mark.parametrize("scales", [[0], [0, 1], [2, 0, 1], [0, 1, 2, 4, 8]])
+def test_multi_scale_pyramid(scales: List[float]):
+    """
+    Test the pyramid gives values close to smoothing each scale separately.
+
+    :param scales: scaling parameters.
+    """
+    # balls of different centers and radii
+    grid = np.stack(np.meshgrid(*[np.arange(40)] * 3, indexing="ij"), axis=-1)
+    y_true = np.stack(
+        [np.linalg.norm(grid - c, axis=-1) < r for c, r in [(18, 10), (22, 6)]]
+    )
+    y_pred = np.stack(
+        [np.linalg.norm(grid - c, axis=-1) < r for c, r in [(20, 12), (20, 7)]]
+    )
+    y_true = tf.constant(y_true, dtype=tf.float32)
+    y_pred = tf.constant(y_pred, dtype=tf.float32)
+    got = DiceLoss(scales=scales, pyramid=True).call(y_true=y_true, y_pred=y_pred)
+    expected = DiceLoss(scales=scales).call(y_true=y_true, y_pred=y_pred)
+    assert is_equal_tf(got, expected, atol=1e-3)
+
+
 def test_separable_filter():
     """Testing separable filter case where diagonal ones are propagated."""
     k = tf.ones(shape=(3, 3, 3, 3, 1), dtype=tf.float32)
@@ -74,3 +102,32 @@ def test_separable_filter():
     got = separable_filter(x, k)
 
     assert is_equal_tf(got, expected)
+
+
+def test_separable_filter_channels():
+    """Test channels are filtered independently."""
+    x = tf.random.uniform(shape=(2, 4, 5, 6, 3))
+    k = tf.constant([1.0, 2.0, 1.0])
+
+    got = separable_filter(x, k)
+    expected = tf.concat(
+        [separable_filter(x[..., i : i + 1], k) for i in range(3)], axis=4
+    )
+    assert is_equal_tf(got, expected)
+
+
+@pytest.mark.parametrize("kernel_size", [1, 2, 3, 4, 9])
+@pytest.mark.parametrize("num_channels", [1, 5])
+def test_box_filter(kernel_size: int, num_channels: int):
+    """
+    Test box filter is equivalent to separable filter with ones.
+
+    :param kernel_size: size of the window.
+    :param num_channels: number of channels.
+    """
+    x = tf.random.uniform(shape=(2, 4, 5, 6, num_channels))
+
+    got = box_filter(x, kernel_size=kernel_size)
+    expected = separable_filter(x, tf.ones(shape=(kernel_size,)))
+    assert got.shape == x.shape
+    assert is_equal_tf(got, expected, atol=1e-5)
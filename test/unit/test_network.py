@@ -5,12 +5,16 @@ Tests for deepreg/_model/network/ddf_dvf.py
 """
 import itertools
 from copy import deepcopy
+from test.unit.util import is_equal_tf
 from unittest.mock import MagicMock, patch
 
 import pytest
+import tensorflow as tf
 
+from deepreg.model.backbone import Backbone
 from deepreg.model.network import RegistrationModel
 from deepreg.registry import REGISTRY
+from deepreg.util import set_precision_policy
 
 moving_image_size = (1, 3, 5)
 fixed_image_size = (2, 4, 6)
@@ -41,6 +45,7 @@ config_multiple_losses = {
             {"name": "lncc", "weight": 0.1},
             {"name": "ssd", "weight": 0.1},
             {"name": "gmi", "weight": 0.1},
+            {"name": "lmi", "weight": 0.1, "kernel_size": 4},
         ],
         "label": {
             "name": "dice",
@@ -141,6 +146,9 @@ class TestRegistrationModel:
             batch_size=batch_size,
             config=dict(),
             name="RegistrationModel",
+            stack_labels=False,
+            image_interpolation="linear",
+            label_interpolation="linear",
         )
         assert got == expected
 
@@ -180,7 +188,7 @@ class TestBuildLoss:
         dict(config=config, option=0, expected=2),
         dict(config=config, option=1, expected=2),
         dict(config=config, option=2, expected=3),
-        dict(config=config_multiple_losses, option=3, expected=5),
+        dict(config=config_multiple_losses, option=3, expected=6),
     ]
 
     def test_image_loss(self, config: dict, option: int, expected: int):
@@ -318,3 +326,262 @@ class TestConditionalModel:
         )
         assert indices.shape == (batch_size, index_size)
         assert len(processed) == 5
+
+
+class TestStackLabels:
+    params = [
+        dict(method=method, backbone=backbone)
+        for method, backbone in itertools.product(["ddf", "dvf"], ["local"])
+    ]
+
+    @pytest.fixture
+    def stacked_model(self, method: str, backbone: str) -> RegistrationModel:
+        """
+        A registration model with stacked labels.
+
+        :param method: name of method
+        :param backbone: name of backbone
+        :return: the built object
+        """
+        copied = deepcopy(config)
+        copied["method"] = method
+        copied["backbone"]["name"] = backbone  # type: ignore
+        copied["backbone"].update(backbone_args[backbone])  # type: ignore
+        return REGISTRY.build_model(  # type: ignore
+            config=dict(
+                name=method,
+                moving_image_size=moving_image_size,
+                fixed_image_size=fixed_image_size,
+                index_size=index_size,
+                labeled=True,
+                batch_size=batch_size,
+                config=copied,
+                stack_labels=True,
+            )
+        )
+
+    def test_build_model(self, stacked_model, method, backbone):
+        assert stacked_model.get_config()["stack_labels"]
+        fixed_label = stacked_model._inputs["fixed_label"]
+        pred_fixed_label = stacked_model._outputs["pred_fixed_label"]
+        assert fixed_label.shape.as_list() == [batch_size, *fixed_image_size, None]
+        assert pred_fixed_label.shape[:-1] == (batch_size, *fixed_image_size)
+        assert len(stacked_model._model.losses) == 3
+
+    def test_fold_label_channels(self, stacked_model, method, backbone):
+        num_labels = 2
+        label = tf.random.uniform((batch_size, *fixed_image_size, num_labels))
+        folded = stacked_model.fold_label_channels(label)
+        assert folded.shape == (batch_size * num_labels, *fixed_image_size)
+        assert is_equal_tf(folded[1], label[0, ..., 1])
+        value = tf.range(batch_size * num_labels, dtype=tf.float32)
+        unfolded = stacked_model.unfold_label_channels(value, num_labels=num_labels)
+        assert is_equal_tf(unfolded, [0.5, 2.5, 4.5])
+        # partial batch with as many labels as the batch size
+        value = tf.range(num_labels * batch_size, dtype=tf.float32)[:batch_size]
+        unfolded = stacked_model.unfold_label_channels(value, num_labels=batch_size)
+        assert is_equal_tf(unfolded, [1.0])
+
+    def test_partial_batch(self, stacked_model, method, backbone):
+        """Test evaluating a last batch smaller than the batch size."""
+        num_labels = 3
+        inputs = dict(
+            moving_image=tf.random.uniform((1, *moving_image_size)),
+            fixed_image=tf.random.uniform((1, *fixed_image_size)),
+            moving_label=tf.random.uniform((1, *moving_image_size, num_labels)),
+            fixed_label=tf.random.uniform((1, *fixed_image_size, num_labels)),
+            indices=tf.zeros((1, index_size)),
+        )
+        stacked_model.compile(optimizer=tf.keras.optimizers.Adam())
+        logs = stacked_model.evaluate(inputs, return_dict=True, verbose=0)
+        assert all(tf.math.is_finite(value) for value in logs.values())
+
+
+class TestConditionalModelStackLabels:
+    params = [dict(backbone="local")]
+
+    def test_err(self, backbone):
+        copied = deepcopy(config)
+        copied["method"] = "conditional"
+        copied["backbone"]["name"] = backbone  # type: ignore
+        copied["backbone"].pop("control_points", None)  # type: ignore
+        copied["backbone"].update(backbone_args[backbone])  # type: ignore
+        with pytest.raises(ValueError) as err_info:
+            REGISTRY.build_model(
+                config=dict(
+                    name="conditional",
+                    moving_image_size=moving_image_size,
+                    fixed_image_size=fixed_image_size,
+                    index_size=index_size,
+                    labeled=True,
+                    batch_size=batch_size,
+                    config=copied,
+                    stack_labels=True,
+                )
+            )
+        assert "ConditionalModel does not support stacked labels" in str(err_info.value)
+
+
+class TestInterpolation:
+    params = [dict(method=method) for method in ["ddf", "dvf"]]
+
+    def test_build_model(self, method):
+        copied = deepcopy(config)
+        copied["method"] = method
+        copied["backbone"]["name"] = "local"  # type: ignore
+        copied["backbone"].update(backbone_args["local"])  # type: ignore
+        model = REGISTRY.build_model(
+            config=dict(
+                name=method,
+                moving_image_size=moving_image_size,
+                fixed_image_size=fixed_image_size,
+                index_size=index_size,
+                labeled=True,
+                batch_size=batch_size,
+                config=copied,
+                image_interpolation="cubic",
+                label_interpolation="nearest",
+            )
+        )
+        got = model.get_config()
+        assert got["image_interpolation"] == "cubic"
+        assert got["label_interpolation"] == "nearest"
+        label_warping = model._model.get_layer("label_warping")
+        assert label_warping.get_config()["interpolation"] == "nearest"
+        pred_fixed_label = model._outputs["pred_fixed_label"]
+        assert pred_fixed_label.shape == (batch_size, *fixed_image_size)
+
+
+class TestIntegration:
+    params = [dict(adaptive_steps=True), dict(adaptive_steps=False)]
+
+    def test_build_model(self, adaptive_steps):
+        copied = deepcopy(config)
+        copied["method"] = "dvf"
+        copied["backbone"]["name"] = "local"  # type: ignore
+        copied["backbone"].update(backbone_args["local"])  # type: ignore
+        copied["integration"] = dict(num_steps=4, adaptive_steps=adaptive_steps)
+        model = REGISTRY.build_model(
+            config=dict(
+                name="dvf",
+                moving_image_size=moving_image_size,
+                fixed_image_size=fixed_image_size,
+                index_size=index_size,
+                labeled=True,
+                batch_size=batch_size,
+                config=copied,
+            )
+        )
+        got = model._model.get_layer("int_dvf").get_config()
+        assert got["num_steps"] == 4
+        assert got["adaptive_steps"] == adaptive_steps
+        ddf = model._outputs["ddf"]
+        assert ddf.shape == (batch_size, *fixed_image_size, 3)
+
+
+class TestPredictTiled:
+    params = [dict(method=method) for method in ["ddf", "dvf"]]
+    patch_size = (4, 4, 4)
+
+    def build_model(self, method: str, backbone: str = "local") -> RegistrationModel:
+        copied = deepcopy(config)
+        copied["method"] = method
+        copied["backbone"]["name"] = backbone  # type: ignore
+        copied["backbone"].update(backbone_args[backbone])  # type: ignore
+        return REGISTRY.build_model(
+            config=dict(
+                name=method,
+                moving_image_size=self.patch_size,
+                fixed_image_size=self.patch_size,
+                index_size=index_size,
+                labeled=True,
+                batch_size=batch_size,
+                config=copied,
+            )
+        )
+
+    @staticmethod
+    def build_inputs(image_size: tuple) -> dict:
+        return dict(
+            moving_image=tf.random.uniform((batch_size, *image_size)),
+            fixed_image=tf.random.uniform((batch_size, *image_size)),
+            moving_label=tf.random.uniform((batch_size, *image_size)),
+            fixed_label=tf.random.uniform((batch_size, *image_size)),
+            indices=tf.zeros((batch_size, index_size)),
+        )
+
+    def test_single_patch(self, method):
+        # images of the patch size are predicted in one patch
+        model = self.build_model(method)
+        inputs = self.build_inputs(self.patch_size)
+        got = model.predict_tiled(inputs=inputs, patch_stride=(2, 2, 2))
+        expected = model._model(inputs, training=False)
+        assert got.keys() == expected.keys()
+        for name in got:
+            assert is_equal_tf(got[name], expected[name], atol=1e-5)
+
+    def test_large_image(self, method):
+        model = self.build_model(method)
+        image_size = (5, 7, 6)
+        got = model.predict_tiled(
+            inputs=self.build_inputs(image_size), patch_stride=(2, 3, 4)
+        )
+        assert got["ddf"].shape == (batch_size, *image_size, 3)
+        assert got["pred_fixed_image"].shape == (batch_size, *image_size)
+        assert got["pred_fixed_label"].shape == (batch_size, *image_size)
+
+    def test_global_err(self, method):
+        model = self.build_model(method="ddf", backbone="global")
+        with pytest.raises(ValueError) as err_info:
+            model.predict_tiled(
+                inputs=self.build_inputs(self.patch_size), patch_stride=(2, 2, 2)
+            )
+        assert "Tiled prediction does not support" in str(err_info.value)
+
+
+class TestMixedPrecision:
+    params = [
+        dict(method=method, backbone=backbone)
+        for method, backbone in [
+            ("ddf", "local"),
+            ("ddf", "global"),
+            ("dvf", "unet"),
+            ("conditional", "local"),
+        ]
+    ]
+
+    @pytest.fixture
+    def mixed_model(self, method: str, backbone: str) -> RegistrationModel:
+        copied = deepcopy(config)
+        copied["method"] = method
+        copied["backbone"]["name"] = backbone  # type: ignore
+        if method == "conditional":
+            copied["backbone"].pop("control_points", None)  # type: ignore
+        copied["backbone"].update(backbone_args[backbone])  # type: ignore
+        set_precision_policy("mixed_bfloat16")
+        try:
+            model = REGISTRY.build_model(
+                config=dict(
+                    name=method,
+                    moving_image_size=moving_image_size,
+                    fixed_image_size=fixed_image_size,
+                    index_size=index_size,
+                    labeled=True,
+                    batch_size=batch_size,
+                    config=copied,
+                )
+            )
+        finally:
+            set_precision_policy("float32")
+        return model
+
+    def test_outputs(self, mixed_model, method, backbone):
+        # outputs and losses are in float32 while the backbone is in bfloat16
+        backbone_layer = [
+            x for x in mixed_model._model.layers if isinstance(x, Backbone)
+        ][0]
+        assert backbone_layer.compute_dtype == "bfloat16"
+        for name, output in mixed_model._outputs.items():
+            assert output.dtype == tf.float32, name
+        for loss in mixed_model._model.losses:
+            assert loss.dtype == tf.float32
@@ -327,3 +327,24 @@ class TestNiftiFileLoader:
     def test_close(self, name):
         loader = get_loader(name)
         loader.close()
+
+    def test_get_data_cached(self):
+        loader = NiftiFileLoader(
+            dir_paths=["./data/test/nifti/paired/test"],
+            name="fixed_images",
+            grouped=False,
+            cache_size_mb=10,
+        )
+        first = loader.get_data(index=0)
+        assert len(loader.cache) == 1
+        # the second read is served from the cache
+        assert loader.get_data(index=0) is first
+        assert is_equal_np(first, get_loader("paired").get_data(index=0))
+        loader.close()
+        assert len(loader.cache) == 0
+
+    def test_get_data_no_cache(self):
+        loader = get_loader("paired")
+        assert loader.cache is None
+        assert loader.get_data(index=0) is not loader.get_data(index=0)
+        loader.close()
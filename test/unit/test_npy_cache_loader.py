@@ -0,0 +1,216 @@
+"""
+Tests functionality of the NpyCacheFileLoader
+"""
+import json
+import os
+import shutil
+import threading
+from functools import partial
+from test.unit.util import is_equal_np
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from deepreg.dataset.loader.nifti_loader import NiftiFileLoader
+from deepreg.dataset.loader.npy_cache_loader import (
+    MANIFEST_FILE_NAME,
+    NpyCacheFileLoader,
+    get_cache_dir_path,
+    write_file_atomically,
+)
+
+
+def test_get_cache_dir_path():
+    got = get_cache_dir_path(dir_path="data/train", name="images", cache_dir=None)
+    assert got == os.path.join("data/train", ".npy_cache", "images")
+    got = get_cache_dir_path(dir_path="data/train", name="images", cache_dir="cache")
+    assert got.startswith(os.path.join("cache", "train-"))
+    assert got.endswith("images")
+
+
+def test_write_file_atomically(tmp_path):
+    file_path = str(tmp_path / "data.json")
+    write_file_atomically(
+        file_path=file_path, write_fn=lambda file: json.dump([1], file), mode="w"
+    )
+    with open(file_path) as file:
+        assert json.load(file) == [1]
+
+    def write_fn(file):
+        file.write("[2")
+        raise RuntimeError("interrupted")
+
+    # a failed writing keeps the existing file and removes the temporary file
+    with pytest.raises(RuntimeError):
+        write_file_atomically(file_path=file_path, write_fn=write_fn, mode="w")
+    with open(file_path) as file:
+        assert json.load(file) == [1]
+    assert os.listdir(str(tmp_path)) == ["data.json"]
+
+
+def test_write_file_atomically_concurrent(tmp_path):
+    # concurrent writers of the same file do not mix their outputs
+    file_path = str(tmp_path / "data.npy")
+    arrays = [np.full((64, 64, 16), i, dtype=np.float32) for i in range(4)]
+    threads = [
+        threading.Thread(
+            target=write_file_atomically,
+            kwargs=dict(
+                file_path=file_path,
+                write_fn=partial(np.save, arr=arr),
+                mode="wb",
+            ),
+        )
+        for arr in arrays
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    got = np.load(file_path)
+    assert any(np.array_equal(got, arr) for arr in arrays)
+    assert os.listdir(str(tmp_path)) == ["data.npy"]
+
+
+class TestNpyCacheFileLoader:
+    @pytest.mark.parametrize(
+        "dir_paths,name,grouped,index",
+        [
+            (["./data/test/nifti/paired/test"], "fixed_images", False, 1),
+            (["./data/test/nifti/paired/test"], "fixed_labels", False, 0),
+            (["./data/test/nifti/unpaired/test"], "images", False, 1),
+            (
+                ["./data/test/nifti/grouped/train", "./data/test/nifti/grouped/test"],
+                "images",
+                True,
+                (1, 1),
+            ),
+        ],
+    )
+    def test_get_data(self, dir_paths, name, grouped, index, tmp_path):
+        source = NiftiFileLoader(dir_paths=dir_paths, name=name, grouped=grouped)
+        loader = NpyCacheFileLoader(
+            dir_paths=dir_paths,
+            name=name,
+            grouped=grouped,
+            source="nifti",
+            cache_dir=str(tmp_path),
+        )
+        assert loader.data_path_splits == source.data_path_splits
+        assert loader.group_struct == source.group_struct
+        assert loader.get_data_ids() == source.get_data_ids()
+        assert loader.get_num_images() == source.get_num_images()
+
+        expected = source.get_data(index=index)
+        got = loader.get_data(index=index)
+        assert isinstance(got, np.memmap)
+        assert got.dtype == np.float32
+        assert is_equal_np(got, expected)
+
+        # statistics are read from the manifest
+        assert source.get_data_range(index=index) is None
+        assert is_equal_np(
+            loader.get_data_range(index=index), [np.min(expected), np.max(expected)]
+        )
+        assert is_equal_np(loader.get_dataset_range(), source.get_dataset_range())
+        loader.close()
+        source.close()
+
+    def test_manifest(self, tmp_path):
+        dir_path = "./data/test/nifti/paired/test"
+        loader = NpyCacheFileLoader(
+            dir_paths=[dir_path],
+            name="fixed_images",
+            grouped=False,
+            cache_dir=str(tmp_path),
+        )
+        arr = NiftiFileLoader(
+            dir_paths=[dir_path], name="fixed_images", grouped=False
+        ).get_data(index=0)
+        entry = loader.manifest[0]
+        assert entry["shape"] == list(arr.shape)
+        assert np.isclose(entry["min"], np.min(arr))
+        assert np.isclose(entry["max"], np.max(arr))
+
+        # the existing cache is reused without conversion
+        cache_dir_path = get_cache_dir_path(
+            dir_path=dir_path, name="fixed_images", cache_dir=str(tmp_path)
+        )
+        mtime = os.path.getmtime(os.path.join(cache_dir_path, MANIFEST_FILE_NAME))
+        loader = NpyCacheFileLoader(
+            dir_paths=[dir_path],
+            name="fixed_images",
+            grouped=False,
+            cache_dir=str(tmp_path),
+        )
+        assert mtime == os.path.getmtime(
+            os.path.join(cache_dir_path, MANIFEST_FILE_NAME)
+        )
+        assert loader.manifest[0] == entry
+
+    def test_source_updated(self, tmp_path):
+        dir_path = str(tmp_path / "data")
+        shutil.copytree("./data/test/nifti/paired/test", dir_path)
+        cache_dir = str(tmp_path / "cache")
+        loader = NpyCacheFileLoader(
+            dir_paths=[dir_path],
+            name="fixed_images",
+            grouped=False,
+            cache_dir=cache_dir,
+        )
+        source = NiftiFileLoader(
+            dir_paths=[dir_path], name="fixed_images", grouped=False
+        )
+        file_path = source.get_data_file_path(data_index=0)
+        stat = os.stat(file_path)
+        assert loader.manifest[0]["mtime_ns"] == stat.st_mtime_ns
+        assert loader.manifest[0]["size"] == stat.st_size
+
+        # touching a source file triggers the conversion
+        mtime_ns = stat.st_mtime_ns + 10 ** 9
+        os.utime(file_path, ns=(mtime_ns, mtime_ns))
+        loader = NpyCacheFileLoader(
+            dir_paths=[dir_path],
+            name="fixed_images",
+            grouped=False,
+            cache_dir=cache_dir,
+        )
+        assert loader.manifest[0]["mtime_ns"] == mtime_ns
+
+        # rewriting a source file updates the cached array
+        arr = source.get_data(index=0)
+        nib.save(img=nib.Nifti1Image(arr * 2 + 1, affine=np.eye(4)), filename=file_path)
+        loader = NpyCacheFileLoader(
+            dir_paths=[dir_path],
+            name="fixed_images",
+            grouped=False,
+            cache_dir=cache_dir,
+        )
+        assert is_equal_np(loader.get_data(index=0), arr * 2 + 1)
+        loader.close()
+        source.close()
+
+    def test_source_err(self, tmp_path):
+        with pytest.raises(ValueError) as err_info:
+            NpyCacheFileLoader(
+                dir_paths=["./data/test/nifti/paired/test"],
+                name="fixed_images",
+                grouped=False,
+                source="npy_cache",
+                cache_dir=str(tmp_path),
+            )
+        assert "The source of npy_cache can not be npy_cache" in str(err_info.value)
+
+    def test_get_data_err(self, tmp_path):
+        loader = NpyCacheFileLoader(
+            dir_paths=["./data/test/nifti/paired/test"],
+            name="fixed_images",
+            grouped=False,
+            cache_dir=str(tmp_path),
+        )
+        with pytest.raises(ValueError) as err_info:
+            loader.get_data(index="wrong")
+        assert "index for NpyCacheFileLoader.get_data must be int" in str(
+            err_info.value
+        )
@@ -1,11 +1,13 @@
 """
 Tests functionality of the PairedDataLoader
 """
+from functools import partial
 from os.path import join
 
 import numpy as np
 import pytest
 
+from deepreg.dataset.loader import interface
 from deepreg.dataset.loader.h5_loader import H5FileLoader
 from deepreg.dataset.loader.nifti_loader import NiftiFileLoader
 from deepreg.dataset.loader.paired_loader import PairedDataLoader
@@ -159,3 +161,143 @@ def test_close():
                 data_loader.close()
                 for f in data_loader.loader_moving_image.h5_files.values():
                     assert not f.__bool__()
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_data_generator_with_workers(executor: str):
+    """
+    Check that decoding with a pool of workers yields
+    the same samples in the same order as the sequential decoding.
+    """
+    common_args = dict(
+        file_loader=NiftiFileLoader,
+        data_dir_paths=[join(DataPaths["nifti"], "train")],
+        labeled=True,
+        sample_label="all",
+        seed=0,
+        fixed_image_shape=fixed_image_shape,
+        moving_image_shape=moving_image_shape,
+    )
+    expected = list(PairedDataLoader(**common_args).data_generator())
+    data_loader = PairedDataLoader(num_workers=2, executor=executor, **common_args)
+    got = list(data_loader.data_generator())
+    assert len(got) == len(expected)
+    for got_sample, expected_sample in zip(got, expected):
+        assert got_sample.keys() == expected_sample.keys()
+        for key in expected_sample.keys():
+            assert np.array_equal(got_sample[key], expected_sample[key])
+    data_loader.close()
+
+
+@pytest.mark.parametrize("labeled", [True, False])
+def test_index_pipeline(labeled: bool):
+    """
+    Check that the index pipeline yields
+    the same samples in the same order as the generator pipeline.
+    """
+    common_args = dict(
+        file_loader=NiftiFileLoader,
+        data_dir_paths=[join(DataPaths["nifti"], "test")],
+        labeled=labeled,
+        sample_label="all",
+        seed=0,
+        fixed_image_shape=fixed_image_shape,
+        moving_image_shape=moving_image_shape,
+    )
+    expected = list(PairedDataLoader(**common_args).get_dataset().as_numpy_iterator())
+    data_loader = PairedDataLoader(pipeline="index", **common_args)
+    got = list(data_loader.get_dataset().as_numpy_iterator())
+    assert len(got) == len(expected)
+    for got_sample, expected_sample in zip(got, expected):
+        assert got_sample.keys() == expected_sample.keys()
+        for key in expected_sample.keys():
+            assert np.array_equal(got_sample[key], expected_sample[key])
+    data_loader.close()
+
+
+def test_index_pipeline_shard():
+    """Check that shards of the index pipeline partition the samples."""
+    common_args = dict(
+        file_loader=NiftiFileLoader,
+        data_dir_paths=[join(DataPaths["nifti"], "train")],
+        labeled=False,
+        sample_label="all",
+        seed=0,
+        fixed_image_shape=fixed_image_shape,
+        moving_image_shape=moving_image_shape,
+        pipeline="index",
+    )
+    num_samples = PairedDataLoader(**common_args).num_samples
+    image_indices = []
+    for shard_index in range(2):
+        data_loader = PairedDataLoader(
+            num_shards=2, shard_index=shard_index, **common_args
+        )
+        image_indices += [
+            int(x["indices"][0]) for x in data_loader.get_dataset().as_numpy_iterator()
+        ]
+    assert sorted(image_indices) == list(range(num_samples))
+
+
+def get_worker_cache_size() -> int:
+    """
+    Return the number of volumes cached by the file loader of a worker process.
+
+    :return: number of cached moving images.
+    """
+    return len(interface._worker_data_loader.loader_moving_image.cache)
+
+
+def test_data_generator_reuse_workers():
+    """Check that the pool of workers and their caches are reused across epochs."""
+    data_loader = PairedDataLoader(
+        file_loader=partial(NiftiFileLoader, cache_size_mb=256),
+        data_dir_paths=[join(DataPaths["nifti"], "train")],
+        labeled=True,
+        sample_label="all",
+        seed=0,
+        fixed_image_shape=fixed_image_shape,
+        moving_image_shape=moving_image_shape,
+        num_workers=1,
+        executor="process",
+    )
+    expected = list(data_loader.data_generator())
+    executor = data_loader.get_executor()
+    num_cached = executor.submit(get_worker_cache_size).result()
+    assert num_cached == data_loader.num_images
+
+    # the second epoch is decoded by the same worker, reading from its cache
+    got = list(data_loader.data_generator())
+    assert data_loader.get_executor() is executor
+    assert executor.submit(get_worker_cache_size).result() == num_cached
+    assert len(got) == len(expected)
+    for got_sample, expected_sample in zip(got, expected):
+        for key in expected_sample.keys():
+            assert np.array_equal(got_sample[key], expected_sample[key])
+
+    data_loader.close()
+    assert data_loader._executor is None
+
+
+def test_index_pipeline_shuffle():
+    """Check that shuffling the indices of the index pipeline keeps all samples."""
+    data_loader = PairedDataLoader(
+        file_loader=NiftiFileLoader,
+        data_dir_paths=[join(DataPaths["nifti"], "train")],
+        labeled=True,
+        sample_label="all",
+        seed=0,
+        fixed_image_shape=fixed_image_shape,
+        moving_image_shape=moving_image_shape,
+        pipeline="index",
+    )
+    assert data_loader.shuffle_indices
+    expected = [
+        tuple(x["indices"]) for x in data_loader.get_dataset().as_numpy_iterator()
+    ]
+    got = [
+        tuple(x["indices"])
+        for x in data_loader.get_dataset(shuffle_buffer_size=4).as_numpy_iterator()
+    ]
+    assert sorted(got) == sorted(expected)
+    data_loader.close()
@@ -8,7 +8,9 @@ pytest style
 import os
 import shutil
 
-from deepreg.predict import build_config, build_pair_output_path
+import tensorflow as tf
+
+from deepreg.predict import build_config, build_pair_output_path, resize_inputs_to_patch
 
 
 def test_build_pair_output_path():
@@ -62,3 +64,17 @@ def test_build_config():
 def test_predict_on_dataset():
     # predict_on_dataset is tested in test_train/test_train_and_predict
     pass
+
+
+def test_resize_inputs_to_patch():
+    inputs = dict(
+        moving_image=tf.ones((2, 5, 6, 7)),
+        fixed_image=tf.ones((2, 8, 9, 10)),
+        moving_label=tf.ones((2, 5, 6, 7, 3)),
+        indices=tf.ones((2, 3)),
+    )
+    got = resize_inputs_to_patch(inputs=inputs, patch_size=(2, 3, 4))
+    assert got["moving_image"].shape == (2, 2, 3, 4)
+    assert got["fixed_image"].shape == (2, 2, 3, 4)
+    assert got["moving_label"].shape == (2, 2, 3, 4, 3)
+    assert got["indices"].shape == (2, 3)
@@ -67,6 +67,98 @@ def test_resize_inputs(
         assert outputs[k].shape == expected_shape
 
 
+def test_resize_inputs_stacked_labels():
+    """Check return shapes when labels have an extra axis for label channels."""
+    num_labels = 3
+    inputs = dict(
+        moving_image=tf.random.uniform((1, 2, 3)),
+        fixed_image=tf.random.uniform((2, 3, 4)),
+        moving_label=tf.random.uniform((1, 2, 3, num_labels)),
+        fixed_label=tf.random.uniform((2, 3, 4, num_labels)),
+        indices=tf.ones((2,)),
+    )
+    outputs = preprocess.resize_inputs(inputs, (3, 4, 5), (4, 5, 6))
+    assert outputs["moving_image"].shape == (3, 4, 5)
+    assert outputs["fixed_image"].shape == (4, 5, 6)
+    assert outputs["moving_label"].shape == (3, 4, 5, num_labels)
+    assert outputs["fixed_label"].shape == (4, 5, 6, num_labels)
+
+
+class TestSamplePatch:
+    image_size = (8, 9, 10)
+    patch_size = (3, 4, 5)
+
+    def get_inputs(self, num_labels: int = 0) -> dict:
+        label_size = self.image_size + ((num_labels,) if num_labels else ())
+        # the value of each voxel encodes its coordinates
+        image = tf.reshape(
+            tf.range(np.prod(self.image_size), dtype=tf.float32), self.image_size
+        )
+        return dict(
+            moving_image=image,
+            fixed_image=image + 1,
+            moving_label=tf.zeros(label_size),
+            fixed_label=tf.zeros(label_size),
+            indices=tf.constant([7.0, 8.0]),
+        )
+
+    @pytest.mark.parametrize("num_labels", [0, 2])
+    def test_random(self, num_labels: int):
+        inputs = self.get_inputs(num_labels)
+        outputs = preprocess.sample_patch(
+            inputs=inputs, patch_size=self.patch_size, seed=tf.constant([1, 2])
+        )
+        assert outputs["moving_image"].shape == self.patch_size
+        assert outputs["fixed_label"].shape[:3] == self.patch_size
+        indices = outputs["indices"].numpy()
+        assert indices[0] == 7 and indices[-1] == 8
+        start = indices[1:4].astype(int)
+        assert np.all(start >= 0)
+        assert np.all(start + self.patch_size <= self.image_size)
+        expected = inputs["moving_image"].numpy()[
+            tuple(slice(s, s + p) for s, p in zip(start, self.patch_size))
+        ]
+        assert is_equal_np(outputs["moving_image"], expected)
+        assert is_equal_np(outputs["fixed_image"], expected + 1)
+
+    def test_seed(self):
+        inputs = self.get_inputs()
+        got = [
+            preprocess.sample_patch(
+                inputs=inputs, patch_size=self.patch_size, seed=tf.constant(seed)
+            )["indices"]
+            for seed in [[1, 2], [1, 2]]
+        ]
+        assert is_equal_tf(got[0], got[1])
+
+    @pytest.mark.parametrize("num_labels", [0, 2])
+    def test_foreground(self, num_labels: int):
+        inputs = self.get_inputs(num_labels)
+        # a single foreground voxel next to the border
+        label = np.zeros(inputs["fixed_label"].shape, dtype=np.float32)
+        label[7, 0, 5, ...] = 1
+        inputs["fixed_label"] = tf.constant(label)
+        for seed in range(5):
+            outputs = preprocess.sample_patch(
+                inputs=inputs,
+                patch_size=self.patch_size,
+                seed=tf.constant([seed, 0]),
+                foreground=True,
+            )
+            start = outputs["indices"].numpy()[1:4]
+            assert is_equal_np(start, [5, 0, 3])
+            assert np.sum(outputs["fixed_label"].numpy()) == max(num_labels, 1)
+
+    def test_empty_foreground(self):
+        outputs = preprocess.sample_patch(
+            inputs=self.get_inputs(),
+            patch_size=self.patch_size,
+            seed=tf.constant([1, 2]),
+            foreground=True,
+        )
+        assert outputs["moving_image"].shape == self.patch_size
+
+
 def test_random_transform_3d_get_config():
     """Check config values."""
     config = dict(
@@ -98,11 +190,14 @@ class TestRandomTransformation:
         name=name,
     )
     extra_config_dict = dict(
-        affine=dict(scale=0.2), ddf=dict(field_strength=0.2, low_res_size=(1, 2, 3))
+        affine=dict(scale=0.2),
+        ddf=dict(field_strength=0.2, low_res_size=(1, 2, 3)),
+        affine_ddf=dict(scale=0.2, field_strength=0.2, low_res_size=(1, 2, 3)),
     )
     layer_cls_dict = dict(
         affine=preprocess.RandomAffineTransform3D,
         ddf=preprocess.RandomDDFTransform3D,
+        affine_ddf=preprocess.RandomAffineDDFTransform3D,
     )
 
     def build_layer(self, name: str) -> preprocess.RandomTransformation3D:
@@ -115,7 +210,7 @@ class TestRandomTransformation:
         config = {**self.common_config, **self.extra_config_dict[name]}  # type: ignore
         return self.layer_cls_dict[name](**config)
 
-    @pytest.mark.parametrize("name", ["affine", "ddf"])
+    @pytest.mark.parametrize("name", ["affine", "ddf", "affine_ddf"])
     def test_get_config(self, name: str):
         """
         Check config values.
@@ -155,7 +250,54 @@ class TestRandomTransformation:
         assert fixed.shape == (self.batch_size, *fixed_param_shape)
         assert not is_equal_np(moving, fixed)
 
-    @pytest.mark.parametrize("name", ["affine", "ddf"])
+    @pytest.mark.parametrize("name", ["affine", "ddf", "affine_ddf"])
+    def test_call_partial_batch(self, name: str):
+        """
+        Check batches smaller than batch_size are supported.
+
+        :param name: name of the layer
+        """
+        layer = self.build_layer(name)
+        batch_size = self.batch_size - 1
+        inputs = dict(
+            moving_image=tf.random.uniform((batch_size, *self.moving_image_size)),
+            fixed_image=tf.random.uniform((batch_size, *self.fixed_image_size)),
+            indices=tf.ones((batch_size, self.num_indices)),
+        )
+        outputs = layer(inputs, seed=tf.constant([1, 2]))
+        for k in inputs:
+            assert outputs[k].shape == inputs[k].shape
+
+    def test_gen_transform_params_affine_ddf(self):
+        """Check return shapes of the composite affine and DDF transformation."""
+        layer = self.build_layer("affine_ddf")
+        (moving_theta, moving_ddf), (
+            fixed_theta,
+            fixed_ddf,
+        ) = layer.gen_transform_params()
+        assert moving_theta.shape == (self.batch_size, 4, 3)
+        assert fixed_theta.shape == (self.batch_size, 4, 3)
+        assert moving_ddf.shape == (self.batch_size, *self.moving_image_size, 3)
+        assert fixed_ddf.shape == (self.batch_size, *self.fixed_image_size, 3)
+        assert not is_equal_np(moving_theta, fixed_theta)
+
+    def test_transform_affine_ddf(self):
+        """Check the composite transformation reduces to affine or DDF only."""
+        layer = self.build_layer("affine_ddf")
+        image = tf.random.uniform(shape=(self.batch_size, *self.fixed_image_size))
+        grid_ref = layer.fixed_grid_ref
+        (_, _), (theta, ddf) = layer.gen_transform_params()
+        identity = tf.tile(tf.eye(4, 3)[None, ...], (self.batch_size, 1, 1))
+
+        got = layer.transform(image, grid_ref, (theta, tf.zeros_like(ddf)))
+        expected = preprocess.RandomAffineTransform3D.transform(image, grid_ref, theta)
+        assert is_equal_tf(got, expected)
+
+        got = layer.transform(image, grid_ref, (identity, ddf))
+        expected = preprocess.RandomDDFTransform3D.transform(image, grid_ref, ddf)
+        assert is_equal_tf(got, expected)
+
+    @pytest.mark.parametrize("name", ["affine", "ddf", "affine_ddf"])
     def test_transform(self, name: str):
         """
         Check return shapes.
@@ -174,7 +316,7 @@ class TestRandomTransformation:
         )
         assert transformed.shape == moving_image.shape
 
-    @pytest.mark.parametrize("name", ["affine", "ddf"])
+    @pytest.mark.parametrize("name", ["affine", "ddf", "affine_ddf"])
     @pytest.mark.parametrize("labeled", [True, False])
     def test_call(self, name: str, labeled: bool):
         """
@@ -235,3 +377,72 @@ def test_random_transform_generator():
         batch_size=batch_size, scale=scale, seed=seed
     )
     assert is_equal_tf(got, expected)
+
+
+def test_gen_rand_affine_transform_tf():
+    """
+    Test the TensorFlow version of affine generator is stateless,
+    and solves the same system as the numpy version.
+    """
+    batch_size = 3
+    seed = tf.constant([1, 2])
+    got = deepreg.dataset.preprocess.gen_rand_affine_transform_tf(
+        batch_size=batch_size, scale=0.1, seed=seed
+    )
+    assert got.shape == (batch_size, 4, 3)
+
+    # the same seed gives the same transformation
+    same = deepreg.dataset.preprocess.gen_rand_affine_transform_tf(
+        batch_size=batch_size, scale=0.1, seed=seed
+    )
+    assert is_equal_tf(got, same)
+
+    # the corners are transformed to the perturbed corners
+    corners = deepreg.dataset.preprocess.AFFINE_CORNERS
+    new = np.einsum("ij,bjk->bik", corners, got.numpy())
+    ratio = new / corners[None, :, :3]
+    assert np.all(ratio >= 0.9 - 1e-5) and np.all(ratio <= 1 + 1e-5)
+
+    # scale 0 gives identity transformations
+    got = deepreg.dataset.preprocess.gen_rand_affine_transform_tf(
+        batch_size=batch_size, scale=0, seed=seed
+    )
+    expected = np.tile(np.eye(4, 3)[None, ...], (batch_size, 1, 1))
+    assert is_equal_tf(got, expected)
+
+
+def test_random_affine_transform_seed():
+    """Test the affine augmentation is reproducible given a seed."""
+    layer = preprocess.RandomAffineTransform3D(
+        moving_image_size=(3, 4, 5), fixed_image_size=(2, 3, 4), batch_size=2
+    )
+    inputs = dict(
+        moving_image=tf.random.uniform((2, 3, 4, 5)),
+        fixed_image=tf.random.uniform((2, 2, 3, 4)),
+        indices=tf.ones((2, 2)),
+    )
+    seed = tf.constant([3, 4])
+    got = layer(inputs, seed=seed)
+    expected = layer(inputs, seed=seed)
+    assert all(is_equal_tf(got[k], expected[k]) for k in inputs)
+
+
+def test_gen_rand_ddf_tf():
+    """Test the TensorFlow version of DDF generator is stateless."""
+    seed = tf.constant([1, 2])
+    got = preprocess.gen_rand_ddf_tf(
+        batch_size=2,
+        image_size=(3, 4, 5),
+        field_strength=1,
+        low_res_size=(1, 2, 3),
+        seed=seed,
+    )
+    assert got.shape == (2, 3, 4, 5, 3)
+    expected = preprocess.gen_rand_ddf_tf(
+        batch_size=2,
+        image_size=(3, 4, 5),
+        field_strength=1,
+        low_res_size=(1, 2, 3),
+        seed=seed,
+    )
+    assert is_equal_tf(got, expected)
@@ -8,6 +8,7 @@ pytest style
 import os
 import shutil
 
+import nibabel as nib
 import pytest
 
 from deepreg.predict import main as predict_main
@@ -54,6 +55,8 @@ class TestBuildConfig:
     [
         ["config/unpaired_labeled_ddf.yaml"],
         ["config/unpaired_labeled_ddf.yaml", "config/test/affine.yaml"],
+        ["config/unpaired_labeled_ddf.yaml", "config/test/stack_labels.yaml"],
+        ["config/unpaired_labeled_ddf.yaml", "config/test/patch.yaml"],
     ],
 )
 def test_train_and_predict_main(config_paths):
@@ -104,3 +107,56 @@ def test_train_and_predict_main(config_paths):
 
     shutil.rmtree("logs/test_train")
     shutil.rmtree("logs/test_predict")
+
+
+def test_train_and_predict_patch_main():
+    """
+    Test predicting with a model trained on patches.
+
+    The predictions have to be on the whole images at their original resolution,
+    not on sampled patches nor on images resized to the config image shape.
+    """
+    config_paths = ["config/unpaired_labeled_ddf.yaml", "config/test/patch.yaml"]
+    train_main(
+        args=[
+            "--gpu",
+            "",
+            "--exp_name",
+            "test_train",
+            "--config_path",
+        ]
+        + config_paths
+    )
+
+    predict_main(
+        args=[
+            "--gpu",
+            "",
+            "--ckpt_path",
+            "logs/test_train/save/ckpt-2",
+            "--split",
+            "test",
+            "--exp_name",
+            "test_predict",
+            "--save_nifti",
+            "--batch_size",
+            "64",
+            "--patch_size",
+            "8",
+            "8",
+            "8",
+            "--patch_stride",
+            "8",
+            "8",
+            "8",
+        ]
+    )
+
+    # check outputs have the original image shape, not the config one of 16^3
+    pair_dir = "logs/test_predict/test/pair_0_1"
+    for name in ["ddf", "pred_fixed_image", "fixed_image"]:
+        arr = nib.load(os.path.join(pair_dir, f"{name}.nii.gz")).get_fdata()
+        assert arr.shape[:3] == (64, 64, 60)
+
+    shutil.rmtree("logs/test_train")
+    shutil.rmtree("logs/test_predict")
@@ -18,6 +18,7 @@ from deepreg.util import (
     calculate_metrics,
     save_array,
     save_metric_dict,
+    set_precision_policy,
 )
 
 
@@ -82,6 +83,23 @@ def test_build_log_dir(log_dir: str, exp_name: str):
         assert tail == exp_name
 
 
+class TestSetPrecisionPolicy:
+    @pytest.mark.parametrize("precision", ["mixed_float16", "mixed_bfloat16"])
+    def test_mixed(self, precision: str):
+        set_precision_policy(precision)
+        try:
+            assert tf.keras.mixed_precision.global_policy().name == precision
+            assert tf.keras.layers.Dense(1).compute_dtype != "float32"
+        finally:
+            set_precision_policy("float32")
+        assert tf.keras.mixed_precision.global_policy().name == "float32"
+
+    def test_err(self):
+        with pytest.raises(ValueError) as err_info:
+            set_precision_policy("float64")
+        assert "precision must be one of" in str(err_info.value)
+
+
 class TestSaveArray:
     save_dir = "logs/test_util_save_array"
     arr_name = "arr"
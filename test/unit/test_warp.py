@@ -24,6 +24,25 @@ def test_main(out_path: str, expected_path: str):
     os.remove(expected_path)
 
 
+@pytest.mark.parametrize("interpolation", ["nearest", "linear", "cubic"])
+def test_main_interpolation(interpolation: str):
+    out_path = "logs/test_warp/out.nii.gz"
+    main(
+        args=[
+            "--image",
+            image_path,
+            "--ddf",
+            ddf_path,
+            "--out",
+            out_path,
+            "--interpolation",
+            interpolation,
+        ]
+    )
+    assert os.path.isfile(out_path)
+    os.remove(out_path)
+
+
 class TestShapeSanityCheck:
     @pytest.mark.parametrize(
         ("image_shape", "ddf_shape"),